@@ -0,0 +1,420 @@
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+import wave
+import multiprocessing
+from queue import Empty
+from threading import Thread
+import numpy as np
+from audio_server import AudioServer
+from audio_client import AudioClient
+from audio_codecs import data_fill_channel
+from audio_file import Playlist
+from audio_datagram import LOST
+from audio_protocol import pack_frame, format_options
+
+
+class BenchmarkClient(AudioClient):
+    """AudioClient that counts what it receives and, with protocol version 2, how long every frame took from
+    the moment the server published it until it was read off the socket here"""
+    def __init__(self, server, **kwargs):
+        super().__init__(**kwargs)
+        self.server = server
+        self.measuring = False
+        self.chunks = 0
+        self.latencies = []
+
+    def get_next_chunk(self, into=None):
+        data = super().get_next_chunk(into)
+        if self.measuring and data is not None and data is not LOST:
+            self.chunks += 1
+            if self.server_protocol >= 2:
+                published = self.server.audio_buffer.publish_time(self.last_sequence)
+                if published is not None:
+                    self.latencies.append(time.monotonic() - published)
+        return data
+
+
+def run_mode(mode, args, results):
+    """Runs one compression mode in its own process: a server on a synthetic source and args.clients clients
+    playing into null sinks over loopback. Client decoding shares the process, so cpu per client includes it"""
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    realtime = args.realtime == 1
+    server = AudioServer(chunk=args.chunk, channels=args.channels, rate=args.rate, bind_address="127.0.0.1",
+                         bind_port=args.port, audio_buffer_size=args.server_buffer, use_compression=mode,
+                         use_event_loop=args.use_event_loop == 1, audio_device=args.source, device_realtime=realtime,
+                         udp_fec=args.fec, udp_loss=args.loss, udp_reorder=args.reorder,
+                         multicast_group=args.group if args.transport == "multicast" else None,
+                         multicast_port=free_udp_port(), encode_workers=args.encode_workers,
+                         mid_side=args.mid_side == 1)
+    port = server.connection.getsockname()[1]
+    Thread(target=server.wait_for_connection, name="server", daemon=True).start()
+    while len(server.audio_buffer) < server.buffer_size:
+        time.sleep(0.05)
+
+    # what capturing and encoding costs before anyone is listening
+    cpu_start, start = time.process_time(), time.monotonic()
+    time.sleep(1)
+    server_cpu = (time.process_time() - cpu_start) / (time.monotonic() - start)
+
+    clients = []
+    for i in range(args.clients):
+        client = BenchmarkClient(server, chunk=args.chunk, channels=server.CHANNELS, rate=server.RATE,
+                                 audio_buffer_size=args.client_buffer, protocol_version=args.protocol,
+                                 audio_device="null", device_realtime=realtime, transport=args.transport,
+                                 multicast_interface="127.0.0.1")
+        client.set_server("127.0.0.1", port)
+        Thread(target=client.play_audio_stream, name="client {}".format(i), daemon=True).start()
+        clients.append(client)
+    time.sleep(args.warmup)
+
+    connected = [client for client in clients if client.is_connected and client.audio_buffer is not None]
+    bytes_start = [client.bytes_received for client in connected]
+    underruns_start = [client.audio_buffer.underruns for client in connected]
+    lost_start = [datagram_counts(client) for client in connected]
+    for client in connected:
+        client.measuring = True
+    cpu_start, start = time.process_time(), time.monotonic()
+    time.sleep(args.duration)
+    cpu = time.process_time() - cpu_start
+    elapsed = time.monotonic() - start
+    for client in connected:
+        client.measuring = False
+
+    lost, recovered = np.sum([datagram_counts(client) for client in connected] + [(0, 0)], axis=0) - \
+        np.sum(lost_start + [(0, 0)], axis=0)
+    chunks = sum(client.chunks for client in connected)
+    wire_bytes = sum(client.bytes_received for client in connected) - sum(bytes_start)
+    latencies = np.concatenate([client.latencies for client in connected] + [[]]) * 1000
+    result = {
+        "mode": mode,
+        "clients": len(connected),
+        "chunks_per_sec": chunks / elapsed,
+        "server_cpu": server_cpu * 100,
+        "cpu_per_client": (cpu / elapsed - server_cpu) * 100 / max(len(connected), 1),
+        "underruns": sum(client.audio_buffer.underruns for client in connected) - sum(underruns_start),
+        "lost": int(lost),
+        "recovered": int(recovered),
+        "bytes_per_chunk": wire_bytes / max(chunks, 1),
+        "wire_ratio": wire_bytes / max(chunks * args.chunk * server.CHANNELS * 2, 1),
+        "kbit_per_client": wire_bytes * 8 / 1000 / elapsed / max(len(connected), 1),
+    }
+    for name, percentile in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+        result[name] = float(np.percentile(latencies, percentile)) if len(latencies) > 0 else None
+    results.put(result)
+    server.shutdown()
+
+
+def run_receive(mode, args, results):
+    """Times the client's receive path alone: fill_buffer reading protocol version 2 frames off a socket pair,
+    decoding and committing them to the jitter buffer, without a sound card, a server or other clients competing
+    for the cpu. A feeder thread replays a few seconds of chunks the server encoded beforehand.
+    Temporary allocations are measured with tracemalloc in a second pass: the peak above the baseline while one
+    chunk is handled"""
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    server = AudioServer(chunk=args.chunk, channels=args.channels, rate=args.rate, bind_address="127.0.0.1",
+                         bind_port=0, use_compression=mode, audio_device=args.source, device_realtime=False,
+                         mid_side=args.mid_side == 1)
+    frames = []
+    for sequence in range(int(4 * server.RATE / server.CHUNK)):
+        data = server.get_next_chunk()
+        silent = server.chunk_metadata(data, mode)[0]
+        frames.append(pack_frame(sequence, mode, server.compress_data(data, silent, mode) if mode > 0 else data))
+    stream = b"".join(frames)
+    feed, connection = socket.socketpair()
+
+    def feeder():
+        try:
+            while True:
+                feed.sendall(stream)
+        except OSError:
+            pass
+
+    def drain():
+        acks = bytearray(4096)
+        try:
+            while feed.recv_into(acks) > 0:
+                pass
+        except OSError:
+            pass
+
+    Thread(target=feeder, name="feeder", daemon=True).start()
+    Thread(target=drain, name="drain", daemon=True).start()
+    client = AudioClient(chunk=server.CHUNK, channels=server.CHANNELS, rate=server.RATE,
+                         audio_buffer_size=args.client_buffer, audio_device="null")
+    client.connection = connection
+    client.parse_server_parameters(format_options({
+        "rate": server.RATE, "chunk": server.CHUNK, "channels": server.CHANNELS, "compression": mode, "proto": 2,
+        "window": 16, "factor": server.decimation_factor, "feedback": 1, "ms": int(server.mid_side)}))
+    client.is_connected = True
+
+    def receive(chunks):
+        for _ in range(chunks):
+            client.fill_buffer(1)
+            client.audio_buffer.clear()
+
+    receive(100)
+    chunks, cpu_start, start = 0, time.process_time(), time.monotonic()
+    while time.monotonic() - start < args.duration:
+        receive(50)
+        chunks += 50
+    cpu = time.process_time() - cpu_start
+    elapsed = time.monotonic() - start
+
+    tracemalloc.start()
+    receive(50)
+    temporary = []
+    for _ in range(500):
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        receive(1)
+        temporary.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    results.put({
+        "mode": mode,
+        "chunk": server.CHUNK,
+        "chunks_per_sec": chunks / elapsed,
+        "cpu_us": cpu / chunks * 1e6,
+        "temp_p50": float(np.percentile(temporary, 50)) / 1024,
+        "temp_max": float(np.max(temporary)) / 1024,
+        "pcm_kib": server.CHUNK * server.CHANNELS * 2 / 1024,
+    })
+    server.shutdown()
+
+
+def data_fill_reference(data):
+    """The original sample by sample walk of compression 2, on one channel. audio_codecs.data_fill_channel is its
+    vectorized version and has to produce exactly the same bytes"""
+    data_cords = []
+    new_data = []
+    direction = 1 if data[1] >= data[0] else -1
+    matching_values = False
+    last_value = None
+    for cursor, value in enumerate(data):
+        if cursor == 0 or cursor == len(data) - 1:
+            new_data.append(value)
+            data_cords.append(cursor)
+        elif value < last_value and direction == 1:
+            new_data.append(data[cursor - 1])
+            data_cords.append(cursor - 1)
+            direction = -1
+        elif value > last_value and direction == -1:
+            new_data.append(data[cursor - 1])
+            data_cords.append(cursor - 1)
+            direction = 1
+        elif value == last_value:
+            if not matching_values:
+                matching_values = True
+                new_data.append(value)
+                data_cords.append(cursor - 1)
+            elif data[cursor + 1] != value:
+                matching_values = False
+                new_data.append(value)
+                data_cords.append(cursor)
+                direction = 1 if data[cursor + 1] >= value else -1
+        last_value = value
+    return np.array([len(data_cords)] + data_cords + new_data, dtype=np.int16).tobytes()
+
+
+def fill_check_chunk(rng, kind, length):
+    """A chunk for the compression 2 check. Plateaus of every length are where the walk's state is tricky"""
+    if kind == "random":
+        return rng.integers(-32768, 32768, length).astype(np.int16)
+    if kind == "plateaus":
+        runs = rng.integers(1, 5, length)
+        return np.repeat(rng.integers(-4, 5, length), runs)[:length].astype(np.int16)
+    if kind == "small range":
+        return rng.integers(-2, 3, length).astype(np.int16)
+    # a quiet sine, quantized so it has plateaus at the peaks and some noise on top
+    sine = np.sin(np.arange(length) * rng.uniform(0.01, 0.5)) * rng.uniform(1, 200)
+    return (np.round(sine) + rng.integers(-1, 2, length) * (rng.random(length) < 0.1)).astype(np.int16)
+
+
+def run_fill_check(args):
+    """Checks compression 2 against the reference walk on fuzzed chunks of 3 to args.chunk samples and times
+    both on a noisy sine. Returns the number of chunks that came out different"""
+    rng = np.random.default_rng(0)
+    kinds = ("random", "plateaus", "small range", "sine")
+    mismatches = 0
+    for i in range(args.fill_check):
+        kind = kinds[i % len(kinds)]
+        chunk = fill_check_chunk(rng, kind, int(rng.integers(3, args.chunk + 1)))
+        if data_fill_channel(chunk) != data_fill_reference(chunk):
+            mismatches += 1
+            if mismatches <= 5:
+                print("mismatch on a {} chunk of {} samples: {}".format(kind, len(chunk), chunk.tolist()))
+    print("compression 2: {} fuzzed chunks, {} mismatch(es) against the reference walk".format(
+        args.fill_check, mismatches))
+
+    sine = (np.sin(np.arange(args.chunk) * 0.03) * 8000 + rng.normal(0, 50, args.chunk)).astype(np.int16)
+    for name, encode in (("reference walk", data_fill_reference), ("vectorized", data_fill_channel)):
+        repeats, start = 0, time.perf_counter()
+        while time.perf_counter() - start < 1:
+            encode(sine)
+            repeats += 1
+        print("{:>14}: {:.3f} ms per {} sample chunk".format(name, (time.perf_counter() - start) / repeats * 1000,
+                                                              args.chunk))
+    return mismatches
+
+
+def write_wav(filename, samples, rate, channels):
+    with wave.open(filename, "wb") as file:
+        file.setnchannels(channels)
+        file.setsampwidth(2)
+        file.setframerate(rate)
+        file.writeframes(np.repeat(samples, channels).astype(np.int16).tobytes())
+
+
+def run_playlist_check(args):
+    """Plays one continuous sine split over files at different sample rates and channel counts through a
+    Playlist and checks the track transitions. The sine goes on without a break from one file into the next, so
+    a seam is only right if no step across it is larger than the steepest step of the sine itself (with a little
+    room for the interpolation). Returns the number of seams that were not"""
+    frequency, amplitude, rate = 440, 12000, 44100
+    # (sample rate, channels, seconds) of every file, in playlist order. the playlist plays at the first rate
+    tracks = [(44100, 1, 0.61), (22050, 1, 0.53), (48000, 2, 0.47), (32000, 1, 0.39), (44100, 2, 0.5)]
+    directory = tempfile.mkdtemp()
+    filenames = []
+    start = 0.0
+    seams = []
+    for index, (track_rate, channels, seconds) in enumerate(tracks):
+        frames = int(seconds * track_rate)
+        t = start + np.arange(frames) / track_rate
+        filename = os.path.join(directory, "{}.wav".format(index))
+        write_wav(filename, np.round(amplitude * np.sin(2 * np.pi * frequency * t)), track_rate, channels)
+        filenames.append(filename)
+        start += frames / track_rate
+        seams.append(start)
+    try:
+        playlist = Playlist(filenames, args.chunk, use_cache=False)
+        chunks = []
+        while not playlist.finished:
+            chunks.append(playlist.read_chunk())
+        playlist.close()
+    finally:
+        shutil.rmtree(directory)
+    output = np.frombuffer(b"".join(bytes(chunk) for chunk in chunks), dtype=np.int16).astype(np.int64)
+    slope = 2 * np.pi * frequency * amplitude / rate
+    failures = 0
+    for index, seam in enumerate(seams[:-1]):
+        around = int(round(seam * rate))
+        worst = int(np.max(np.abs(np.diff(output[around - 8:around + 8]))))
+        ok = worst <= 1.1 * slope
+        failures += 0 if ok else 1
+        print("track {} -> {} ({} -> {} Hz): largest step {} at the seam, the sine's own is {:.0f}. {}".format(
+            index + 1, index + 2, tracks[index][0], tracks[index + 1][0], worst, slope, "ok" if ok else "BROKEN"))
+    return failures
+
+
+def free_udp_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def datagram_counts(client):
+    """(lost, recovered by fec) chunks of a datagram client"""
+    if client.reorder is None:
+        return 0, 0
+    return client.reorder.lost, client.reorder.recovered
+
+
+def print_results(results):
+    print("mode clients chunks/s   p50 ms   p95 ms   p99 ms   max ms  server cpu%  cpu%/client  underruns  "
+          "bytes/chunk  wire  kbit/s/client   lost  recovered")
+    for r in results:
+        latency = "".join("{:>9}".format("-" if r[name] is None else "{:.1f}".format(r[name]))
+                          for name in ("p50", "p95", "p99", "max"))
+        print("{:>4} {:>7} {:>8.1f}{} {:>12.1f} {:>12.2f} {:>10} {:>12.0f} {:>5.2f} {:>14.1f} {:>6} {:>10}".format(
+            r["mode"], r["clients"], r["chunks_per_sec"], latency, r["server_cpu"], r["cpu_per_client"],
+            r["underruns"], r["bytes_per_chunk"], r["wire_ratio"], r["kbit_per_client"], r["lost"], r["recovered"]))
+
+
+def print_receive_results(results):
+    print("mode  chunk  chunks/s  cpu us/chunk  temp KiB/chunk p50  max  pcm KiB/chunk")
+    for r in results:
+        print("{:>4} {:>6} {:>9.0f} {:>13.1f} {:>19.1f} {:>4.1f} {:>14.1f}".format(
+            r["mode"], r["chunk"], r["chunks_per_sec"], r["cpu_us"], r["temp_p50"], r["temp_max"], r["pcm_kib"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load test for the audio transport. Starts a server on "
+                                                 "a synthetic source and a number of clients playing into null sinks "
+                                                 "for every compression mode")
+    parser.add_argument("--clients", default=4, type=int, help="simulated clients per mode")
+    parser.add_argument("--modes", default="0,1,2,3,4,5", help="comma separated use_compression modes")
+    parser.add_argument("--duration", default=5.0, type=float, help="seconds measured per mode")
+    parser.add_argument("--warmup", default=2.0, type=float, help="seconds between connecting and measuring")
+    parser.add_argument("--source", default="music", help="sine, noise, silence, music, null or wav:<filename>")
+    parser.add_argument("--realtime", default=1, type=int, choices=[0, 1],
+                        help="0 runs source and sinks flat out to find the sustained maximum")
+    parser.add_argument("--protocol", default=2, type=int, choices=[1, 2],
+                        help="latency is only measured with version 2, version 1 frames carry no sequence number")
+    parser.add_argument("--use_event_loop", default=0, type=int, choices=[0, 1])
+    parser.add_argument("--transport", default="tcp", choices=["tcp", "udp", "multicast"])
+    parser.add_argument("--group", default="239.255.10.60", help="multicast group for --transport multicast")
+    parser.add_argument("--fec", default=0, type=int, help="udp and multicast. chunks per parity datagram, 0 for none")
+    parser.add_argument("--loss", default=0.0, type=float,
+                        help="udp and multicast. fraction of datagrams dropped")
+    parser.add_argument("--reorder", default=0.0, type=float,
+                        help="udp and multicast. fraction of datagrams reordered")
+    parser.add_argument("--encode_workers", default=0, type=int, help="server encoding processes, 0 for none")
+    parser.add_argument("--chunk", default=2048, type=int)
+    parser.add_argument("--channels", default=1, type=int)
+    parser.add_argument("--mid_side", default=0, type=int, choices=[0, 1],
+                        help="compression 4 codes stereo as mid and side")
+    parser.add_argument("--rate", default=44100, type=int)
+    parser.add_argument("--server_buffer", default=16, type=int, help="server buffer size in chunks")
+    parser.add_argument("--client_buffer", default=8, type=int, help="client buffer size in chunks")
+    parser.add_argument("--port", default=0, type=int, help="0 picks a free port")
+    parser.add_argument("--receive", default=0, type=int, choices=[0, 1],
+                        help="1 benchmarks only the client's receive and decode path, with its temporary allocations")
+    parser.add_argument("--fill_check", default=0, type=int,
+                        help="only checks compression 2 against its reference walk on this many fuzzed chunks")
+    parser.add_argument("--playlist_check", default=0, type=int, choices=[0, 1],
+                        help="1 only checks that playlist track transitions are seamless, across sample rates")
+    parser.add_argument("--verbose", default=0, type=int, choices=[0, 1], help="show server and client output")
+    args = parser.parse_args()
+
+    if args.fill_check > 0:
+        sys.exit(1 if run_fill_check(args) > 0 else 0)
+    if args.playlist_check == 1:
+        sys.exit(1 if run_playlist_check(args) > 0 else 0)
+
+    # every mode gets a fresh process, so modes do not share caches or leftover threads. not daemonic, those may
+    # not start the server's encoding processes. the server shuts down at the end of a mode and the process exits
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for mode in [int(m) for m in args.modes.split(",")]:
+        if args.receive == 1:
+            print("benchmarking the receive path with compression mode {}".format(mode))
+        else:
+            print("benchmarking compression mode {} with {} client(s)".format(mode, args.clients))
+        queue = context.Queue()
+        process = context.Process(target=run_receive if args.receive == 1 else run_mode, args=(mode, args, queue))
+        process.start()
+        try:
+            results.append(queue.get(timeout=args.warmup + args.duration + 60))
+        except Empty:
+            print("mode {} did not finish".format(mode))
+        process.join(timeout=30)
+        if process.is_alive():
+            print("mode {} did not exit".format(mode))
+            process.terminate()
+    if args.receive == 1:
+        print_receive_results(results)
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,117 @@
-from time import sleep
+from time import sleep, monotonic, perf_counter
 from threading import Thread
 import numpy as np
 import socket
-import pyaudio
+import select
+from audio_devices import pyaudio, PA_INT16, require_pyaudio, open_sink
+from audio_jitter import JitterBuffer, DriftEstimator
+from audio_codecs import Interpolator, FractionalResampler, LosslessDecoder, AdpcmDecoder, adpcm_chunk_bytes, \
+    DECIMATED_FIRST
+from audio_protocol import PROTOCOL_VERSION, DEFAULT_WINDOW, FRAME_HEADER, CLIENT_MESSAGE, MSG_ACK, MSG_REGISTER, \
+    MSG_REPAIR, MSG_FEEDBACK, MSG_STREAM, REPAIR_MESSAGE, FLAG_PARAMS, PARAMS_SEQUENCE, parse_options, \
+    recv_exact_into, pack_feedback
+from audio_datagram import LOST, ReorderBuffer, unpack_datagram
+from audio_relay import RelayServer
+from audio_metrics import Metrics
+
+
+# compression modes decompress_data handles. protocol version 2 servers may switch between these mid-stream
+CODECS = (0, 1, 2, 3, 4, 5)
+# what get_next_chunk returns for the frame that moved us to another of the server's streams
+STREAM_CHANGED = object()
 
 
 class AudioClient:
     # noinspection SpellCheckingInspection
-    def __init__(self, chunk=2048, audio_format=pyaudio.paInt16, channels=1, rate=44100, audio_buffer_size=96):
+    def __init__(self, chunk=2048, audio_format=PA_INT16, channels=1, rate=44100, audio_buffer_size=96,
+                 protocol_version=PROTOCOL_VERSION, window=DEFAULT_WINDOW, min_buffer_depth=2, audio_device="pyaudio",
+                 device_realtime=True, transport="tcp", multicast_interface="0.0.0.0", relay_port=None,
+                 relay_address="0.0.0.0", relay_buffer_size=102, relay_options=None, headless=False,
+                 drift_correction=True, drift_limit=0.001, metrics_port=None, metrics_address="127.0.0.1",
+                 metrics_file=None, metrics_interval=10, stream=None):
         # constants
         self.CHUNK = chunk             # samples per frame
         self.FORMAT = audio_format     # audio format (bytes per sample?)
         self.CHANNELS = channels       # 1 for mono, 2 for stereo
         self.RATE = rate               # samples per second
         self.live_stream = None        # pyaudio object
+        self.audio_device = audio_device         # pyaudio, null or wav:<filename>
+        self.device_realtime = device_realtime
         self.connection = None         # connection to server
         self.server_address = None
         self.server_port = None
         self.is_connected = False
+        self.stream_name = stream      # which of the server's streams to play, its own one when None
+        self.resume_token = None       # the server keeps our place in its buffer for a while with this one
+        self.streams = []              # names of every stream the server has, from a protocol version 2 server
         self.buffer_size = audio_buffer_size
-        self.audio_buffer = []
+        self.min_buffer_depth = min_buffer_depth
+        self.audio_buffer = None       # JitterBuffer, created once the server told us the chunk size
+        self.drift_correction = drift_correction    # resample playback to follow the server's clock
+        self.drift_limit = drift_limit              # largest rate correction, as a fraction
+        self.drift = None              # DriftEstimator, created with the audio buffer
+        self.resampler = None          # FractionalResampler
         self.use_compression = 0
-        self.last_sample = 0           # used for compression mode 1
+        self.mid_side = False          # compression 4 chunks may be coded as mid and side. relays pass that on
+        self.last_sample = 0           # used for compression mode 1, the last frame of the previous chunk
+        self.allocate_decode_buffers()
+        self.decimation_factor = 1
+        self.interpolator = None       # used for compression mode 3
         self.threads = {}
+        self.protocol_version = protocol_version    # highest version we ask the server for
+        self.window = window
+        self.server_protocol = 1       # version the server agreed to
+        self.last_sequence = None      # sequence number of the last frame received
+        self.frames_since_ack = 0
+        self.feedback = False          # the server wants our playout buffer depth with every ack
+        self.bytes_received = 0        # everything read off the socket while streaming, headers included
+        # reused for every chunk, so receiving allocates nothing. grown when a bigger chunk comes in
+        self.receive_buffer = bytearray(self.CHUNK * self.CHANNELS * 2)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.header_view = memoryview(bytearray(FRAME_HEADER.size))
+        self.silence = bytes(self.CHUNK * self.CHANNELS * 2)     # a silent chunk, sent as 2 zero bytes
+        # datagram transport
+        self.transport = transport     # tcp, or udp / multicast to ask a protocol version 2 server for datagrams
+        self.server_transport = "tcp"  # transport the server agreed to
+        self.session_id = 0
+        self.udp_port = None
+        self.parity_group = 0
+        self.datagram = None           # udp socket
+        self.reorder = None            # ReorderBuffer
+        self.last_datagram = 0.0
+        self.last_register = 0.0
+        self.registered = False        # the server confirmed our udp address
+        # multicast
+        self.multicast_interface = multicast_interface
+        self.multicast = None          # socket joined to the server's group
+        self.multicast_group = None
+        self.multicast_port = None
+        self.stream_id = None          # session id the server puts in multicast datagrams
+        # relay. re-serves everything received on relay_port, still encoded
+        self.relay_port = relay_port
+        self.relay_address = relay_address
+        self.relay_buffer_size = relay_buffer_size
+        self.relay_options = relay_options or {}     # any other AudioServer options, i.e. use_event_loop
+        self.relay = None              # RelayServer, created on the first connection
+        self.headless = headless       # no sink and no decoding, only makes sense with a relay_port
+        # metrics. see audio_metrics.py
+        self.metrics = Metrics("audio_client_")
+        self.decode_time = {codec: self.metrics.histogram(
+            "decode_seconds", "Time to decode one chunk into the jitter buffer", codec=codec) for codec in CODECS}
+        self.received_chunks = self.metrics.counter("received_chunks_total", "Chunks received from the server")
+        self.connections = self.metrics.counter("connections_total", "Connections made to the server")
+        self.reconnects = self.metrics.counter("reconnects_total", "Connections made after the first one")
+        self.metrics.add_collector(self.collect_metrics)
+        self.metrics.start(metrics_port, metrics_address, metrics_file, metrics_interval)
 
     def create_audio_stream(self):
         """ Create pyaudio object and open stream for reading/writing audio data"""
+        if self.audio_device != "pyaudio":
+            self.live_stream = open_sink(self.audio_device, self.CHUNK, self.CHANNELS, self.RATE,
+                                         self.device_realtime)
+            print("audio stream running on {}".format(self.audio_device))
+            return
+        require_pyaudio()
         stream = pyaudio.PyAudio()
         print("starting new audio stream")
         self.live_stream = stream.open(
@@ -51,137 +137,571 @@ class AudioClient:
         """Connects to server and gets audio parameters for creating the pyaudio object, i.e. sample rate, etc
         Normally called by play_audio_stream"""
         retries = retry if retry is not None else 3
+        attempt = 0
         print("connecting to audio server at {}:{}".format(self.server_address, self.server_port))
         while retries > 0 and not self.is_connected:
             try:
                 self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.connection.connect((self.server_address, self.server_port))
                 self.connection.settimeout(3)
-                info = "AudioClient,"+str(self.buffer_size)
+                # the backlog the server starts us with. no more than the jitter buffer aims to keep, anything over
+                # that would only have to be played off again
+                backlog = self.audio_buffer.target_depth if self.audio_buffer is not None else self.min_buffer_depth
+                info = "AudioClient,"+str(min(backlog, self.buffer_size))
+                if self.protocol_version >= 2:
+                    info += ",proto={},window={},ms=1".format(self.protocol_version, self.window)
+                    # a relay forwards chunks as they are, its own clients could not follow a codec switch
+                    if self.relay_port is None:
+                        info += ",codecs={}".format("/".join(str(codec) for codec in CODECS))
+                    if self.transport in ("udp", "multicast"):
+                        info += ",transport={}".format(self.transport)
+                    else:
+                        info += ",feedback=1"
+                if self.stream_name is not None:
+                    info += ",stream={}".format(self.stream_name)
+                if self.resume_token is not None and self.last_sequence is not None:
+                    # picks up right after the last chunk we got, the ones we have buffered keep playing meanwhile
+                    info += ",token={},seq={}".format(self.resume_token, self.last_sequence)
+                sink = (self.RATE, self.CHANNELS)
                 self.connection.send(bytes(info, "utf-8"))
                 data = self.connection.recv(self.CHUNK)
-                data = data.decode("utf-8").split(sep=",")
-                data = [int(d) for d in data if d != ","]
-                self.RATE = data[0]
-                self.CHUNK = data[1]
-                self.use_compression = data[2]
-                print("using samplerate: {}, chunksize: {}, compression: {}".format(self.RATE, self.CHUNK,
-                                                                                    self.use_compression))
+                self.parse_server_parameters(data.decode("utf-8"))
+                print("using samplerate: {}, chunksize: {}, compression: {}, protocol: {}".format(
+                    self.RATE, self.CHUNK, self.use_compression, self.server_protocol))
                 self.connection.send(bytes("ok", "utf-8"))
             except Exception as e:
                 print(e)
                 retries -= 1
                 print("connection failed. retries remaining:", retries)
-                sleep(2)
+                # quick at first, a short drop should not cost seconds
+                sleep(min(2, 0.25 * 2 ** attempt))
+                attempt += 1
             else:
                 self.is_connected = True
                 print("connection established")
-                self.create_audio_stream()
+                if self.connections.value > 0:
+                    self.reconnects.inc()
+                self.connections.inc()
+                if self.server_transport in ("udp", "multicast"):
+                    self.open_datagram_socket()
+                if self.relay_port is not None:
+                    self.start_relay()
+                if not self.headless and (self.live_stream is None or (self.RATE, self.CHANNELS) != sink):
+                    self.create_audio_stream()
+
+    def start_relay(self):
+        """Starts serving downstream clients once the first connection told us the stream parameters.
+        Later connections keep the same relay"""
+        if self.relay is None:
+            self.relay = RelayServer(self, self.relay_address, self.relay_port, self.relay_buffer_size,
+                                     **self.relay_options)
+            thread = Thread(target=self.relay.wait_for_connection, name="relay", daemon=True)
+            self.threads[thread.name] = thread
+            thread.start()
+        elif not self.relay.matches(self):
+            print("upstream stream parameters changed. downstream clients are no longer being fed")
+        self.relay.reset_lag()
+
+    def parse_server_parameters(self, data):
+        """Version 2 servers answer with key=value fields. Older servers send rate,chunk,channels, compression"""
+        fields = data.split(sep=",")
+        if "=" in data:
+            options = parse_options(fields)
+            self.RATE = int(options["rate"])
+            self.CHUNK = int(options["chunk"])
+            self.CHANNELS = int(options.get("channels", 1))
+            self.mid_side = options.get("ms") == "1"
+            self.use_compression = int(options["compression"])
+            self.server_protocol = int(options.get("proto", 1))
+            self.window = int(options.get("window", 1))
+            self.decimation_factor = int(options.get("factor", 1))
+            self.server_transport = options.get("transport", "tcp")
+            self.session_id = int(options.get("session", 0))
+            self.udp_port = int(options.get("udp_port", 0))
+            self.parity_group = int(options.get("fec", 0))
+            self.multicast_group = options.get("group")
+            self.multicast_port = int(options.get("group_port", 0))
+            self.stream_id = int(options.get("stream", 0))
+            self.feedback = options.get("feedback") == "1"
+            self.streams = options["streams"].split("/") if "streams" in options else []
+            self.resume_token = options.get("token")
+            if "name" in options:
+                self.stream_name = options["name"]
+        else:
+            data = [int(d) for d in fields if d != ","]
+            self.RATE = data[0]
+            self.CHUNK = data[1]
+            self.CHANNELS = data[2]
+            self.mid_side = False
+            self.use_compression = data[3]
+            self.decimation_factor = data[4] if len(data) > 4 else 1
+            self.server_protocol = 1
+            self.server_transport = "tcp"
+            self.feedback = False
+            self.streams = []
+            self.resume_token = None
+        self.last_sequence = None
+        self.frames_since_ack = 0
+        if len(self.silence) != self.CHUNK * self.CHANNELS * 2:
+            self.silence = bytes(self.CHUNK * self.CHANNELS * 2)
+        self.allocate_decode_buffers()
+        self.last_sample = 0
+        # filter state starts from scratch on every connection, just like the server's does for a new client
+        self.interpolator = Interpolator(self.decimation_factor, self.CHUNK, self.CHANNELS) \
+            if self.use_compression == 3 else None
+        chunk_bytes = self.CHUNK * self.CHANNELS * 2
+        if self.drift_correction:
+            if self.resampler is None or self.resampler.channels != self.CHANNELS:
+                self.resampler = FractionalResampler(self.CHANNELS)
+            if self.drift is None or self.audio_buffer is None or self.audio_buffer.chunk_bytes != chunk_bytes:
+                self.drift = DriftEstimator(self.CHUNK / self.RATE, self.drift_limit)
+            else:
+                self.drift.reset()
+        if self.audio_buffer is None or self.audio_buffer.chunk_bytes != chunk_bytes or \
+                self.audio_buffer.channels != self.CHANNELS:
+            self.audio_buffer = JitterBuffer(self.buffer_size, chunk_bytes, self.CHUNK / self.RATE,
+                                             min_depth=self.min_buffer_depth, channels=self.CHANNELS)
 
     def play_audio_stream(self):
         """Called after setting server IP and port.
         Takes care of creating buffer thread and writing audio data"""
         done = False
+        underruns = 0
         while done is False:
             if "buffer_control" not in self.threads.keys():
                 print("starting buffer thread")
                 thread = Thread(target=self.buffer_control, name="buffer_control", daemon=True)
                 self.threads[thread.name] = thread
                 self.connect_to_server()
-                self.fill_buffer()
                 thread.start()
-            while self.live_stream.get_write_available() > self.CHUNK:
-                if len(self.audio_buffer) == 0:
-                    print("buffer empty")
-                    sleep(1)
-                    break
-                data = self.audio_buffer.pop(0) if len(self.audio_buffer) > 0 else None
-                self.write_audio_to_stream(data)
+            if self.audio_buffer is None or self.live_stream is None:
+                sleep(1)
+                continue
+            # blocks for at most one chunk period. an empty buffer hands back a concealment chunk instead
+            data = self.audio_buffer.get()
+            if self.audio_buffer.underruns != underruns:
+                underruns = self.audio_buffer.underruns
+                print("buffer empty. target depth now {}".format(self.audio_buffer.target_depth))
+            if self.drift is not None:
+                data = self.correct_drift(data)
+            self.write_audio_to_stream(data)
+
+    def collect_metrics(self):
+        """Values kept anyway, read when the metrics are asked for"""
+        samples = [
+            ("received_bytes_total", "counter", "Bytes read off the sockets while streaming, headers included", {},
+             self.bytes_received),
+            ("connected", "gauge", "1 while connected to the server", {}, int(self.is_connected)),
+            ("codec", "gauge", "Compression mode the server is sending", {}, self.use_compression),
+        ]
+        if self.audio_buffer is not None:
+            samples += [
+                ("buffer_depth", "gauge", "Chunks in the jitter buffer", {}, len(self.audio_buffer)),
+                ("buffer_target_depth", "gauge", "Depth the jitter buffer is aiming for", {},
+                 self.audio_buffer.target_depth),
+                ("underruns_total", "counter", "Times the jitter buffer ran empty", {}, self.audio_buffer.underruns),
+                ("jitter_seconds", "gauge", "Smoothed deviation of chunk arrival times", {},
+                 self.audio_buffer.jitter),
+            ]
+        if self.drift is not None:
+            samples.append(("clock_drift_ppm", "gauge", "Estimated drift of the server clock against the sink", {},
+                            self.drift.drift * 1e6))
+        if self.reorder is not None:
+            samples += [
+                ("lost_chunks_total", "counter", "Datagram chunks given up on and concealed", {}, self.reorder.lost),
+                ("recovered_chunks_total", "counter", "Datagram chunks rebuilt from parity", {},
+                 self.reorder.recovered),
+            ]
+        if self.relay is not None:
+            samples.append(("relay_upstream_lag_seconds", "gauge", "How much later than at best chunks arrive "
+                            "from upstream", {}, self.relay.upstream_lag))
+        return samples
+
+    def correct_drift(self, data):
+        """Plays the chunk a tiny bit faster or slower so the jitter buffer depth stays where buffering left it,
+        however far the server's clock is from the sound card's. The depth only counts while playing, not while
+        buffering up again after an underrun"""
+        if not self.audio_buffer.buffering:
+            self.drift.update(len(self.audio_buffer), self.audio_buffer.target_depth - 1)
+        return self.resampler.process(np.frombuffer(data, dtype=np.int16), self.drift.ratio).tobytes()
 
     def buffer_control(self):
-        """Buffer thread function. Maintains connection to server and keeps buffer full"""
+        """Buffer thread function. Maintains connection to server and keeps buffer full.
+        fill_buffer blocks while the buffer is full, so this thread sleeps instead of spinning"""
         while True:
             if not self.is_connected:
                 self.connect_to_server()
-            if len(self.audio_buffer) < self.buffer_size:
+            if self.is_connected:
                 self.fill_buffer()
+            else:
+                sleep(1)
 
-    def fill_buffer(self):
-        """Grabs audio data from server, applies compression if enabled, and adds to buffer"""
-        while len(self.audio_buffer) < self.buffer_size and self.is_connected:
-            data = self.get_next_chunk()
-            data = self.decompress_data(data) if self.use_compression > 0 else data
-            if data is None:
+    def fill_buffer(self, chunks=None):
+        """Grabs audio data from server, decompresses it if needed, and adds it to the buffer.
+        Runs until the connection drops, or for the given number of chunks. A relay gets every chunk before it is
+        decoded, a headless one never decodes at all.
+        Chunks are decoded straight into a claimed jitter buffer slot, uncompressed ones are even received into it,
+        so nothing chunk sized gets allocated or copied on the way"""
+        while self.is_connected and (chunks is None or chunks > 0):
+            slot = None if self.headless else self.audio_buffer.claim()
+            into = None if slot is None else self.audio_buffer.slots[slot]
+            data = self.get_next_chunk(into)
+            if data is STREAM_CHANGED:
+                continue
+            if data is not None and data is not LOST:
+                self.received_chunks.inc()
+            if data is not None and self.relay is not None and self.relay.matches(self):
+                self.relay.relay_chunk(data)
+            if self.headless:
+                if data is None:
+                    break
+            elif data is LOST:
+                # the datagram transport gave up on this one. conceal it in its place in the stream
+                self.audio_buffer.put_lost()
+            elif data is None:
                 print("a chunk was None")
                 break
+            elif data is into:
+                self.audio_buffer.commit(len(into))
             else:
-                self.audio_buffer.append(data)
-
-    def get_next_chunk(self):
-        """gets next chunk of audio data from server. When using compression, a 2 byte header is received first
-        which contains the amount of data to expect. Otherwise the amount of data is always self.CHUNK * 2"""
-        data_size = self.CHUNK if self.use_compression > 0 else self.CHUNK * 2
-        data = bytes()
-        while len(data) < data_size:
+                started = perf_counter()
+                length = self.decompress_data(data, self.audio_buffer.samples[slot]) * 2
+                self.decode_time[self.use_compression].observe(perf_counter() - started)
+                self.audio_buffer.commit(length)
+            if chunks is not None:
+                chunks -= 1
+
+    def receive_into(self, length):
+        """The next length bytes off the socket, as a view of the receive buffer that is only good until the
+        next call"""
+        if length > len(self.receive_buffer):
+            self.receive_buffer = bytearray(length)
+            self.receive_view = memoryview(self.receive_buffer)
+        view = self.receive_view[:length]
+        recv_exact_into(self.connection, view)
+        return view
+
+    def get_next_chunk(self, into=None):
+        """gets next chunk of audio data from server. When using a variable size compression mode, a 2 byte header
+        is received first which contains the amount of data to expect. Otherwise the amount of data is always
+        self.CHUNK * self.CHANNELS * 2, or the constant ADPCM chunk size with compression mode 5.
+        A whole uncompressed chunk is received straight into the writable memoryview into, if one is given, and into
+        itself is returned. Anything else comes back as a view that is only good until the next call"""
+        if self.server_transport in ("udp", "multicast"):
+            return self.get_next_datagram()
+        if self.server_protocol >= 2:
+            return self.get_next_frame(into)
+        variable_size = self.use_compression in (1, 2, 3, 4)
+        if self.use_compression == 5:
+            data_size = adpcm_chunk_bytes(self.CHUNK, self.CHANNELS)
+        else:
+            data_size = self.CHUNK if variable_size else self.CHUNK * self.CHANNELS * 2
+        if into is None or self.use_compression != 0 or len(into) != data_size:
+            if data_size > len(self.receive_buffer):
+                self.receive_buffer = bytearray(data_size)
+                self.receive_view = memoryview(self.receive_buffer)
+            into = self.receive_view
+        received = 0
+        while received < data_size:
             try:
-                chunk_data = self.connection.recv(data_size)
-                if len(chunk_data) == 0:
+                count = self.connection.recv_into(into[received:data_size])
+                self.bytes_received += count
+                if count == 0:
                     raise ConnectionError("chunk data was length 0")
-                elif len(data) == 0 and len(chunk_data) == 2:
-                    if chunk_data == bytes(2):
-                        data = bytes(data_size)
-                    else:
-                        data_size = np.frombuffer(chunk_data, dtype=np.int16)[0]
-                        self.connection.send(chunk_data)
+                elif received == 0 and count == 2 and (variable_size or into[:2] == bytes(2)):
+                    if into[:2] == bytes(2):
+                        self.connection.send(bytes("ok", "utf-8"))
+                        return self.silence if self.use_compression == 0 else bytes(2)
+                    data_size = int(np.frombuffer(into, dtype=np.int16, count=1)[0])
+                    self.connection.send(into[:2])
+                    if data_size > len(into):
+                        self.receive_buffer = bytearray(data_size)
+                        self.receive_view = into = memoryview(self.receive_buffer)
                 else:
-                    data += chunk_data
-            except (ConnectionError, socket.timeout) as e:
+                    received += count
+            except OSError as e:
                 print("failed getting chunk:", e)
                 self.connection.close()
                 self.is_connected = False
                 return None
         self.connection.send(bytes("ok", "utf-8"))
+        return into if len(into) == data_size else into[:data_size]
+
+    def get_next_frame(self, into=None):
+        """Protocol version 2. Reads one self-describing frame and acknowledges every window / 2 frames
+        so the server never has to stop and wait for us"""
+        try:
+            recv_exact_into(self.connection, self.header_view)
+            length, sequence, codec, flags = FRAME_HEADER.unpack(self.header_view)
+            if codec == 0 and into is not None and length == len(into):
+                recv_exact_into(self.connection, into)
+                data = into
+            else:
+                data = self.receive_into(length)
+            self.bytes_received += FRAME_HEADER.size + length
+            if flags & FLAG_PARAMS:
+                # acknowledged on its own, the server ignores our acks from the moment it switched until this one
+                self.change_stream(bytes(data).decode("utf-8"))
+                self.connection.send(CLIENT_MESSAGE.pack(MSG_ACK, PARAMS_SEQUENCE))
+                return STREAM_CHANGED
+            self.last_sequence = sequence
+            self.frames_since_ack += 1
+            if self.frames_since_ack >= max(1, self.window // 2):
+                message = CLIENT_MESSAGE.pack(MSG_ACK, sequence)
+                if self.feedback:
+                    # lets the server keep our latency in check by skipping chunks when we fall behind
+                    message += CLIENT_MESSAGE.pack(MSG_FEEDBACK, pack_feedback(
+                        len(self.audio_buffer), self.audio_buffer.target_depth, self.audio_buffer.underruns))
+                self.connection.send(message)
+                self.frames_since_ack = 0
+        except OSError as e:
+            # timeouts and resets, but also the network going away for a moment (unreachable host and the like)
+            print("failed getting frame:", e)
+            self.connection.close()
+            self.is_connected = False
+            return None
+        if codec != self.use_compression:
+            self.switch_codec(codec)
+        if codec == 0 and length == 2 and data == bytes(2):
+            return self.silence
         return data
 
-    def decompress_data(self, data):
-        """Called when using compression. passes compressed data to the proper decompress function
+    def switch_stream(self, name):
+        """Asks the server for another of its streams (see self.streams) without reconnecting. Playback moves
+        over once the server answers, in the middle of fill_buffer. Protocol version 2 over tcp only, everyone
+        else can reconnect with stream= set. Returns False when the request could not be sent"""
+        if self.server_protocol < 2 or self.server_transport != "tcp" or name not in self.streams:
+            print("can not switch to stream {}. streams: {}".format(name, self.streams))
+            return False
+        try:
+            self.connection.send(CLIENT_MESSAGE.pack(MSG_STREAM, self.streams.index(name)))
+        except OSError as e:
+            print("stream switch not sent:", e)
+            return False
+        # a reconnect asks for the new stream straight away
+        self.stream_name = name
+        return True
+
+    def change_stream(self, params):
+        """The server moved us to another stream. Playback starts over with its parameters and the sink is
+        reopened when the sample rate or channel count changed"""
+        sink = (self.RATE, self.CHANNELS)
+        self.parse_server_parameters(params)
+        self.audio_buffer.clear()
+        print("switched to stream {}, samplerate: {}, chunksize: {}, compression: {}".format(
+            self.stream_name, self.RATE, self.CHUNK, self.use_compression))
+        if self.relay is not None:
+            self.start_relay()
+        if not self.headless and (self.RATE, self.CHANNELS) != sink:
+            self.create_audio_stream()
+
+    def open_datagram_socket(self):
+        if self.datagram is not None:
+            self.datagram.close()
+        self.datagram = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # room for the backlog the server sends in one go when we join
+        self.datagram.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.datagram.bind(("", 0))
+        self.datagram.settimeout(self.CHUNK / self.RATE)
+        self.reorder = ReorderBuffer(self.parity_group)
+        self.registered = False
+        self.last_datagram = monotonic()
+        self.register_datagrams()
+        if self.server_transport == "multicast":
+            self.join_multicast_group()
+
+    def join_multicast_group(self):
+        if self.multicast is not None:
+            self.multicast.close()
+        self.multicast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # every listener on this machine binds the group port
+        self.multicast.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.multicast.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.multicast.bind(("", self.multicast_port))
+        self.multicast.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                  socket.inet_aton(self.multicast_group) + socket.inet_aton(self.multicast_interface))
+        print("joined multicast group {}:{}".format(self.multicast_group, self.multicast_port))
+
+    def register_datagrams(self):
+        """Tells the server where to send our datagrams, or with multicast where to send repairs.
+        Repeated until the server confirms it"""
+        self.datagram.sendto(CLIENT_MESSAGE.pack(MSG_REGISTER, self.session_id), (self.server_address, self.udp_port))
+        self.last_register = monotonic()
+
+    def get_next_datagram(self):
+        """Datagram transport. Returns the next chunk in sequence order, LOST for one that is not coming,
+        or None once the server stopped sending for 3 seconds or hung up"""
+        while True:
+            chunk = self.reorder.pop()
+            if chunk is LOST:
+                return LOST
+            if chunk is not None:
+                self.last_sequence, codec, data = chunk
+                if codec != self.use_compression:
+                    self.switch_codec(codec)
+                if codec == 0 and data == bytes(2):
+                    return self.silence
+                return data
+            packet = self.receive_datagram()
+            now = monotonic()
+            if packet is None:
+                if not self.registered and now - self.last_register > 0.5:
+                    self.register_datagrams()
+                if now - self.last_datagram > 3 or self.server_hung_up():
+                    print("server stopped sending datagrams")
+                    self.close_datagram_sockets()
+                    self.connection.close()
+                    self.is_connected = False
+                    return None
+                continue
+            if len(packet) == CLIENT_MESSAGE.size:
+                # the server confirming our registration
+                self.registered = CLIENT_MESSAGE.unpack(packet) == (MSG_REGISTER, self.session_id) or self.registered
+                continue
+            if not self.registered and now - self.last_register > 0.5:
+                self.register_datagrams()
+            datagram = unpack_datagram(packet)
+            if datagram is None or datagram[0] not in (self.session_id, self.stream_id):
+                continue
+            self.last_datagram = now
+            self.bytes_received += len(packet)
+            self.reorder.push(datagram[1], datagram[3], datagram[4], datagram[7], datagram[5], datagram[6])
+            if self.server_transport == "multicast":
+                for sequence in self.reorder.gaps():
+                    self.datagram.sendto(REPAIR_MESSAGE.pack(MSG_REPAIR, self.session_id, sequence),
+                                         (self.server_address, self.udp_port))
+
+    def receive_datagram(self):
+        """Next packet from the unicast socket or the multicast group, None after a chunk period of nothing"""
+        sockets = [sock for sock in (self.datagram, self.multicast) if sock is not None]
+        try:
+            readable, _, _ = select.select(sockets, [], [], self.CHUNK / self.RATE)
+            return readable[0].recv(65536) if len(readable) > 0 else None
+        except (socket.timeout, ConnectionError):
+            return None
+
+    def close_datagram_sockets(self):
+        for sock in (self.datagram, self.multicast):
+            if sock is not None:
+                sock.close()
+        self.datagram = None
+        self.multicast = None
+
+    def server_hung_up(self):
+        """The tcp connection stays quiet with the datagram transport, anything readable means it was closed"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return len(readable) > 0 and len(self.connection.recv(1)) == 0
+        except (OSError, ValueError):
+            return True
+
+    def switch_codec(self, codec):
+        """Protocol version 2 frames name their codec, so a server with a codec ladder can move us to a cheaper
+        or better compression mode at any frame. Decoder state starts over, like it does on a new connection"""
+        print("server switched compression from {} to {}".format(self.use_compression, codec))
+        self.use_compression = codec
+        self.last_sample = 0
+        self.interpolator = Interpolator(self.decimation_factor, self.CHUNK, self.CHANNELS) if codec == 3 else None
+
+    def decompress_data(self, data, out):
+        """Called when using compression. passes compressed data to the proper decompress function, which decodes
+        it into out, the int16 samples of a jitter buffer slot. Returns the number of samples written
         I could probably use a higher order function to achieve the same result."""
-        if data is None:
-            return data
+        if self.use_compression == 0:
+            samples = len(data) // 2
+            out[:samples] = np.frombuffer(data, dtype=np.int16, count=samples)
+            return samples
+        elif self.use_compression == 3:
+            return self.decompress_upsample(data, out)
         elif data == bytes(2):
-            return bytes(self.CHUNK * 2)
+            out[:] = 0
+            return len(out)
         elif self.use_compression == 1:
-            return self.decompress_interpolate(data)
+            return self.decompress_interpolate(data, out)
         elif self.use_compression == 2:
-            return self.decompress_data_fill(data)
-
-    def decompress_interpolate(self, data):
-        """self explanatory. Interpolates between all values sent from server.
-        self.last_sample is always the first element and is set by the last element of previous data"""
-        x = [i for i in range(self.CHUNK)]
-        xp = np.array(range(-1, len(data), 2))
-        fp = np.zeros((len(xp),))
-        fp[0] = self.last_sample
-        fp[1:] = np.frombuffer(data, dtype=np.int16)
-        new_data = np.interp(x, xp, fp).astype(np.int16)
-        self.last_sample = new_data[-1]
-        new_data = new_data.tobytes()
-        return new_data
-
-    def decompress_data_fill(self, data):
-        """magnum opus. Kind of hard to explain how this works in a doc string. just call it magic"""
+            return self.decompress_data_fill(data, out)
+        elif self.use_compression == 4:
+            return len(self.lossless_decoder.process(data, out))
+        elif self.use_compression == 5:
+            return len(self.adpcm_decoder.process(data, out))
+
+    def allocate_decode_buffers(self):
+        """Scratch space for the decompressors, made once per stream so decoding a chunk allocates next to
+        nothing. Rebuilt when CHUNK or CHANNELS change"""
+        self.sample_index = np.arange(self.CHUNK, dtype=np.float64)     # x values for np.interp
+        # compression mode 1, in int32 so sums of two samples fit
+        self.received_frames = np.empty((self.CHUNK // 2, self.CHANNELS), dtype=np.int32)
+        self.midpoints = np.empty((self.CHUNK // 2, self.CHANNELS), dtype=np.int32)
+        self.midpoint_signs = np.empty((self.CHUNK // 2, self.CHANNELS), dtype=np.int32)
+        self.fill_points = np.empty((2, self.CHUNK))                    # compression mode 2 xp and fp
+        self.lossless_decoder = LosslessDecoder(self.CHANNELS)
+        self.adpcm_decoder = AdpcmDecoder(self.CHUNK, self.CHANNELS)
+
+    def decompress_interpolate(self, data, out):
+        """self explanatory. Interpolates between all values sent from server, every channel on its own.
+        self.last_sample is always the first frame and is set by the last frame of previous data"""
+        received = np.frombuffer(data, dtype=np.int16).reshape(-1, self.CHANNELS)
+        x = self.sample_index
+        frames = out[:len(x) * self.CHANNELS].reshape(-1, self.CHANNELS)
+        if len(received) * 2 == self.CHUNK:
+            # a full chunk is every odd frame. the even ones are halfway between their neighbours, rounded toward
+            # zero like np.interp's result is when it is stored, worked out in place in integers
+            midpoints = self.midpoints
+            np.copyto(self.received_frames, received)
+            np.add(self.last_sample, self.received_frames[0], out=midpoints[0])
+            np.add(self.received_frames[:-1], self.received_frames[1:], out=midpoints[1:])
+            np.right_shift(midpoints, 31, out=self.midpoint_signs)
+            np.subtract(midpoints, self.midpoint_signs, out=midpoints)
+            np.right_shift(midpoints, 1, out=midpoints)
+            np.copyto(frames[0::2], midpoints, casting="unsafe")
+            frames[1::2] = received
+        else:
+            xp = np.arange(-1, len(received) * 2, 2)
+            fp = np.zeros((len(xp), self.CHANNELS))
+            fp[0] = self.last_sample
+            fp[1:] = received
+            for channel in range(self.CHANNELS):
+                frames[:, channel] = np.interp(x, xp, fp[:, channel])
+        self.last_sample = frames[-1].copy()
+        return len(x) * self.CHANNELS
+
+    def decompress_upsample(self, data, out):
+        """Compression mode 3. Silent chunks are fed through as zeros so the filter history stays continuous"""
+        first = None
+        if data == bytes(2):
+            data = memoryview(self.silence)[:self.interpolator.next_frames() * self.CHANNELS * 2]
+        elif self.CHUNK % self.decimation_factor:
+            # led by the frame the server kept first, see DECIMATED_FIRST
+            first = DECIMATED_FIRST.unpack_from(data)[0]
+            data = memoryview(data)[DECIMATED_FIRST.size:]
+        samples = self.CHUNK * self.CHANNELS
+        self.interpolator.process(np.frombuffer(data, dtype=np.int16), out[:samples], first)
+        return samples
+
+    def decompress_data_fill(self, data, out):
+        """magnum opus. Kind of hard to explain how this works in a doc string. just call it magic.
+        Every channel comes as its own count, coordinates and values, one after the other"""
         data = np.frombuffer(data, dtype=np.int16)
-        x = [i for i in range(self.CHUNK)]
-        xp = data[1:data[0]+1]
-        fp = data[data[0]+1:]
-        try:
-            new_data = np.interp(x, xp, fp).astype(np.int16)
-        except ValueError as e:
-            print(e)
-            print("length x {} xp {} fp {}".format(len(x), len(xp), len(fp)))
-            return bytes(self.CHUNK * 2)
-        new_data = new_data.tobytes()
-        return new_data
+        x = self.sample_index
+        frames = out[:len(x) * self.CHANNELS].reshape(-1, self.CHANNELS)
+        start = 0
+        for channel in range(self.CHANNELS):
+            count = int(data[start]) if start < len(data) else 0
+            sent_xp = data[start + 1:start + 1 + count]
+            sent_fp = data[start + 1 + count:start + 1 + 2 * count]
+            start += 1 + 2 * count
+            # as floats in buffers of their own, so np.interp has nothing to convert
+            xp = self.fill_points[0, :count]
+            fp = self.fill_points[1, :count]
+            try:
+                np.copyto(xp, sent_xp)
+                np.copyto(fp, sent_fp)
+                frames[:, channel] = np.interp(x, xp, fp)
+            except ValueError as e:
+                print(e)
+                print("length x {} xp {} fp {}".format(len(x), len(sent_xp), len(sent_fp)))
+                frames[:, channel] = 0
+        return len(x) * self.CHANNELS
 
     def write_audio_to_stream(self, data):
         if data is None:
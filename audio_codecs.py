@@ -0,0 +1,568 @@
+import struct
+import numpy as np
+
+
+def lowpass_taps(factor, taps_per_phase=16):
+    """Hamming windowed sinc low pass with its cutoff just under the nyquist frequency of the decimated rate.
+    The tap count is a multiple of factor so the filter splits evenly into factor polyphase branches"""
+    num_taps = factor * taps_per_phase
+    n = np.arange(num_taps) - (num_taps - 1) / 2
+    cutoff = 0.9 / factor
+    taps = cutoff * np.sinc(cutoff * n) * np.hamming(num_taps)
+    return taps / np.sum(taps)
+
+
+def to_int16(samples, out=None):
+    """Rounds and clips to int16, into out (same shape as samples) when given"""
+    if out is None:
+        return np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+    np.copyto(out, np.clip(np.rint(samples), -32768, 32767), casting="unsafe")
+    return out
+
+
+# when the decimation factor does not divide the chunk size a mode 3 chunk starts with the frame of it that was
+# kept first, so a client that joins or switches to mode 3 mid stream knows where the chunk sits between kept frames
+DECIMATED_FIRST = struct.Struct("<H")
+
+
+class Decimator:
+    """Anti-alias filters and keeps every factor-th frame of the stream. Only the kept outputs are computed, which
+    is the same work as a polyphase decimator. The filter history and the frame to keep first are carried across
+    chunks so chunk edges are seamless and any chunk size works: when factor does not divide it the chunks carry
+    one kept frame more or less, whatever the stream has in them.
+    The gather tables of input positions for every output are built once for the stream, one per offset"""
+    def __init__(self, factor, chunk, channels=1):
+        self.factor = factor
+        self.chunk = chunk
+        self.channels = channels
+        self.taps = lowpass_taps(factor)[::-1].copy()
+        self.history = np.zeros((len(self.taps) - 1, channels))
+        self.indexes = [np.arange(first, chunk, factor)[:, None] + np.arange(len(self.taps))[None, :]
+                        for first in range(factor)]
+        self.first = 0                 # frame of the next chunk that is kept first
+
+    def reset(self):
+        self.history[:] = 0
+        self.first = 0
+
+    def process(self, samples):
+        """int16 interleaved samples in, int16 interleaved samples at 1 / factor of the rate out"""
+        frames = samples.reshape(-1, self.channels)
+        if len(frames) < self.chunk:
+            # end of a file. pad so the gather table still fits
+            frames = np.concatenate((frames, np.zeros((self.chunk - len(frames), self.channels), np.int16)))
+        x = np.concatenate((self.history, frames))
+        self.history = x[-(len(self.taps) - 1):]
+        index = self.indexes[self.first]
+        self.first = (self.first - self.chunk) % self.factor
+        return to_int16(np.tensordot(x[index], self.taps, axes=([1], [0]))).reshape(-1)
+
+
+class Interpolator:
+    """Client side of Decimator. Upsamples by factor with the same low pass split into factor polyphase branches,
+    so every output frame costs taps_per_phase multiplies and no zero stuffing is needed. Follows which frame of
+    every chunk the decimator kept first, so every chunk comes out exactly chunk frames long even when factor does
+    not divide it: a chunk that starts between two kept frames starts from the last input of the chunk before.
+    Inputs, windows and outputs live in buffers made once for the stream, channel major so every channel is one
+    gather and one matrix product into them"""
+    def __init__(self, factor, chunk, channels=1):
+        self.factor = factor
+        self.chunk = chunk
+        self.channels = channels
+        taps = lowpass_taps(factor) * factor
+        self.taps_per_phase = len(taps) // factor
+        # branches[j, p] multiplies the j-th oldest input of the window for output phase p
+        self.branches = taps.reshape(self.taps_per_phase, factor)[::-1].copy()
+        rows = chunk // factor + 2
+        # the history, one input more than the filter needs for a chunk that starts between two kept frames,
+        # followed by the chunk's inputs
+        self.inputs = np.zeros((channels, self.taps_per_phase + rows))
+        self.index = np.arange(rows)[:, None] + np.arange(self.taps_per_phase)[None, :]
+        self.windows = np.empty(channels * rows * self.taps_per_phase)
+        self.phases = np.empty(channels * rows * factor)
+        self.first = 0                 # frame of the next chunk the decimator keeps first, as far as we know
+
+    def reset(self):
+        self.inputs[:] = 0
+        self.first = 0
+
+    def next_frames(self):
+        """Number of frames the decimator keeps of the next chunk"""
+        return len(range(self.first, self.chunk, self.factor))
+
+    def process(self, samples, out=None, first=None):
+        """int16 interleaved samples of a chunk in, chunk frames out. Written into out if given. first is the
+        frame the decimator kept first if the chunk says, otherwise it follows on from the chunk before"""
+        if first is not None:
+            self.first = first
+        frames = samples.reshape(-1, self.channels)
+        history = self.taps_per_phase
+        np.copyto(self.inputs[:, history:history + len(frames)], frames.T)
+        # a chunk that starts between two kept frames also needs the last input before it
+        offset = -self.first % self.factor
+        start = 0 if offset > 0 else 1
+        rows = len(frames) + 1 - start
+        windows = self.windows[:self.channels * rows * history].reshape(self.channels, rows, history)
+        np.take(self.inputs, self.index[start:start + rows], axis=1, out=windows, mode="clip")
+        # (channels, rows, taps) x (taps, phases) -> (channels, rows, phases), output frame row * factor + phase
+        y = self.phases[:self.channels * rows * self.factor].reshape(self.channels, rows, self.factor)
+        np.matmul(windows, self.branches, out=y)
+        self.inputs[:, :history] = self.inputs[:, len(frames):len(frames) + history]
+        self.first = (self.first - self.chunk) % self.factor
+        y = y.reshape(self.channels, -1)[:, offset:offset + self.chunk]
+        np.rint(y, out=y)
+        np.clip(y, -32768, 32767, out=y)
+        out = np.empty(self.chunk * self.channels, dtype=np.int16) if out is None else out
+        np.copyto(out.reshape(self.chunk, self.channels), y.T, casting="unsafe")
+        return out
+
+
+class FractionalResampler:
+    """Resamples by a ratio that may change from one chunk to the next, with 4 point cubic (Catmull-Rom)
+    interpolation. The last 3 frames and the fractional read position are carried across chunks, so chunk edges
+    are seamless and a ratio of exactly 1 hands the input back unchanged, 2 frames late.
+    ratio is input frames consumed per output frame: above 1 plays faster and shortens the chunk"""
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.history = np.zeros((3, channels))
+        self.position = 1.0            # of the next output frame, counted from the first frame of history
+
+    def reset(self):
+        self.history[:] = 0
+        self.position = 1.0
+
+    def prime(self, samples):
+        """Starts on the first frame of samples, the input to come, instead of on silence. The history is that
+        input's first step carried backwards, so the first output is its first frame and there is no ramp"""
+        frames = samples.reshape(-1, self.channels)[:2].astype(np.float64)
+        step = frames[-1] - frames[0]
+        self.history[:] = frames[0] - step * np.arange(3, 0, -1)[:, None]
+        self.position = 3.0
+
+    def flush(self, ratio=1.0):
+        """The output still owed for the input so far, up to its last frame, with the last step carried on as the
+        neighbours that never come. For when the input ends for good"""
+        step = self.history[-1] - self.history[-2]
+        return self.process(to_int16(self.history[-1] + step * np.arange(1, 3)[:, None]).reshape(-1), ratio)
+
+    def process(self, samples, ratio=1.0):
+        """int16 interleaved samples in, int16 interleaved samples out, about len(samples) / ratio of them"""
+        x = np.concatenate((self.history, samples.reshape(-1, self.channels)))
+        # every output needs x[k - 1] to x[k + 2] around it, so positions up to len(x) - 2 can be done now
+        count = max(0, int(np.ceil((len(x) - 2 - self.position) / ratio)))
+        t = self.position + ratio * np.arange(count)
+        k = np.minimum(t.astype(np.intp), len(x) - 3)
+        f = (t - k)[:, None]
+        p0, p1, p2, p3 = x[k - 1], x[k], x[k + 1], x[k + 2]
+        y = p1 + 0.5 * f * (p2 - p0 + f * (2 * p0 - 5 * p1 + 4 * p2 - p3 + f * (3 * (p1 - p2) + p3 - p0)))
+        self.position += ratio * count - (len(x) - 3)
+        self.history = x[-3:]
+        return to_int16(y).reshape(-1)
+
+
+# lossless mode. fixed polynomial prediction of order 0 - 3 followed by rice coding of the residuals, chosen per
+# chunk and channel like FLAC's fixed subframes. A chunk starts with its frame count (uint32, the top bit set
+# when a stereo chunk is coded as mid and side) and then stores each channel as
+#   order (0x80 = verbatim), rice parameter k, unary section length (uint32), order warm up samples (int16),
+#   unary section, remainder section
+# The quotients of all residuals go in one unary section (q zero bits then a one) and the k bit remainders in
+# another, so both can be packed and unpacked with numpy instead of walking a variable length bit stream
+LOSSLESS_FRAMES = struct.Struct("<I")
+LOSSLESS_HEADER = struct.Struct("<BBI")
+LOSSLESS_VERBATIM = 0x80
+LOSSLESS_MID_SIDE = 0x80000000           # set in the frame count when a stereo chunk is coded as mid and side
+MAX_PREDICTION_ORDER = 3
+
+
+def encode_lossless(samples, channels=1, mid_side=False):
+    """int16 interleaved samples in, bytes out. With mid_side a stereo chunk is coded as mid and side instead of
+    left and right whenever that predicts better, decided chunk by chunk like FLAC does"""
+    frames = samples.reshape(-1, channels)
+    count = len(frames)
+    if mid_side and channels == 2:
+        coded = to_mid_side(frames)
+        if sum(prediction_cost(coded[:, channel]) for channel in range(2)) < \
+                sum(prediction_cost(frames[:, channel]) for channel in range(2)):
+            frames = coded
+            count |= LOSSLESS_MID_SIDE
+    frames = frames.astype(np.int64)
+    return LOSSLESS_FRAMES.pack(count) + \
+        b"".join(encode_lossless_channel(frames[:, channel]) for channel in range(channels))
+
+
+def to_mid_side(frames):
+    """(frames, 2) int16 left and right to mid and side. side = L - R and mid = R + (side >> 1), both wrapping
+    around in int16 like FLAC's lifting steps, so it is undone exactly even where L - R does not fit"""
+    coded = np.empty(frames.shape, dtype=np.int16)
+    np.subtract(frames[:, 0], frames[:, 1], out=coded[:, 1])
+    np.add(frames[:, 1], coded[:, 1] >> 1, out=coded[:, 0])
+    return coded
+
+
+def to_left_right(frames):
+    """Undoes to_mid_side in place"""
+    right = frames[:, 0] - (frames[:, 1] >> 1)
+    frames[:, 0] = frames[:, 1] + right
+    frames[:, 1] = right
+
+
+def prediction_residuals(x):
+    """Residuals of every fixed predictor, order 0 first"""
+    return [x] + [np.diff(x, n=order) for order in range(1, min(MAX_PREDICTION_ORDER, len(x) - 1) + 1)]
+
+
+def prediction_cost(x):
+    """Sum of the absolute residuals of the best predictor, a good stand-in for the coded size"""
+    return min(int(np.sum(np.abs(r))) for r in prediction_residuals(x.astype(np.int64)))
+
+
+def encode_lossless_channel(x):
+    verbatim = LOSSLESS_HEADER.pack(LOSSLESS_VERBATIM, 0, 0) + x.astype(np.int16).tobytes()
+    residuals = prediction_residuals(x)
+    order = int(np.argmin([np.sum(np.abs(r)) for r in residuals]))
+    residual = residuals[order]
+    if len(residual) == 0:
+        return verbatim
+    # zig zag so small negative residuals become small unsigned numbers
+    unsigned = np.where(residual >= 0, residual * 2, -residual * 2 - 1)
+    # the best k is close to log2 of the mean. try its neighbours and keep the smallest
+    estimate = int(np.log2(np.mean(unsigned) + 1))
+    candidates = np.arange(max(0, estimate - 1), min(estimate + 2, 31))
+    total_bits = [np.sum(unsigned >> k) + len(unsigned) * (k + 1) for k in candidates]
+    k = int(candidates[int(np.argmin(total_bits))])
+    if min(total_bits) // 8 + LOSSLESS_HEADER.size + order * 2 >= len(verbatim):
+        return verbatim
+    quotient = unsigned >> k
+    unary = np.zeros(int(np.sum(quotient)) + len(quotient), dtype=np.uint8)
+    unary[np.cumsum(quotient + 1) - 1] = 1
+    unary = np.packbits(unary).tobytes()
+    if k > 0:
+        shifts = np.arange(k - 1, -1, -1)
+        remainder = np.packbits(((unsigned[:, None] >> shifts) & 1).astype(np.uint8).reshape(-1)).tobytes()
+    else:
+        remainder = bytes()
+    return LOSSLESS_HEADER.pack(order, k, len(unary)) + x[:order].astype(np.int16).tobytes() + unary + remainder
+
+
+class LosslessDecoder:
+    """Decodes encode_lossless chunks into int16 interleaved samples. The quotients and remainders still come out
+    of np.unpackbits and np.flatnonzero, which make their own arrays, everything after them is worked out in
+    buffers made once here and reused, grown when a chunk holds more frames than any before"""
+    def __init__(self, channels=1):
+        self.channels = channels
+        self.unsigned = np.empty(0, dtype=np.int64)
+        self.signs = np.empty(0, dtype=np.int64)
+        self.residuals = np.empty(0, dtype=np.int64)
+
+    def process(self, data, out=None):
+        """bytes from encode_lossless in, int16 interleaved samples out. Decodes into the start of out if given"""
+        data = memoryview(data)
+        frame_count = LOSSLESS_FRAMES.unpack_from(data, 0)[0]
+        mid_side = frame_count & LOSSLESS_MID_SIDE
+        frame_count &= ~LOSSLESS_MID_SIDE
+        if out is None:
+            out = np.empty((frame_count, self.channels), dtype=np.int16)
+        else:
+            out = out[:frame_count * self.channels].reshape(frame_count, self.channels)
+        if len(self.residuals) < frame_count:
+            self.unsigned = np.empty(frame_count, dtype=np.int64)
+            self.signs = np.empty(frame_count, dtype=np.int64)
+            self.residuals = np.empty(frame_count, dtype=np.int64)
+        offset = LOSSLESS_FRAMES.size
+        for channel in range(self.channels):
+            order, k, unary_length = LOSSLESS_HEADER.unpack_from(data, offset)
+            offset += LOSSLESS_HEADER.size
+            if order == LOSSLESS_VERBATIM:
+                out[:, channel] = np.frombuffer(data, dtype=np.int16, count=frame_count, offset=offset)
+                offset += frame_count * 2
+                continue
+            count = frame_count - order
+            warm_up = np.frombuffer(data, dtype=np.int16, count=order, offset=offset).astype(np.int64)
+            offset += order * 2
+            unary = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=unary_length, offset=offset))
+            offset += unary_length
+            stops = np.flatnonzero(unary)[:count]
+            # the quotient is the number of zero bits before every one bit
+            unsigned = self.unsigned[:count]
+            signs = self.signs[:count]
+            if count > 0:
+                unsigned[0] = stops[0]
+                np.subtract(stops[1:], stops[:-1], out=unsigned[1:])
+                np.subtract(unsigned[1:], 1, out=unsigned[1:])
+            remainder_length = (count * k + 7) // 8
+            if k > 0:
+                bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=remainder_length, offset=offset))
+                np.left_shift(unsigned, k, out=unsigned)
+                for bit in range(k):
+                    # the remainders are k bits each, most significant first
+                    np.copyto(signs, bits[bit:count * k:k])
+                    np.left_shift(signs, k - 1 - bit, out=signs)
+                    np.bitwise_or(unsigned, signs, out=unsigned)
+            offset += remainder_length
+            # zigzag back to signed, into the end of residuals, so every difference level below can grow by one
+            # sample in front of it
+            residual = self.residuals[order:frame_count]
+            np.bitwise_and(unsigned, 1, out=signs)
+            np.negative(signs, out=signs)
+            np.right_shift(unsigned, 1, out=residual)
+            np.bitwise_xor(residual, signs, out=residual)
+            # undo the differences one level at a time, each level starts from the warm up samples' difference
+            for level in range(order - 1, -1, -1):
+                start = np.diff(warm_up, n=level)[0]
+                residual = self.residuals[level:frame_count]
+                np.cumsum(residual[1:], out=residual[1:])
+                residual[1:] += start
+                residual[0] = start
+            out[:, channel] = self.residuals[:frame_count]
+        if mid_side:
+            to_left_right(out)
+        return out.reshape(-1)
+
+
+def decode_lossless(data, channels=1, out=None):
+    """bytes from encode_lossless in, int16 interleaved samples out. Decodes into the start of out if given"""
+    return LosslessDecoder(channels).process(data, out)
+
+
+# IMA ADPCM. 4 bits per sample, so a chunk is always channels * (4 + frames / 2) bytes.
+# Every channel starts with the predictor and step index the encoder had before the chunk, followed by the
+# 4 bit codes packed two per byte, low nibble first. The encoder state runs on across chunks, and because every
+# chunk carries it a client can start decoding at any chunk, including right after a reconnect
+ADPCM_HEADER = struct.Struct("<hBx")
+ADPCM_INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8]
+ADPCM_STEP_TABLE = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88, 97,
+    107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796,
+    876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660, 4026, 4428, 4871,
+    5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385,
+    24623, 27086, 29794, 32767
+]
+# difference added to the predictor and the next step index for every (step index, code) pair
+ADPCM_DIFFERENCE = np.array([[((step >> 3) + (step if code & 4 else 0) + (step >> 1 if code & 2 else 0) +
+                               (step >> 2 if code & 1 else 0)) * (-1 if code & 8 else 1) for code in range(16)]
+                             for step in ADPCM_STEP_TABLE], dtype=np.int64)
+ADPCM_NEXT_INDEX = np.array([[min(max(index + ADPCM_INDEX_TABLE[code & 7], 0), 88) for code in range(16)]
+                             for index in range(89)], dtype=np.int64)
+ADPCM_INDEX_MOVE = np.array(ADPCM_INDEX_TABLE * 2, dtype=np.int64)   # step index change for every code
+
+
+def adpcm_chunk_bytes(frames, channels=1):
+    return channels * (ADPCM_HEADER.size + (frames + 1) // 2)
+
+
+class AdpcmEncoder:
+    """Stateful IMA ADPCM encoder. The predictor feeds back on itself sample by sample, so this is a table driven
+    loop over frames that handles all channels of a frame at once"""
+    def __init__(self, chunk, channels=1):
+        self.chunk = chunk
+        self.channels = channels
+        self.predictor = [0] * channels
+        self.index = [0] * channels
+        self.difference = ADPCM_DIFFERENCE.tolist()
+        self.next_index = ADPCM_NEXT_INDEX.tolist()
+
+    def reset(self):
+        self.predictor = [0] * self.channels
+        self.index = [0] * self.channels
+
+    def process(self, samples):
+        frames = samples.reshape(-1, self.channels)
+        if len(frames) < self.chunk:
+            frames = np.concatenate((frames, np.zeros((self.chunk - len(frames), self.channels), np.int16)))
+        headers = [ADPCM_HEADER.pack(self.predictor[channel], self.index[channel]) for channel in range(self.channels)]
+        codes = np.empty((self.chunk + self.chunk % 2, self.channels), dtype=np.uint8)
+        codes[-1] = 0
+        steps = ADPCM_STEP_TABLE
+        difference = self.difference
+        next_index = self.next_index
+        for channel in range(self.channels):
+            predictor = self.predictor[channel]
+            index = self.index[channel]
+            channel_codes = []
+            for sample in frames[:, channel].tolist():
+                diff = sample - predictor
+                step = steps[index]
+                code = 0
+                if diff < 0:
+                    code = 8
+                    diff = -diff
+                if diff >= step:
+                    code |= 4
+                    diff -= step
+                if diff >= step >> 1:
+                    code |= 2
+                    diff -= step >> 1
+                if diff >= step >> 2:
+                    code |= 1
+                predictor += difference[index][code]
+                predictor = 32767 if predictor > 32767 else -32768 if predictor < -32768 else predictor
+                index = next_index[index][code]
+                channel_codes.append(code)
+            codes[:self.chunk, channel] = channel_codes
+            self.predictor[channel] = predictor
+            self.index[channel] = index
+        packed = (codes[0::2] | (codes[1::2] << 4)).T
+        return b"".join(headers[channel] + packed[channel].tobytes() for channel in range(self.channels))
+
+
+class AdpcmDecoder:
+    """Decodes AdpcmEncoder chunks into int16 interleaved samples. The step index only depends on the codes, so it
+    is walked first and the predictor is then a cumulative sum. The walk is a running sum of the index moves that
+    stops at 0, which has a closed form with a running minimum. Only when it would go past 88 (full scale noise)
+    or the predictor clips, both rare, do they get walked sample by sample.
+    Every intermediate array is made once here and reused, a client decodes a whole stream with one of these"""
+    def __init__(self, frames, channels=1):
+        self.frames = frames
+        self.channels = channels
+        self.codes = np.empty(frames + frames % 2, dtype=np.intp)
+        self.moves = np.empty(frames, dtype=np.int64)
+        self.low = np.empty(frames, dtype=np.int64)
+        self.walked = np.empty(frames, dtype=np.int64)
+        self.indexes = np.empty(frames, dtype=np.intp)
+        self.steps = np.empty(frames, dtype=np.int64)
+        self.differences = ADPCM_DIFFERENCE.reshape(-1)
+        self.next_index = ADPCM_NEXT_INDEX.tolist()
+
+    def process(self, data, out=None):
+        """bytes from AdpcmEncoder in, int16 interleaved samples out (into out if given)"""
+        frames = self.frames
+        out = np.empty((frames, self.channels), dtype=np.int16) if out is None else out.reshape(frames, self.channels)
+        channel_bytes = ADPCM_HEADER.size + (frames + 1) // 2
+        codes = self.codes[:frames]
+        moves, low, walked, indexes, steps = self.moves, self.low, self.walked, self.indexes, self.steps
+        for channel in range(self.channels):
+            offset = channel * channel_bytes
+            predictor, index = ADPCM_HEADER.unpack_from(data, offset)
+            packed = np.frombuffer(data, dtype=np.uint8, count=channel_bytes - ADPCM_HEADER.size,
+                                   offset=offset + ADPCM_HEADER.size)
+            np.bitwise_and(packed, 15, out=self.codes[0::2])
+            np.right_shift(packed, 4, out=self.codes[1::2])
+            # the index before every code: index + the moves so far, held up by 0 wherever the running sum dipped
+            np.take(ADPCM_INDEX_MOVE, codes, out=moves, mode="clip")
+            np.cumsum(moves, out=moves)
+            np.minimum.accumulate(moves, out=low)
+            np.minimum(low, 0, out=low)
+            np.subtract(moves, low, out=low)
+            np.add(moves, index, out=walked)
+            np.maximum(walked, low, out=walked)
+            if frames > 0 and walked.max() > 88:
+                next_index = self.next_index
+                for position, code in enumerate(codes.tolist()):
+                    indexes[position] = index
+                    index = next_index[index][code]
+            elif frames > 0:
+                indexes[0] = index
+                indexes[1:] = walked[:-1]
+            # steps = ADPCM_DIFFERENCE[indexes, codes], through the flat table
+            np.multiply(indexes, 16, out=indexes)
+            np.add(indexes, codes, out=indexes)
+            np.take(self.differences, indexes, out=steps, mode="clip")
+            samples = np.cumsum(steps, out=walked)
+            samples += predictor
+            if frames > 0 and (samples.min() < -32768 or samples.max() > 32767):
+                step_list = steps.tolist()
+                for position in range(frames):
+                    predictor = min(max(predictor + step_list[position], -32768), 32767)
+                    samples[position] = predictor
+            out[:, channel] = samples
+        return out.reshape(-1)
+
+
+def decode_adpcm(data, frames, channels=1, out=None):
+    """bytes from AdpcmEncoder in, int16 interleaved samples out (into out if given). See AdpcmDecoder"""
+    return AdpcmDecoder(frames, channels).process(data, out)
+
+
+def chunk_levels(data):
+    """peak and rms of a pcm chunk"""
+    samples = np.frombuffer(data, dtype=np.int16)
+    if len(samples) == 0:
+        return 0, 0.0
+    peak = int(np.max(np.abs(samples.astype(np.int32))))
+    rms = float(np.sqrt(np.dot(samples, samples.astype(np.float64)) / len(samples)))
+    return peak, rms
+
+
+def data_fill_channel(data):
+    """Keeps only the turning points and plateau edges of the waveform. Vectorized version of the original
+    sample by sample walk, it produces exactly the same bytes. The walk's state is rebuilt from np.diff:
+    - direction before a sample is the sign of the last non zero difference, except right after a plateau
+      that ended with a direction update
+    - a plateau's start is only kept when the walk was not still 'matching' from a previous 2 sample plateau,
+      which is the case after an odd number of consecutive 2 sample plateaus"""
+    last = len(data) - 1
+    diff = np.sign(np.diff(data.astype(np.int32)))      # diff[i] compares sample i + 1 with sample i
+
+    # plateaus. runs of equal samples from run_start to run_end inclusive
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], (diff == 0).view(np.int8), [0]))))
+    run_start = edges[0::2]
+    run_end = edges[1::2]
+    short_run = run_end - run_start == 1
+    run_index = np.arange(len(run_start))
+    last_long_run = np.maximum.accumulate(np.where(short_run, -1, run_index))
+    previous_long_run = np.concatenate(([-1], last_long_run[:-1]))
+    matching = (run_index - previous_long_run - 1) % 2 == 1
+    keep_start = ~matching & (run_start + 1 <= last - 1)
+    keep_end = (matching | ~short_run) & (run_end <= last - 1)
+    updated_direction = np.zeros(len(data), dtype=bool)
+    updated_direction[run_end[keep_end]] = True
+
+    # turning points. a sample whose difference disagrees with the direction the walk was going in
+    nonzero_index = np.maximum.accumulate(np.where(diff != 0, np.arange(len(diff)), -1))
+    initial_direction = -1 if diff[0] == -1 else 1
+    direction = np.where(nonzero_index >= 0, diff[np.maximum(nonzero_index, 0)], initial_direction)
+    direction = np.concatenate(([initial_direction], direction[:-1]))
+    turning = (diff != 0) & (diff != direction) & ~updated_direction[:-1]
+    turning[last - 1:] = False
+    turning_cords = np.flatnonzero(turning)
+
+    # every kept point is ordered by the sample the original walk found it at
+    cursors = np.concatenate(([0], turning_cords + 1, run_start[keep_start] + 1, run_end[keep_end], [last]))
+    data_cords = np.concatenate(([0], turning_cords, run_start[keep_start], run_end[keep_end], [last]))
+    order = np.argsort(cursors, kind="stable")
+    data_cords = data_cords[order]
+    new_data = np.concatenate(([len(data_cords)], data_cords, data[data_cords]))
+    return new_data.astype(np.int16).tobytes()
+
+
+class ChunkEncoder:
+    """Every compression mode of a stream in one object, used by the server's buffer thread and by the encoding
+    workers alike. Holds the state of the stateful encoders (3 and 5), so one instance has to see every chunk of
+    those modes in order. Only plain values and numpy arrays inside, it pickles"""
+    def __init__(self, chunk, channels, modes, silence_threshold=16, decimation_factor=2, mid_side=False):
+        self.chunk = chunk
+        self.channels = channels
+        self.silence_threshold = silence_threshold
+        self.mid_side = mid_side
+        self.decimator = Decimator(decimation_factor, chunk, channels) if 3 in modes else None
+        self.adpcm_encoder = AdpcmEncoder(chunk, channels) if 5 in modes else None
+
+    def is_silent(self, peak, rms, length, mode):
+        """Lossless mode only calls pure digital silence silent, anything else must reach the client untouched"""
+        if length == 0:
+            return True
+        return peak == 0 if mode == 4 else rms < self.silence_threshold
+
+    def encode(self, data, silent, mode):
+        """pcm bytes in, the chunk as mode sends it out. None for mode 0, which sends the pcm as it is"""
+        samples = np.frombuffer(data, dtype=np.int16)
+        if mode == 3:
+            first = DECIMATED_FIRST.pack(self.decimator.first) if self.chunk % self.decimator.factor else b""
+            encoded = first + self.decimator.process(samples).tobytes()
+        elif mode == 5:
+            encoded = self.adpcm_encoder.process(samples)
+        elif silent:
+            return bytes(2)
+        elif mode == 1:
+            # keeps every other frame
+            frames = samples.reshape(-1, self.channels)
+            return frames[0:len(frames) // 2 * 2:2].tobytes()
+        elif mode == 2:
+            # every channel on its own, one after the other
+            frames = samples.reshape(-1, self.channels)
+            return b"".join(data_fill_channel(frames[:, channel]) for channel in range(self.channels))
+        elif mode == 4:
+            return encode_lossless(samples, self.channels, self.mid_side)
+        else:
+            return None
+        return bytes(2) if silent else encoded
@@ -0,0 +1,224 @@
+import random
+import struct
+import numpy as np
+
+# Datagram transport. Parameters and the session id are negotiated over the usual tcp connection, which then
+# only stays open to tell both sides the other one is still there. Chunks go out as one datagram each, or as
+# several fragments when they do not fit one ethernet frame: ip fragmentation would drop the whole chunk all the
+# same when a fragment is lost, and refuses datagrams over 64 KiB outright
+# session id, sequence number, timestamp (server ms when the chunk was published), codec id, flags,
+# fragment index, fragment count, payload length of this fragment
+DATAGRAM_HEADER = struct.Struct("<IIIBBHHH")
+DATAGRAM_MTU = 1472            # a 1500 byte ethernet frame less the ip and udp headers
+FRAGMENT_BYTES = DATAGRAM_MTU - DATAGRAM_HEADER.size
+FLAG_PARITY = 1
+# parity datagrams start with the xor of the lengths and codecs of the chunks they cover and a bitmap of which
+# ones they cover: bit i is the sequence number in the header plus i. a chunk the server skipped for a lagging
+# client is not in its group's parity
+PARITY_HEADER = struct.Struct("<HBQ")
+MAX_PARITY_GROUP = 64
+# handed out by ReorderBuffer.pop in place of a chunk it gave up on
+LOST = object()
+
+
+def pack_datagrams(session_id, sequence, timestamp, codec, payload, flags=0):
+    """The datagrams that carry payload, as many fragments of up to FRAGMENT_BYTES as it takes"""
+    view = memoryview(payload)
+    count = max(1, -(-len(view) // FRAGMENT_BYTES))
+    fragments = [view[index * FRAGMENT_BYTES:(index + 1) * FRAGMENT_BYTES] for index in range(count)]
+    return [DATAGRAM_HEADER.pack(session_id, sequence & 0xFFFFFFFF, timestamp & 0xFFFFFFFF, codec, flags, index, count,
+                                 len(fragment)) + fragment for index, fragment in enumerate(fragments)]
+
+
+def unpack_datagram(packet):
+    """Returns (session id, sequence, timestamp, codec, flags, fragment index, fragment count, payload) or None if
+    the packet is not one of ours"""
+    if len(packet) < DATAGRAM_HEADER.size:
+        return None
+    session_id, sequence, timestamp, codec, flags, fragment, fragments, length = DATAGRAM_HEADER.unpack_from(packet)
+    payload = packet[DATAGRAM_HEADER.size:]
+    if len(payload) != length or fragment >= fragments:
+        return None
+    return session_id, sequence, timestamp, codec, flags, fragment, fragments, payload
+
+
+def xor_into(target, payload):
+    """xors payload into the start of target (a uint8 array at least as long)"""
+    target[:len(payload)] ^= np.frombuffer(payload, dtype=np.uint8)
+
+
+class ParityEncoder:
+    """XOR forward error correction. Every group of chunks (sequence numbers group * n to group * n + n - 1) is
+    followed by one parity datagram, so the client can rebuild any single chunk lost from the group.
+    Only the chunks actually sent are covered, a group can have gaps. Costs 1 / group more bandwidth"""
+    def __init__(self, group):
+        if group > MAX_PARITY_GROUP:
+            raise ValueError("a parity group covers at most {} chunks".format(MAX_PARITY_GROUP))
+        self.group = group
+        self.first = None              # first sequence number covered by the pending parity
+        self.covered = 0               # bitmap of the sequence numbers covered, from first
+        self.length = 0
+        self.codec = 0
+        self.parity = np.zeros(0, dtype=np.uint8)
+
+    def add(self, sequence, codec, payload):
+        """Returns (first sequence covered, parity payload) once sequence closes its group, otherwise None"""
+        if self.first is None or sequence // self.group != self.first // self.group:
+            self.first = sequence
+            self.covered = 0
+            self.length = 0
+            self.codec = 0
+            self.parity = np.zeros(0, dtype=np.uint8)
+        if len(payload) > len(self.parity):
+            self.parity = np.concatenate((self.parity, np.zeros(len(payload) - len(self.parity), dtype=np.uint8)))
+        xor_into(self.parity, payload)
+        self.length ^= len(payload)
+        self.codec ^= codec
+        self.covered |= 1 << (sequence - self.first)
+        if sequence % self.group != self.group - 1:
+            return None
+        parity = PARITY_HEADER.pack(self.length, self.codec, self.covered) + self.parity.tobytes()
+        first, self.first = self.first, None
+        return first, parity
+
+
+class ReorderBuffer:
+    """Puts datagrams back in order on the client. A chunk that still has not shown up once window newer ones
+    arrived is rebuilt from its group's parity if possible and given up on (LOST) otherwise.
+    With parity the window has to cover a whole group, the parity datagram comes after the group's last chunk.
+    Chunks and parity that came in fragments are put back together first, a chunk missing a fragment is missing"""
+    def __init__(self, parity_group=0, window=3):
+        self.parity_group = parity_group
+        self.window = max(window, parity_group + 1)
+        self.packets = {}              # sequence -> (codec, payload) waiting to be played
+        self.history = {}              # recently played packets, still needed to rebuild a chunk from parity
+        self.parity = {}               # first covered sequence -> parity payload
+        self.requested = set()         # missing sequence numbers already reported by gaps
+        self.fragments = {}            # (sequence, parity flag) -> fragments received so far, None for the others
+        self.next_sequence = None
+        self.highest = None
+        self.lost = 0
+        self.recovered = 0
+        self.late = 0                  # arrived after they were played or given up on, or twice
+
+    def push(self, sequence, codec, flags, payload, fragment=0, fragments=1):
+        if fragments > 1:
+            payload = self.reassemble(sequence, flags, payload, fragment, fragments)
+            if payload is None:
+                return
+        if self.next_sequence is None:
+            if flags & FLAG_PARITY:
+                return
+            self.next_sequence = sequence
+        if flags & FLAG_PARITY:
+            self.parity[sequence] = payload
+            self.recover(sequence)
+            return
+        if sequence < self.next_sequence or sequence in self.packets:
+            self.late += 1
+            return
+        self.packets[sequence] = (codec, payload)
+        self.highest = sequence if self.highest is None else max(self.highest, sequence)
+        if self.parity_group > 0:
+            for first in [first for first in self.parity if first <= sequence]:
+                self.recover(first)
+
+    def reassemble(self, sequence, flags, payload, fragment, fragments):
+        """The whole payload once this fragment completes it, None while some are still missing"""
+        key = (sequence, flags & FLAG_PARITY)
+        parts = self.fragments.setdefault(key, [None] * fragments)
+        if len(parts) != fragments:
+            return None
+        parts[fragment] = payload
+        if any(part is None for part in parts):
+            return None
+        del self.fragments[key]
+        return b"".join(parts)
+
+    def recover(self, first):
+        """Rebuilds the one missing chunk of a parity group once all the others are here"""
+        parity = self.parity[first]
+        length, codec, bitmap = PARITY_HEADER.unpack_from(parity)
+        covered = [first + offset for offset in range(MAX_PARITY_GROUP) if bitmap >> offset & 1]
+        missing = [sequence for sequence in covered if sequence not in self.packets and sequence not in self.history]
+        if len(missing) == 0 or missing[0] < self.next_sequence:
+            del self.parity[first]
+            return
+        if len(missing) > 1:
+            return
+        data = np.frombuffer(parity, dtype=np.uint8, offset=PARITY_HEADER.size).copy()
+        for sequence in covered:
+            if sequence != missing[0]:
+                other_codec, payload = self.packets.get(sequence) or self.history[sequence]
+                xor_into(data, payload)
+                length ^= len(payload)
+                codec ^= other_codec
+        self.packets[missing[0]] = (codec, data[:length].tobytes())
+        self.recovered += 1
+        del self.parity[first]
+
+    def gaps(self):
+        """Sequence numbers missing below the newest one here, each reported once. Multicast clients ask
+        the server to resend these"""
+        if self.highest is None:
+            return []
+        start = max(self.next_sequence, self.highest - 64)
+        gaps = [sequence for sequence in range(start, self.highest)
+                if sequence not in self.packets and sequence not in self.requested]
+        self.requested.update(gaps)
+        return gaps
+
+    def pop(self):
+        """Next chunk in order as (sequence, codec, payload), LOST when it was given up on,
+        or None when it may still arrive"""
+        if self.next_sequence is None:
+            return None
+        sequence = self.next_sequence
+        if sequence in self.packets:
+            codec, payload = self.packets.pop(sequence)
+            if self.parity_group > 0:
+                self.history[sequence] = (codec, payload)
+            self.advance()
+            return sequence, codec, payload
+        if self.highest is not None and self.highest - sequence >= self.window:
+            self.lost += 1
+            self.advance()
+            return LOST
+        return None
+
+    def advance(self):
+        self.next_sequence += 1
+        horizon = self.next_sequence - 2 * max(self.parity_group, 1)
+        for old in [old for old in self.history if old < horizon]:
+            del self.history[old]
+        for old in [old for old in self.parity if old < horizon]:
+            del self.parity[old]
+        for old in [old for old in self.fragments if old[0] < horizon]:
+            del self.fragments[old]
+        self.requested.discard(self.next_sequence - 1)
+
+
+class LossShim:
+    """Wraps a datagram socket and drops or reorders what is sent through it, for testing over loopback.
+    A reordered datagram is held back and sent right after the next one"""
+    def __init__(self, sock, loss=0.0, reorder=0.0, seed=None):
+        self.sock = sock
+        self.loss = loss
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.held = None
+
+    def sendto(self, data, address):
+        if self.random.random() < self.loss:
+            return len(data)
+        if self.held is None and self.random.random() < self.reorder:
+            self.held = (bytes(data), address)
+            return len(data)
+        sent = self.sock.sendto(data, address)
+        if self.held is not None:
+            held, self.held = self.held, None
+            self.sock.sendto(*held)
+        return sent
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
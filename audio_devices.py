@@ -0,0 +1,170 @@
+import time
+import wave
+import numpy as np
+try:
+    import pyaudio
+except ImportError:
+    pyaudio = None
+
+# same value as pyaudio.paInt16, so the constructors have a default even without pyaudio installed
+PA_INT16 = pyaudio.paInt16 if pyaudio is not None else 8
+SYNTHETIC_KINDS = ("sine", "noise", "silence", "music")
+
+
+def require_pyaudio():
+    if pyaudio is None:
+        raise ImportError("pyaudio is not installed. install it or pick another audio_device (null, sine, noise, "
+                          "silence, music or wav:<filename>)")
+
+
+def open_source(device, chunk, channels, rate, realtime=True):
+    """Input stream for anything that is not a sound card. Same read interface as a pyaudio stream"""
+    if device in SYNTHETIC_KINDS:
+        return SyntheticSource(device, chunk, channels, rate, realtime)
+    elif device == "null":
+        return NullStream(chunk, channels, rate, realtime)
+    elif device.startswith("wav:"):
+        return WavSource(device[4:], chunk, realtime)
+    raise ValueError("unknown audio input device {}".format(device))
+
+
+def open_sink(device, chunk, channels, rate, realtime=True):
+    """Output stream for anything that is not a sound card. Same write interface as a pyaudio stream"""
+    if device == "null":
+        return NullStream(chunk, channels, rate, realtime)
+    elif device.startswith("wav:"):
+        return WavSink(device[4:], chunk, channels, rate, realtime)
+    raise ValueError("unknown audio output device {}".format(device))
+
+
+class PacedStream:
+    """Base for the devices that are not sound cards. Keeps reads and writes at the sample rate like a real
+    device would, or lets them run flat out when realtime is False"""
+    def __init__(self, chunk, channels, rate, realtime=True):
+        self.chunk = chunk
+        self.channels = channels
+        self.rate = rate
+        self.realtime = realtime
+        self.started = None            # monotonic time of frame 0
+        self.frames = 0                # frames read or written so far
+
+    def clock(self):
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        elif now - self.started - self.frames / self.rate > 1:
+            # more than a second behind. a sound card would have over or under run by now, so start counting again
+            self.started = now - self.frames / self.rate
+        return now
+
+    def pace(self, frames):
+        """Blocks until frames more frames are due"""
+        now = self.clock()
+        self.frames += frames
+        if self.realtime:
+            delay = self.started + self.frames / self.rate - now
+            if delay > 0:
+                time.sleep(delay)
+
+    def get_read_available(self):
+        if not self.realtime:
+            return self.chunk
+        now = self.clock()
+        return max(0, int((now - self.started) * self.rate) - self.frames)
+
+    def stop_stream(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullStream(PacedStream):
+    """Reads silence and throws away whatever is written"""
+    def read(self, frames):
+        self.pace(frames)
+        return bytes(frames * self.channels * 2)
+
+    def write(self, data):
+        self.pace(len(data) // (self.channels * 2))
+
+
+class SyntheticSource(PacedStream):
+    """Generated input. sine is a steady tone, noise is gaussian noise, silence is digital silence and music
+    is a little melody of decaying chords with a rest every 8th note, so the silence handling gets exercised too"""
+    def __init__(self, kind, chunk, channels, rate, realtime=True, frequency=440, amplitude=8000, seed=0):
+        super().__init__(chunk, channels, rate, realtime)
+        if kind not in SYNTHETIC_KINDS:
+            raise ValueError("unknown synthetic source {}".format(kind))
+        self.kind = kind
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.random = np.random.default_rng(seed)
+        self.scale = np.array([0, 2, 4, 5, 7, 9, 11, 12])
+        self.channel_offset = np.arange(channels) * 0.3    # small phase shift so channels are not identical
+
+    def read(self, frames):
+        samples = self.generate(self.frames, frames)
+        self.pace(frames)
+        return samples.tobytes()
+
+    def generate(self, start, frames):
+        t = (np.arange(start, start + frames) / self.rate)[:, None]
+        if self.kind == "silence":
+            signal = np.zeros((frames, self.channels))
+        elif self.kind == "noise":
+            signal = self.random.normal(0, self.amplitude / 3, (frames, self.channels))
+        elif self.kind == "sine":
+            signal = self.amplitude * np.sin(2 * np.pi * self.frequency * t + self.channel_offset)
+        else:
+            note_length = 0.25
+            note = (t // note_length).astype(np.int64)
+            base = 220 * 2 ** (self.scale[note % len(self.scale)] / 12)
+            envelope = np.exp(-6 * (t % note_length)) * (note % 8 != 7)
+            phase = 2 * np.pi * base * t + self.channel_offset
+            signal = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.5 * np.sin(1.5 * phase) + 0.25 * np.sin(3 * phase)
+            signal = self.amplitude / 2 * envelope * signal
+            signal += self.random.normal(0, 4, signal.shape) * (envelope > 0)
+        return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+class WavSource(PacedStream):
+    """Plays a 16 bit wav file over and over"""
+    def __init__(self, filename, chunk, realtime=True):
+        self.wave = wave.open(filename, "rb")
+        if self.wave.getsampwidth() != 2:
+            raise ValueError("{} is not a 16 bit wav file".format(filename))
+        if self.wave.getnframes() == 0:
+            raise ValueError("{} has no audio in it".format(filename))
+        super().__init__(chunk, self.wave.getnchannels(), self.wave.getframerate(), realtime)
+
+    def read(self, frames):
+        data = bytearray()
+        while len(data) < frames * self.channels * 2:
+            piece = self.wave.readframes(frames - len(data) // (self.channels * 2))
+            if len(piece) == 0:
+                self.wave.rewind()
+                continue
+            data += piece
+        self.pace(frames)
+        return bytes(data)
+
+    def close(self):
+        self.wave.close()
+
+
+class WavSink(PacedStream):
+    """Records whatever is played into a 16 bit wav file"""
+    def __init__(self, filename, chunk, channels, rate, realtime=True):
+        super().__init__(chunk, channels, rate, realtime)
+        self.wave = wave.open(filename, "wb")
+        self.wave.setnchannels(channels)
+        self.wave.setsampwidth(2)
+        self.wave.setframerate(rate)
+
+    def write(self, data):
+        self.wave.writeframes(data)
+        self.pace(len(data) // (self.channels * 2))
+
+    def close(self):
+        self.wave.close()
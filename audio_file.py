@@ -0,0 +1,312 @@
+import os
+import json
+import hashlib
+import tempfile
+from threading import Thread, Condition, Lock
+import numpy as np
+import audioread
+from audio_codecs import FractionalResampler
+
+
+class FileSource:
+    """Streams a file chunk by chunk instead of decoding all of it up front, and can seek anywhere in it.
+    The first run decodes in a background thread and writes the decoded pcm to a cache file keyed by path, mtime
+    and size (an anonymous temp file without the cache). Reads come straight out of that file, so the pcm is its
+    own sample accurate chunk index: frame n is at byte n * frame_bytes, seeking is O(1) and only waits when it
+    lands past what has been decoded so far. The decoder stays at most read_ahead chunks ahead of the reader.
+    Later runs memory-map the cache and slice chunks straight out of it, so startup is instant and resident
+    memory stays flat however long the file is"""
+    def __init__(self, filename, chunk, cache_dir=None, use_cache=True, read_ahead=64):
+        self.filename = filename
+        self.chunk = chunk
+        self.read_ahead = read_ahead
+        self.position = 0              # byte offset of the next read
+        self.decoded = 0               # bytes of pcm there are to read so far
+        self.decode_done = False
+        self.closed = False
+        self.condition = Condition()   # decoder progress, the read position and the pcm file
+        self.pcm = None                # memory-mapped cache
+        self.pcm_file = None           # what the decoder writes to and reads come from on the first run
+        cache_dir = cache_dir if cache_dir is not None else os.path.join(tempfile.gettempdir(), "audio_transport")
+        self.cache_path = None
+        self.part_path = None          # the cache file while it is being written, unique to this FileSource
+        if use_cache:
+            stat = os.stat(filename)
+            key = "{}|{}|{}".format(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+            self.cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+            try:
+                with open(self.cache_path + ".json", "r") as file:
+                    info = json.load(file)
+                self.channels = info["channels"]
+                self.samplerate = info["samplerate"]
+                self.duration = info["duration"]
+                self.pcm = np.memmap(self.cache_path + ".pcm", dtype=np.uint8, mode="r")
+                self.decoded = len(self.pcm)
+                self.decode_done = True
+                print("using cached pcm for {}".format(filename))
+            except (IOError, ValueError, KeyError):
+                self.pcm = None
+        if self.pcm is None:
+            self.decoder = audioread.audio_open(filename)
+            self.channels = self.decoder.channels
+            self.samplerate = self.decoder.samplerate
+            self.duration = self.decoder.duration
+            self.pcm_file = self.open_pcm_file()
+        self.frame_bytes = self.channels * 2
+        self.chunk_bytes = self.chunk * self.frame_bytes
+        if self.pcm is None:
+            thread = Thread(target=self.decode, name="file decoder", daemon=True)
+            thread.start()
+
+    def open_pcm_file(self):
+        """The cache file being written, or a temp file that goes away by itself when not caching. The cache file
+        gets a name of its own, so sources decoding the same file at the same time (a playlist listing it twice,
+        two streams or two servers) never write into each other's. Whichever finishes moves its file into place"""
+        if self.cache_path is not None:
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                handle, self.part_path = tempfile.mkstemp(".pcm.part", os.path.basename(self.cache_path) + ".",
+                                                          os.path.dirname(self.cache_path))
+                return os.fdopen(handle, "w+b", buffering=0)
+            except IOError as e:
+                print("not caching {}: {}".format(self.filename, e))
+                self.cache_path = None
+        return tempfile.TemporaryFile("w+b", buffering=0)
+
+    def decode(self):
+        """Decoder thread. Appends the decoded stream to the pcm file and moves it to the cache when done"""
+        try:
+            with self.decoder:
+                for buf in self.decoder:
+                    with self.condition:
+                        while not self.closed and self.decoded - self.position > self.read_ahead * self.chunk_bytes:
+                            self.condition.wait()
+                        if self.closed:
+                            return
+                        self.pcm_file.seek(self.decoded)
+                        self.pcm_file.write(buf)
+                        self.decoded += len(buf)
+                        self.condition.notify_all()
+        finally:
+            with self.condition:
+                self.decode_done = True
+                self.condition.notify_all()
+                if self.cache_path is not None and not self.closed:
+                    self.store_cache()
+
+    def store_cache(self):
+        """Both files are renamed into place, a reader sees either none or all of them"""
+        try:
+            os.replace(self.part_path, self.cache_path + ".pcm")
+            handle, info_path = tempfile.mkstemp(".json.part", os.path.basename(self.cache_path) + ".",
+                                                 os.path.dirname(self.cache_path))
+            with os.fdopen(handle, "w") as file:
+                json.dump({"channels": self.channels, "samplerate": self.samplerate, "duration": self.duration},
+                          file)
+            os.replace(info_path, self.cache_path + ".json")
+        except OSError as e:
+            print("not caching {}: {}".format(self.filename, e))
+
+    @property
+    def frames(self):
+        """Length in frames, None until the whole file is decoded"""
+        return self.decoded // self.frame_bytes if self.decode_done else None
+
+    @property
+    def finished(self):
+        return self.decode_done and self.position >= self.decoded - self.decoded % self.frame_bytes
+
+    def read(self, size):
+        """Up to size bytes of pcm from the read position, waiting for the decoder if it is not there yet.
+        Shorter only at the end of the file and empty past it"""
+        with self.condition:
+            end = self.position + size
+            while not self.decode_done and self.decoded < end:
+                self.condition.wait()
+            end = min(end, self.decoded - self.decoded % self.frame_bytes)
+            if end <= self.position:
+                return bytes()
+            if self.pcm is not None:
+                data = memoryview(self.pcm[self.position:end])
+            else:
+                self.pcm_file.seek(self.position)
+                data = self.pcm_file.read(end - self.position)
+            self.position = end
+            # lets the decoder get further ahead again
+            self.condition.notify_all()
+            return data
+
+    def read_chunk(self):
+        """Next chunk of pcm. Shorter at the end of the file and empty once finished"""
+        return self.read(self.chunk_bytes)
+
+    def seek(self, frame):
+        with self.condition:
+            self.position = max(int(frame), 0) * self.frame_bytes
+            self.condition.notify_all()
+
+    def close(self):
+        """Stops the decoder. A cache that was not finished is thrown away"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+            if self.pcm_file is not None:
+                self.pcm_file.close()
+                if not self.decode_done and self.part_path is not None:
+                    try:
+                        os.remove(self.part_path)
+                    except OSError:
+                        pass
+
+
+class Playlist:
+    """One or more files played one after the other as a single stream of chunks, at the sample rate and
+    channel count of the first one. Tracks at another rate are resampled on the fly, other channel counts are
+    mixed down or spread out to match. Transitions are gapless: the chunk a track ends in is filled up from the
+    start of the next one, which is opened (and starts decoding) as soon as the current one is decoded.
+    With loop the first track follows the last one. seek goes to any sample of any track"""
+    def __init__(self, filenames, chunk, cache_dir=None, use_cache=True, loop=False):
+        self.filenames = [filenames] if isinstance(filenames, str) else list(filenames)
+        if len(self.filenames) == 0:
+            raise ValueError("a playlist needs at least one file")
+        self.chunk = chunk
+        self.cache_dir = cache_dir
+        self.use_cache = use_cache
+        self.loop = loop
+        self.lock = Lock()             # seek comes from another thread than read_chunk
+        self.track_index = 0
+        self.track = self.open_track(0)
+        self.next_track = None         # opened once the current one is decoded
+        self.channels = self.track.channels
+        self.samplerate = self.track.samplerate
+        self.duration = self.track.duration
+        self.chunk_bytes = self.chunk * self.channels * 2
+        self.silence = bytes(self.chunk_bytes)
+        self.pending = bytearray()     # converted pcm that did not fill a whole chunk yet
+        self.resampler = None          # FractionalResampler for a track at another sample rate
+        self.primed = False            # whether the resampler has seen the track's first frame
+        self.finished = False
+        self.start_track()
+
+    def open_track(self, index):
+        return FileSource(self.filenames[index], self.chunk, self.cache_dir, self.use_cache)
+
+    def start_track(self):
+        """Conversion for the current track. The resampler starts over, it is only ever fed one track"""
+        self.resampler = FractionalResampler(self.channels) if self.track.samplerate != self.samplerate else None
+        self.primed = False
+        if len(self.filenames) > 1:
+            print("playing track {} of {}: {} channels={}, samplerate={}".format(
+                self.track_index + 1, len(self.filenames), self.filenames[self.track_index], self.track.channels,
+                self.track.samplerate))
+
+    def convert(self, data):
+        """A track's pcm as bytes at the playlist's channel count and sample rate"""
+        samples = np.frombuffer(data, dtype=np.int16)
+        if self.track.channels != self.channels:
+            samples = remix(samples, self.track.channels, self.channels)
+        if self.resampler is not None:
+            if not self.primed:
+                # starts on the track's own first frame, not on silence
+                self.resampler.prime(samples)
+                self.primed = True
+            samples = self.resampler.process(samples, self.track.samplerate / self.samplerate)
+        return samples.tobytes()
+
+    def finish_track(self):
+        """The last frames of a resampled track, still in the resampler when the track ends"""
+        if self.resampler is not None and self.primed:
+            self.pending += self.resampler.flush(self.track.samplerate / self.samplerate).tobytes()
+            self.primed = False
+
+    def read_chunk(self):
+        """Next chunk of pcm, always a whole one. Silence once the playlist is over"""
+        with self.lock:
+            while len(self.pending) < self.chunk_bytes and not self.finished:
+                data = self.track.read(self.track.chunk_bytes)
+                if len(data) == 0:
+                    self.finish_track()
+                    self.next()
+                    continue
+                self.prefetch()
+                if len(self.pending) == 0 and len(data) == self.chunk_bytes and self.resampler is None \
+                        and self.track.channels == self.channels:
+                    # the usual case, straight out of the file without a copy
+                    return data
+                self.pending += self.convert(data)
+            if len(self.pending) == 0:
+                return self.silence
+            data = bytes(self.pending[:self.chunk_bytes]).ljust(self.chunk_bytes, b"\x00")
+            del self.pending[:self.chunk_bytes]
+            return data
+
+    def following(self):
+        """Index of the track after the current one, None at the end of a playlist that does not loop"""
+        if self.track_index + 1 < len(self.filenames):
+            return self.track_index + 1
+        return 0 if self.loop else None
+
+    def prefetch(self):
+        """Gets the next track decoding once the current one is, so its first chunk is there in time"""
+        index = self.following()
+        if self.next_track is None and self.track.decode_done and index is not None and len(self.filenames) > 1:
+            self.next_track = self.open_track(index)
+
+    def next(self):
+        index = self.following()
+        if index is None:
+            self.finished = True
+            return
+        if len(self.filenames) == 1:
+            # looping a single file. it is all in its pcm file already
+            self.track.seek(0)
+        else:
+            self.track.close()
+            self.track = self.next_track if self.next_track is not None else self.open_track(index)
+            self.next_track = None
+        self.track_index = index
+        self.start_track()
+
+    def seek(self, seconds, track=None):
+        """Goes to seconds into the current track, or into the given track (counting from 0)"""
+        with self.lock:
+            if track is not None and track != self.track_index:
+                if not 0 <= track < len(self.filenames):
+                    raise ValueError("no track {} in a playlist of {}".format(track, len(self.filenames)))
+                self.track.close()
+                if self.next_track is not None:
+                    self.next_track.close()
+                    self.next_track = None
+                self.track = self.open_track(track)
+                self.track_index = track
+                self.start_track()
+            elif self.resampler is not None:
+                self.resampler.reset()
+                self.primed = False
+            self.track.seek(seconds * self.track.samplerate)
+            self.pending.clear()
+            self.finished = False
+
+    def close(self):
+        """Stops the decoders. Nothing can be read after this"""
+        with self.lock:
+            self.track.close()
+            if self.next_track is not None:
+                self.next_track.close()
+                self.next_track = None
+
+
+def remix(samples, from_channels, to_channels):
+    """Interleaved int16 samples to another channel count. Down to mono averages, up from mono copies, anything
+    else keeps the channels both have and leaves the rest silent"""
+    frames = samples.reshape(-1, from_channels)
+    if to_channels == 1:
+        return frames.mean(axis=1).astype(np.int16)
+    if from_channels == 1:
+        return np.repeat(samples, to_channels)
+    result = np.zeros((len(frames), to_channels), dtype=np.int16)
+    shared = min(from_channels, to_channels)
+    result[:, :shared] = frames[:, :shared]
+    return result.reshape(-1)
@@ -0,0 +1,223 @@
+import math
+import time
+from threading import Condition
+import numpy as np
+
+
+class JitterBuffer:
+    """Fixed size ring of decoded pcm chunks between the network thread and playback.
+    put blocks while the ring is full and get blocks while it is empty, both on one condition variable, so
+    neither side spins. Arrival jitter is tracked like RTP does (RFC 3550) and the target depth follows it:
+    up after an underrun or when jitter grows, slowly back down when playback has been clean for a while.
+    While the ring is well above target playback now and then drops a chunk, which is how latency comes back
+    down after a burst. The chunk before it ends in a short crossfade (splice seconds) into the end of the dropped
+    one, so the chunk after follows on where it should: no click, only a few ms where two stretches of the signal
+    overlap. A missing chunk is concealed by fading out the last one instead of leaving a gap.
+    One slot is always kept free so the chunk handed out by get stays untouched until the next get.
+    claim and commit are put without the copy: the network thread receives or decodes straight into the slot"""
+    def __init__(self, capacity, chunk_bytes, chunk_period, min_depth=2, target_depth=None, adapt_interval=200,
+                 drop_interval=8, channels=1, splice=0.004):
+        self.capacity = max(capacity, min_depth + 2)
+        self.chunk_bytes = chunk_bytes
+        self.channels = channels
+        self.chunk_period = chunk_period        # seconds of audio per chunk
+        self.block = bytearray(self.capacity * chunk_bytes)
+        self.view = memoryview(self.block)
+        # views of every slot made once, as bytes for recv_into and as int16 samples for the decoders
+        self.slots = [self.view[slot * chunk_bytes:(slot + 1) * chunk_bytes] for slot in range(self.capacity)]
+        self.samples = list(np.frombuffer(self.block, dtype=np.int16).reshape(self.capacity, -1))
+        self.lengths = [0] * self.capacity
+        self.read_pos = 0
+        self.write_pos = 0
+        self.condition = Condition()
+        self.has_room = lambda: len(self) < self.max_depth
+        self.has_chunk = lambda: not self.buffering and len(self) > 0
+        self.min_depth = min_depth
+        self.max_depth = self.capacity - 1
+        self.target_depth = min_depth if target_depth is None else min(max(target_depth, min_depth), self.max_depth)
+        self.adapt_interval = adapt_interval    # clean chunks played before the target may drop by one
+        self.drop_interval = drop_interval      # chunks played between two latency reducing drops
+        self.buffering = True                   # waiting to reach target depth before playing
+        self.jitter = 0.0
+        self.last_arrival = None
+        self.clean_chunks = 0
+        self.since_drop = 0
+        self.concealed_in_row = 0
+        self.lost_in_row = 0
+        self.underruns = 0
+        self.drops = 0
+        self.conceal = bytearray(chunk_bytes)
+        self.conceal_view = memoryview(self.conceal)
+        self.last_played = np.zeros(chunk_bytes // 2, dtype=np.int16)
+        # one gain per frame, so every channel fades alike
+        self.fade_out = np.repeat(np.linspace(1, 0, chunk_bytes // (2 * channels)), channels)
+        self.fade_in = self.fade_out[::-1].copy()
+        # raised cosine over the splice of a drop, a few ms of the end of a chunk
+        frames = chunk_bytes // (2 * channels)
+        splice_frames = min(max(int(round(frames * splice / chunk_period)), 1), frames)
+        self.splice_out = np.repeat(0.5 + 0.5 * np.cos(np.linspace(0, np.pi, splice_frames)), channels)
+        self.splice_in = 1 - self.splice_out
+        self.merged = bytearray(chunk_bytes)
+        self.merged_view = memoryview(self.merged)
+        self.lost = bytearray(chunk_bytes)
+
+    def __len__(self):
+        return self.write_pos - self.read_pos
+
+    def clear(self):
+        with self.condition:
+            self.read_pos = self.write_pos
+            self.buffering = True
+            self.last_arrival = None
+            self.condition.notify_all()
+
+    def put(self, data, timeout=None, arrived=True):
+        """Copies a chunk into the ring. Returns False if the ring stayed full for timeout seconds.
+        arrived is False for chunks made up on this side, which do not count towards the arrival jitter"""
+        slot = self.claim(timeout)
+        if slot is None:
+            return False
+        length = min(len(data), self.chunk_bytes)
+        self.slots[slot][:length] = data[:length] if length < len(data) else data
+        self.commit(length, arrived)
+        return True
+
+    def claim(self, timeout=None):
+        """Waits for room like put and returns the index of the next free slot, to be filled through
+        slots[index] or samples[index] and handed over with commit. None if the ring stayed full for timeout
+        seconds. Only the thread that puts may claim"""
+        with self.condition:
+            if not self.condition.wait_for(self.has_room, timeout=timeout):
+                return None
+            return self.write_pos % self.capacity
+
+    def commit(self, length, arrived=True):
+        """Makes the claimed slot, holding length bytes, the newest chunk"""
+        with self.condition:
+            self.lengths[self.write_pos % self.capacity] = length
+            self.write_pos += 1
+            if arrived:
+                self.lost_in_row = 0
+                self.track_arrival()
+            if self.buffering and len(self) >= self.target_depth:
+                self.buffering = False
+            self.condition.notify_all()
+
+    def put_lost(self, timeout=None):
+        """Stands in for a chunk the network lost for good, in its place in the stream. Like underrun: the chunk
+        before it fading out, then silence if more go missing in a row"""
+        samples = np.frombuffer(self.lost, dtype=np.int16)
+        with self.condition:
+            slot = (self.write_pos - 1) % self.capacity
+            if self.lost_in_row == 0 and self.write_pos > 0 and self.lengths[slot] == self.chunk_bytes:
+                np.multiply(self.samples[slot], self.fade_out, out=samples, casting="unsafe")
+            else:
+                samples[:] = 0
+        self.lost_in_row += 1
+        return self.put(self.lost, timeout, arrived=False)
+
+    def track_arrival(self):
+        now = time.monotonic()
+        if self.last_arrival is not None:
+            deviation = abs((now - self.last_arrival) - self.chunk_period)
+            self.jitter += (deviation - self.jitter) / 16
+            jitter_depth = self.min_depth + math.ceil(4 * self.jitter / self.chunk_period)
+            if jitter_depth > self.target_depth:
+                self.target_depth = min(jitter_depth, self.max_depth)
+        self.last_arrival = now
+
+    def get(self, timeout=None):
+        """Next chunk to play as a memoryview. When nothing arrives within timeout (one chunk period by default)
+        a concealment chunk is returned instead and the underrun raises the target depth"""
+        timeout = self.chunk_period if timeout is None else timeout
+        with self.condition:
+            if not self.condition.wait_for(self.has_chunk, timeout=timeout):
+                return self.underrun()
+            self.concealed_in_row = 0
+            self.clean_chunks += 1
+            self.since_drop += 1
+            if self.clean_chunks >= self.adapt_interval:
+                self.clean_chunks = 0
+                self.target_depth = max(self.target_depth - 1, self.min_depth)
+            if len(self) > self.target_depth + 2 and self.since_drop >= self.drop_interval:
+                # well above target. a chunk less to pull latency back down
+                merged = self.merge()
+                if merged is not None:
+                    return merged
+            slot = self.read_pos % self.capacity
+            self.read_pos += 1
+            self.condition.notify_all()
+            if self.lengths[slot] < self.chunk_bytes:
+                return self.slots[slot][:self.lengths[slot]]
+            self.last_played[:] = self.samples[slot]
+            return self.slots[slot]
+
+    def merge(self):
+        """Plays the next chunk with the end of the one after spliced on, and takes both off the ring. None when
+        one of them is short, the end of a file for example, those are played as they are"""
+        first = self.read_pos % self.capacity
+        second = (self.read_pos + 1) % self.capacity
+        if self.lengths[first] != self.chunk_bytes or self.lengths[second] != self.chunk_bytes:
+            return None
+        samples = np.frombuffer(self.merged, dtype=np.int16)
+        splice = len(self.splice_out)
+        samples[:-splice] = self.samples[first][:-splice]
+        np.copyto(samples[-splice:], self.samples[first][-splice:] * self.splice_out +
+                  self.samples[second][-splice:] * self.splice_in, casting="unsafe")
+        self.read_pos += 2
+        self.drops += 1
+        self.since_drop = 0
+        self.condition.notify_all()
+        self.last_played[:] = samples
+        return self.merged_view
+
+    def underrun(self):
+        """Packet loss concealment. The first missing chunk repeats the last one fading out, then silence.
+        Keeps buffering until the ring is back at the (now higher) target depth"""
+        if not self.buffering:
+            self.underruns += 1
+            self.clean_chunks = 0
+            self.target_depth = min(self.target_depth + 1, self.max_depth)
+            self.buffering = len(self) < self.target_depth
+        samples = np.frombuffer(self.conceal, dtype=np.int16)
+        if self.concealed_in_row == 0:
+            np.multiply(self.last_played, self.fade_out, out=samples, casting="unsafe")
+        else:
+            samples[:] = 0
+        self.concealed_in_row += 1
+        return self.conceal_view
+
+
+class DriftEstimator:
+    """The server's capture clock and our sound card never run at quite the same rate, so left alone the jitter
+    buffer slowly fills up or drains. This turns the buffer depth into a playback rate ratio for a
+    FractionalResampler: a PI controller on the depth smoothed over smoothing seconds. The proportional part
+    pulls the depth back to its setpoint over about settle_time seconds, the integral part converges on the
+    clock drift itself (drift, above 0 when the server is faster) so once locked no depth error is left over.
+    The correction never goes beyond limit, 1000 ppm by default, far below what anyone can hear"""
+    def __init__(self, chunk_period, limit=0.001, smoothing=10, settle_time=60, integral_time=240):
+        self.chunk_period = chunk_period
+        self.limit = limit
+        self.smoothing = smoothing
+        self.settle_time = settle_time
+        self.integral_time = integral_time
+        self.depth = None              # smoothed depth in chunks
+        self.drift = 0.0
+        self.ratio = 1.0
+
+    def reset(self):
+        """Starts the depth over, after a reconnect for example. The drift estimate is kept, the clocks are
+        still the same"""
+        self.depth = None
+        self.ratio = 1.0 + self.drift
+
+    def update(self, depth, setpoint):
+        """Called once per chunk played with the buffer depth right after taking it. Returns the new ratio"""
+        if self.depth is None:
+            self.depth = float(setpoint)
+        self.depth += (depth - self.depth) * self.chunk_period / self.smoothing
+        correction = (self.depth - setpoint) * self.chunk_period / self.settle_time
+        self.drift += correction * self.chunk_period / self.integral_time
+        self.drift = min(max(self.drift, -self.limit), self.limit)
+        self.ratio = 1.0 + min(max(self.drift + correction, -self.limit), self.limit)
+        return self.ratio
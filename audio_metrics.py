@@ -0,0 +1,199 @@
+import os
+import json
+import time
+from bisect import bisect_left
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# seconds, from a fast encode to a slow network send
+TIME_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Counter:
+    """Only goes up. Updates are not locked: a += from two threads at the same moment may lose one, which is
+    the price of keeping them cheap enough for every chunk"""
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Fixed buckets, counted in a list made once. observe finds the bucket with a binary search"""
+    kind = "histogram"
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)     # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(le, observations <= le)] the way Prometheus wants them"""
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """A set of named metrics for one server or client. Every metric object is made once, when the thing it
+    measures starts (the server, a client session), so the hot paths only update numbers in place.
+    Values that are already kept somewhere (buffer positions, underrun counts) are not copied on every chunk,
+    collectors read them when somebody asks. A collector is a function returning
+    [(name, kind, help, labels, value)], kind being counter or gauge.
+    text() is the Prometheus exposition format, snapshot() the same as a dict for json"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.families = {}             # name -> (kind, help, {label items: metric})
+        self.collectors = []
+        self.lock = Lock()             # only held to add or remove metrics and to read them all, never to update
+        self.http_server = None
+
+    def metric(self, metric_class, name, help_text, labels, *args):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, (metric_class.kind, help_text, {}))
+            if key not in family[2]:
+                family[2][key] = metric_class(*args)
+            return family[2][key]
+
+    def counter(self, name, help_text, **labels):
+        return self.metric(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, **labels):
+        return self.metric(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, buckets=TIME_BUCKETS, **labels):
+        return self.metric(Histogram, name, help_text, labels, buckets)
+
+    def remove(self, **labels):
+        """Drops every metric with these labels, i.e. client= once a client left"""
+        items = set((label, str(value)) for label, value in labels.items())
+        with self.lock:
+            for _, _, metrics in self.families.values():
+                for key in [key for key in metrics if items <= set(key)]:
+                    del metrics[key]
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        """{name: (kind, help, [(labels dict, metric or value)])} of everything, collectors included"""
+        with self.lock:
+            families = {name: (kind, help_text, [(dict(key), metric) for key, metric in metrics.items()])
+                        for name, (kind, help_text, metrics) in self.families.items()}
+        for collector in self.collectors:
+            for name, kind, help_text, labels, value in collector():
+                families.setdefault(name, (kind, help_text, []))[2].append((labels, value))
+        return families
+
+    def text(self):
+        lines = []
+        for name, (kind, help_text, samples) in sorted(self.collect().items()):
+            name = self.prefix + name
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                if kind != "histogram":
+                    lines.append("{}{} {}".format(name, format_labels(labels), number(value)))
+                    continue
+                for bound, count in value.cumulative():
+                    lines.append("{}_bucket{} {}".format(name, format_labels(dict(labels, le=number(bound))),
+                                                         count))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), number(value.sum)))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), value.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        metrics = {}
+        for name, (kind, _, samples) in self.collect().items():
+            entries = []
+            for labels, value in samples:
+                if kind == "histogram":
+                    entries.append({"labels": labels, "count": value.count, "sum": value.sum,
+                                    "buckets": {number(bound): count for bound, count in value.cumulative()}})
+                else:
+                    entries.append({"labels": labels, "value": value.value if isinstance(value, Counter) else value})
+            metrics[self.prefix + name] = entries
+        return {"time": time.time(), "metrics": metrics}
+
+    def serve(self, address="127.0.0.1", port=9100):
+        """Answers GET /metrics (Prometheus text) and GET /metrics.json from a thread of its own"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.text(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.snapshot()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((address, port), Handler)
+        self.http_server.daemon_threads = True
+        Thread(target=self.http_server.serve_forever, name="metrics", daemon=True).start()
+        print("metrics on http://{}:{}/metrics".format(address, self.http_server.server_address[1]))
+
+    def write_snapshots(self, filename, interval=10):
+        """Rewrites filename with snapshot() every interval seconds. Replaced in one go, never half written"""
+        def writer():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(filename + ".tmp", "w") as file:
+                        json.dump(self.snapshot(), file)
+                    os.replace(filename + ".tmp", filename)
+                except OSError as e:
+                    print("metrics snapshot not written:", e)
+
+        Thread(target=writer, name="metrics snapshots", daemon=True).start()
+
+    def start(self, port=None, address="127.0.0.1", filename=None, interval=10):
+        """Starts whatever the metrics_ options of a server or client asked for"""
+        if port is not None:
+            self.serve(address, port)
+        if filename is not None:
+            self.write_snapshots(filename, interval)
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in labels.items()) + "}"
+
+
+def number(value):
+    value = value.value if isinstance(value, Counter) else value
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
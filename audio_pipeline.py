@@ -0,0 +1,164 @@
+import time
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+from multiprocessing import shared_memory
+from queue import Queue
+from threading import Thread
+from audio_codecs import chunk_levels
+
+# compression modes whose encoder carries state from one chunk to the next. they all go to one worker, in order
+STATEFUL_MODES = (3, 5)
+
+# state of an encoding worker process, set up by start_worker
+worker_memory = None
+worker_slots = None
+worker_slot_bytes = 0
+worker_encoder = None
+
+
+def start_worker(memory_name, slot_bytes, encoder):
+    """encoder is a ChunkEncoder, pickled over from the server. Each worker has a copy of its own"""
+    global worker_memory, worker_slots, worker_slot_bytes, worker_encoder
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    worker_slots = worker_memory.buf
+    worker_slot_bytes = slot_bytes
+    worker_encoder = encoder
+
+
+def encode_chunk(slot, length, modes):
+    """Runs in a worker. Encodes the pcm chunk in a shared memory slot into the given modes.
+    Returns ({mode: (encoded bytes, silent, seconds it took)}, peak, rms). Mode 0 comes back as None, the
+    publish stage takes it straight from the slot"""
+    start = slot * worker_slot_bytes
+    data = worker_slots[start:start + length]
+    encoded = {}
+    peak, rms = chunk_levels(data)
+    for mode in modes:
+        started = time.perf_counter()
+        silent = worker_encoder.is_silent(peak, rms, len(data), mode)
+        encoded[mode] = (worker_encoder.encode(data, silent, mode) if mode > 0 else None, silent,
+                         time.perf_counter() - started)
+    return encoded, peak, rms
+
+
+class EncodePipeline:
+    """Capture, encode and publish as three stages, so a slow codec never holds up reading the device.
+    submit copies a pcm chunk into a shared memory slot and hands it to a process pool. Stateless compression
+    modes are encoded by any of workers processes, the stateful ones (3 and 5) by a single process of their own
+    that sees every chunk in order. The publish thread collects the results in sequence order and publishes them.
+    Capture blocks once every slot is waiting to be encoded or published. Should a worker die or an encoder fail,
+    the chunks still waiting are encoded in the capture thread and the server goes on without the pipeline"""
+    def __init__(self, server, workers, slots=None):
+        self.server = server
+        self.modes = list(server.codec_ladder)
+        self.slot_bytes = server.CHUNK * server.CHANNELS * 2
+        self.slots = slots if slots is not None else workers * 2 + 4
+        self.memory = shared_memory.SharedMemory(create=True, size=self.slot_bytes * self.slots)
+        self.free = Queue()            # slot indexes not in use
+        for slot in range(self.slots):
+            self.free.put(slot)
+        self.pending = Queue()         # (slot, length, futures) in sequence order
+        self.closed = False
+        self.failed = None             # (slot, length) of the chunk that could not be encoded
+        stateless = [mode for mode in self.modes if mode not in STATEFUL_MODES]
+        stateful = [mode for mode in self.modes if mode in STATEFUL_MODES]
+        # spawn, the server already runs threads and holds sockets
+        context = multiprocessing.get_context("spawn")
+        self.stages = []               # (executor, modes it encodes)
+        processes = 0
+        for count, modes in ((workers, stateless), (1, stateful)):
+            if len(modes) > 0:
+                processes += count
+                args = (self.memory.name, self.slot_bytes, server.encoder)
+                executor = ProcessPoolExecutor(count, context, initializer=start_worker, initargs=args)
+                self.stages.append((executor, modes))
+        # start the workers now, not when the first chunks are already waiting
+        wait([executor.submit(int) for executor, _ in self.stages for _ in range(workers)])
+        atexit.register(self.close)
+        self.thread = Thread(target=self.publish_loop, name="publish", daemon=True)
+        server.threads["publish"] = self.thread
+        self.thread.start()
+        print("encoding in {} worker process(es)".format(processes))
+
+    def submit(self, data):
+        """Capture stage. Only copies the chunk and queues it. Returns False once the pipeline failed or was
+        closed, the caller encodes the chunk itself then"""
+        if self.closed:
+            return False
+        slot = self.free.get()
+        if self.failed is not None:
+            if slot is not None:
+                self.free.put(slot)
+            self.recover()
+            return False
+        start = slot * self.slot_bytes
+        self.memory.buf[start:start + len(data)] = data
+        try:
+            futures = [executor.submit(encode_chunk, slot, len(data), modes) for executor, modes in self.stages]
+        except Exception as e:
+            # the pool broke since the last chunk. the publish thread finds out in order, from this future
+            future = Future()
+            future.set_exception(e)
+            futures = [future]
+        self.pending.put((slot, len(data), futures))
+        return True
+
+    def publish_loop(self):
+        """Publish stage"""
+        while True:
+            entry = self.pending.get()
+            if entry is None:
+                return
+            slot, length, futures = entry
+            encoded = {}
+            peak, rms = 0, 0.0
+            try:
+                for future in futures:
+                    chunks, peak, rms = future.result()
+                    encoded.update(chunks)
+            except Exception as e:
+                # BrokenProcessPool when a worker died, or whatever an encoder raised
+                print("encoding pipeline failed: {!r}. encoding in the capture thread from now on".format(e))
+                self.failed = (slot, length)
+                # wakes capture up should every slot be taken
+                self.free.put(None)
+                return
+            start = slot * self.slot_bytes
+            pcm = self.memory.buf[start:start + length]
+            levels = [pcm if mode == 0 else encoded[mode][0] for mode in self.modes]
+            for mode in self.modes:
+                self.server.encode_time[mode].observe(encoded[mode][2])
+            self.server.publish_encoded(levels, [encoded[mode][1] for mode in self.modes], peak, rms)
+            pcm.release()
+            self.free.put(slot)
+
+    def recover(self):
+        """Capture stage, after the publish thread gave up. Encodes and publishes the chunks that were still
+        waiting, in order, and closes the pipeline"""
+        self.thread.join()
+        waiting = [self.failed]
+        while not self.pending.empty():
+            slot, length, _ = self.pending.get()
+            waiting.append((slot, length))
+        for slot, length in waiting:
+            start = slot * self.slot_bytes
+            self.server.publish_chunk(bytes(self.memory.buf[start:start + length]))
+        self.close()
+
+    def close(self):
+        """Lets the publish thread finish the chunks in flight, then waits for the workers to exit and frees the
+        shared memory. Capture should have stopped, see AudioServer.shutdown"""
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join(timeout=5)
+        for executor, _ in self.stages:
+            executor.shutdown(wait=True, cancel_futures=True)
+        try:
+            self.memory.close()
+        except BufferError:
+            # the publish thread is stuck holding a view of a slot. the mapping goes with the process
+            pass
+        self.memory.unlink()
@@ -0,0 +1,72 @@
+import struct
+
+# Protocol version 1 is the original stop-and-wait protocol: the client answers every chunk with "ok" and,
+# when using compression, echoes a 2 byte length header before the chunk is sent.
+# Protocol version 2 sends self-describing frames and lets the server keep a window of unacknowledged frames
+# in flight. The client acknowledges cumulatively with the last sequence number it received.
+PROTOCOL_VERSION = 2
+DEFAULT_WINDOW = 16
+V1_MAX_LENGTH = 0x7FFF         # protocol version 1 length headers are signed 16 bit
+
+# payload length, sequence number, codec id, flags
+FRAME_HEADER = struct.Struct("<IIBB")
+FLAG_PARAMS = 2                # the payload is the parameters of the stream the client was just moved to
+PARAMS_SEQUENCE = 0xFFFFFFFF   # sequence number of a parameters frame, acknowledged on its own
+# message type, value
+CLIENT_MESSAGE = struct.Struct("<BI")
+MSG_ACK = 1
+MSG_REGISTER = 2               # sent over udp with the session id, tells the server where to send datagrams
+MSG_REPAIR = 3                 # multicast clients asking for a sequence number they missed, over udp
+MSG_FEEDBACK = 4               # playout buffer depth, target depth and underrun count, see pack_feedback
+MSG_STREAM = 5                 # switch to another stream of the server, by its index in the streams parameter
+# message type, session id, sequence number
+REPAIR_MESSAGE = struct.Struct("<BII")
+
+
+def parse_options(fields):
+    """Turns ["key=value", ...] handshake fields into a dict. Fields without '=' are ignored"""
+    options = {}
+    for field in fields:
+        if "=" in field:
+            key, value = field.split("=", 1)
+            options[key.strip()] = value.strip()
+    return options
+
+
+def format_options(options):
+    return ",".join("{}={}".format(key, value) for key, value in options.items())
+
+
+def pack_frame(sequence, codec, payload, flags=0):
+    return FRAME_HEADER.pack(len(payload), sequence & 0xFFFFFFFF, codec, flags) + payload
+
+
+def pack_feedback(depth, target, underruns):
+    """Feedback fits the value of a CLIENT_MESSAGE: depth and target depth in chunks (up to 255) and the low 16
+    bits of the underrun count"""
+    return min(depth, 255) | min(target, 255) << 8 | (underruns & 0xFFFF) << 16
+
+
+def unpack_feedback(value):
+    return value & 0xFF, value >> 8 & 0xFF, value >> 16
+
+
+def recv_exact(connection, size):
+    """Reads exactly size bytes from the socket. Raises ConnectionError if the other side hangs up"""
+    data = bytearray()
+    while len(data) < size:
+        chunk_data = connection.recv(size - len(data))
+        if len(chunk_data) == 0:
+            raise ConnectionError("connection closed while reading {} bytes".format(size))
+        data += chunk_data
+    return bytes(data)
+
+
+def recv_exact_into(connection, view):
+    """recv_exact without allocating anything: fills the writable memoryview view straight from the socket"""
+    received = 0
+    while received < len(view):
+        count = connection.recv_into(view[received:] if received > 0 else view)
+        if count == 0:
+            raise ConnectionError("connection closed while reading {} bytes".format(len(view)))
+        received += count
@@ -0,0 +1,81 @@
+import time
+from audio_server import AudioServer
+from audio_ring import ChunkRing
+from audio_datagram import LOST
+
+
+class RelayServer(AudioServer):
+    """AudioServer fed by an AudioClient instead of a sound card. Chunks are published exactly as they came
+    from upstream, still encoded, so a relay never decodes or re-encodes anything. Downstream clients (or further
+    relays) connect with the usual handshake and late joiners are served from the relay's own ring.
+    upstream_lag is how much later than its earliest arrival time the newest chunk came in, in seconds"""
+    def __init__(self, client, bind_address="0.0.0.0", bind_port=1060, audio_buffer_size=102, **kwargs):
+        factor = client.decimation_factor if client.use_compression == 3 else 2
+        super().__init__(chunk=client.CHUNK, channels=client.CHANNELS, rate=client.RATE, bind_address=bind_address,
+                         bind_port=bind_port, audio_buffer_size=audio_buffer_size,
+                         use_compression=client.use_compression, decimation_factor=factor, audio_device="null",
+                         mid_side=client.mid_side, **kwargs)
+        # chunks arrive in one encoding only, whatever --codec_ladder says
+        if self.codec_ladder != [client.use_compression]:
+            for mode in self.codec_ladder:
+                self.metrics.remove(codec=mode)
+            self.codec_ladder = [client.use_compression]
+            self.use_compression = client.use_compression
+            self.audio_buffer = ChunkRing(self.buffer_max_size + self.buffer_size_increment,
+                                          [self.max_chunk_bytes()], self.buffer_size)
+            self.count_codecs()
+        # and there is nothing to encode
+        if self.encode_pipeline is not None:
+            self.encode_pipeline.close()
+            self.encode_pipeline = None
+        self.upstream = self.stream_parameters(client)
+        self.period = self.CHUNK / self.RATE
+        self.lag_base = None           # earliest arrival time minus sequence * period seen so far
+        self.upstream_lag = 0.0
+        self.last_report = time.monotonic()
+
+    @staticmethod
+    def stream_parameters(client):
+        return client.RATE, client.CHUNK, client.CHANNELS, client.use_compression, client.decimation_factor, \
+            client.mid_side
+
+    def matches(self, client):
+        """False when the upstream server came back with different parameters than the relay was built for"""
+        return self.stream_parameters(client) == self.upstream
+
+    def begin_rolling_buffer(self):
+        """Nothing to read here, the client publishes. Like the server, lets clients in once the first chunk is
+        there and fills the rest of the ring while they listen"""
+        print("relay waiting for upstream")
+        with self.chunk_published:
+            self.chunk_published.wait_for(lambda: len(self.audio_buffer) > 0)
+        print("relay receiving from upstream")
+
+    def reset_lag(self):
+        """Called after reconnecting upstream, the gap would otherwise count as lag for good"""
+        self.lag_base = None
+
+    def relay_chunk(self, data):
+        """Publishes one chunk as received. A chunk lost upstream goes out as silence so sequence numbers stay
+        continuous downstream"""
+        if data is LOST:
+            data = bytes(self.CHUNK * self.CHANNELS * 2) if self.use_compression == 0 else bytes(2)
+        if self.use_compression == 0:
+            silent, peak, rms = self.chunk_metadata(data)
+        else:
+            # no peak or rms without decoding. only the silence marker upstream sent counts as silent
+            silent, peak, rms = data == bytes(2), 0, 0.0
+        sequence = self.audio_buffer.publish(data, silent, peak, rms)
+        if self.multicast_socket is not None:
+            self.send_multicast(sequence)
+        self.notify_new_chunk()
+        self.fit_ring()
+
+        now = time.monotonic()
+        offset = now - sequence * self.period
+        self.lag_base = offset if self.lag_base is None else min(self.lag_base, offset)
+        self.upstream_lag = offset - self.lag_base
+        if now - self.last_report > 10:
+            self.last_report = now
+            print("relay upstream lag {} ms, {} downstream client(s)".format(
+                round(self.upstream_lag * 1000), len(self.clients)))
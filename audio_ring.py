@@ -0,0 +1,92 @@
+import time
+import numpy as np
+
+
+class ChunkRing:
+    """Fixed capacity ring of chunk slots backed by one contiguous bytearray.
+    Chunks are addressed by a monotonically increasing sequence number and read back as zero-copy memoryview slices.
+    size is the logical buffer size (how far back readers may go) and can grow or shrink up to capacity
+    without reallocating. Keep capacity a few slots above the largest size so a reader holding the oldest chunk
+    is not overwritten while it is still sending it.
+    Every slot also keeps metadata computed once when the chunk is published (silence flag, peak, rms and the
+    encoded size) so readers never have to look at the audio itself.
+    A slot can hold several encodings (levels) of the same chunk side by side. slot_size is then a list with the
+    largest size of every level, and all levels share the sequence number"""
+    def __init__(self, capacity, slot_size, size=None):
+        self.capacity = capacity
+        self.level_sizes = list(slot_size) if isinstance(slot_size, (list, tuple)) else [slot_size]
+        self.levels = len(self.level_sizes)
+        self.level_offsets = np.concatenate(([0], np.cumsum(self.level_sizes)[:-1])).astype(np.int64)
+        self.slot_size = int(sum(self.level_sizes))
+        self.size = capacity if size is None else min(size, capacity)
+        self.block = bytearray(capacity * self.slot_size)
+        self.view = memoryview(self.block)
+        self.slots = np.frombuffer(self.block, dtype=np.uint8).reshape(capacity, self.slot_size)
+        self.lengths = np.zeros((capacity, self.levels), dtype=np.int64)
+        self.sequences = np.full(capacity, -1, dtype=np.int64)
+        self.silent = np.zeros((capacity, self.levels), dtype=bool)
+        self.peaks = np.zeros(capacity, dtype=np.int32)
+        self.rms = np.zeros(capacity, dtype=np.float32)
+        self.times = np.zeros(capacity, dtype=np.float64)    # time.monotonic() when each chunk was published
+        self.head = -1                 # sequence number of the newest chunk
+
+    def __len__(self):
+        return min(self.head + 1, self.size)
+
+    def resize(self, size):
+        self.size = max(1, min(size, self.capacity))
+
+    def oldest(self):
+        """Sequence number of the oldest chunk readers are allowed to ask for"""
+        return max(0, self.head - self.size + 1)
+
+    def publish(self, data, silent=False, peak=0, rms=0.0):
+        """Copies data into the next slot and returns its sequence number"""
+        return self.publish_levels([data], [silent], peak, rms)
+
+    def publish_levels(self, levels, silent, peak=0, rms=0.0):
+        """Like publish with one chunk and silence flag per level.
+        head is moved last so readers never see a half written slot"""
+        sequence = self.head + 1
+        slot = sequence % self.capacity
+        for level, data in enumerate(levels):
+            if len(data) > self.level_sizes[level]:
+                raise ValueError("chunk of {} bytes does not fit level {} slot size {}".format(
+                    len(data), level, self.level_sizes[level]))
+            offset = slot * self.slot_size + int(self.level_offsets[level])
+            self.view[offset:offset + len(data)] = data
+            self.lengths[slot, level] = len(data)
+            self.silent[slot, level] = silent[level]
+        self.peaks[slot] = peak
+        self.rms[slot] = rms
+        self.times[slot] = time.monotonic()
+        self.sequences[slot] = sequence
+        self.head = sequence
+        return sequence
+
+    def get(self, sequence, level=0):
+        """Returns a memoryview of the chunk or None if it is not published yet or already fell out of the ring"""
+        if sequence > self.head or sequence < self.oldest():
+            return None
+        slot = sequence % self.capacity
+        if self.sequences[slot] != sequence:
+            return None
+        offset = slot * self.slot_size + int(self.level_offsets[level])
+        return self.view[offset:offset + int(self.lengths[slot, level])]
+
+    def publish_time(self, sequence):
+        """time.monotonic() at which a chunk still in the ring was published, otherwise None"""
+        if self.get(sequence) is None:
+            return None
+        return float(self.times[sequence % self.capacity])
+
+    def is_silent(self, sequence, level=0):
+        return bool(self.silent[sequence % self.capacity, level])
+
+    def metadata(self, sequence, level=0):
+        """(silent, peak, rms, encoded size) of a chunk still in the ring, otherwise None"""
+        if self.get(sequence) is None:
+            return None
+        slot = sequence % self.capacity
+        return bool(self.silent[slot, level]), int(self.peaks[slot]), float(self.rms[slot]), \
+            int(self.lengths[slot, level])
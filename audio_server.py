@@ -1,60 +1,258 @@
+import os
 import socket
-from threading import Thread
+import select
+import selectors
+from collections import deque
+from threading import Thread, Condition
 import argparse
 import time
 import numpy as np
-import pyaudio
-import audioread
+from audio_devices import pyaudio, PA_INT16, SYNTHETIC_KINDS, require_pyaudio, open_source, PacedStream
+from audio_file import Playlist
+from audio_ring import ChunkRing
+from audio_codecs import ChunkEncoder, LOSSLESS_FRAMES, LOSSLESS_HEADER, chunk_levels
+from audio_protocol import PROTOCOL_VERSION, DEFAULT_WINDOW, V1_MAX_LENGTH, CLIENT_MESSAGE, MSG_ACK, MSG_REGISTER, \
+    MSG_REPAIR, MSG_FEEDBACK, MSG_STREAM, REPAIR_MESSAGE, FLAG_PARAMS, PARAMS_SEQUENCE, parse_options, format_options, \
+    pack_frame, unpack_feedback
+from audio_datagram import FLAG_PARITY, MAX_PARITY_GROUP, ParityEncoder, LossShim, pack_datagrams
+from audio_pipeline import EncodePipeline
+from audio_metrics import Metrics
+
+
+class ClientSession:
+    """Per-client streaming state. Shared by the threaded send loop and the event loop"""
+    def __init__(self, client_socket, address, client_buffer_size=0, magic_enabled=False, protocol_version=1,
+                 window=1):
+        self.socket = client_socket
+        self.address = address
+        self.client_buffer_size = client_buffer_size
+        self.magic_enabled = magic_enabled
+        self.next_sequence = 0         # sequence number of the next chunk to send
+        self.cur_buf_pos = 0           # distance from the newest chunk, 1 being the newest
+        self.sequence = 0              # sequence number of the chunk returned by next_session_chunk
+        self.stream = None             # the AudioServer whose buffer the client reads from, see AudioServer.streams
+        self.options = {}              # key=value fields of the client's hello
+        self.switch_to = None          # index of the stream the client asked to be moved to
+        self.switching = False         # moved, waiting for the client to acknowledge the parameters frame
+        # protocol version 2
+        self.protocol_version = protocol_version
+        self.window = window           # max frames in flight without an ack
+        self.in_flight = deque()       # sequence numbers sent but not acknowledged yet
+        # codec ladder
+        self.levels = [0]              # ladder levels this client can decode, best quality first
+        self.level = 0                 # level it is being sent right now
+        self.send_started = 0.0
+        self.send_time = 0.0           # smoothed seconds it takes to get one chunk out to this client
+        self.lag_mark = 0              # lowest cur_buf_pos since the last level switch
+        self.since_switch = 0          # chunks sent since the last level switch
+        # datagram transport
+        self.transport = "tcp"
+        self.session_id = None
+        self.udp_address = None        # where the client asked for its datagrams
+        self.parity = None             # ParityEncoder when sending fec
+        # latency controller, for clients that report their playout buffer
+        self.client_depth = 0          # chunks in the client's playout buffer
+        self.client_target = None      # depth the client wants to keep, None until it sent feedback
+        self.client_underruns = None
+        self.since_skip = 0            # chunks sent since the last skipped one
+        self.mean_rms = 0.0            # smoothed rms of the chunks sent, a quieter one is a better one to skip
+        self.skipped = 0               # chunks skipped while catching up this time
+        # metrics, created by begin_session
+        self.skipped_total = 0         # chunks this client never got, for whatever reason
+        self.send_seconds = None       # Histogram
+        self.ack_seconds = None        # Histogram
+        self.sent_at = None            # perf_counter of the frames in flight, by number of frames sent
+        self.frames_sent = 0
+        self.frames_acked = 0
+        self.send_done = 0.0           # protocol version 1 in the event loop. chunk written, waiting for "ok"
+        # event loop state
+        self.state = "hello"           # hello -> params -> idle <-> sending -> waiting
+        self.out_data = None           # memoryview of bytes still to be sent
+        self.in_data = bytes()         # partial replies from the client
+        self.expect = None             # 2 byte reply the client has to send next
+        self.pending_chunk = None      # payload waiting for the header echo when using compression
+        self.last_activity = time.time()
 
 
 class AudioServer:
     # noinspection SpellCheckingInspection
-    def __init__(self, filename=None, chunk=2048, audio_format=pyaudio.paInt16, channels=1, rate=44100,
+    def __init__(self, filename=None, chunk=2048, audio_format=PA_INT16, channels=1, rate=44100,
                  bind_address="0.0.0.0", bind_port=1060, audio_buffer_size=102, buffer_size_increment=6,
                  buffer_optimize_time=10, use_compression=0, config_filename="AudioServer_devices.cfg",
-                 configure_devices=False, input_device_index=None, output_device_index=None):
+                 configure_devices=False, input_device_index=None, output_device_index=None,
+                 use_event_loop=False, client_timeout=5, protocol_window=DEFAULT_WINDOW, decimation_factor=2,
+                 silence_threshold=16, cache_dir=None, use_file_cache=True, audio_device="pyaudio",
+                 device_realtime=True, codec_ladder=None, abr_interval=200, udp_fec=0, udp_loss=0.0,
+                 udp_reorder=0.0, multicast_group=None, multicast_port=1061, multicast_ttl=1, encode_workers=0,
+                 latency_margin=2, skip_interval=16, metrics_port=None, metrics_address="127.0.0.1",
+                 metrics_file=None, metrics_interval=10, mid_side=False, streams=None, stream_name="main",
+                 hosted_by=None, loop=False, resume_timeout=30):
         # constants
         self.CHUNK = chunk             # samples per frame
         self.FORMAT = audio_format     # audio format (bytes per sample?)
         self.CHANNELS = channels       # single channel for microphone
         self.RATE = rate               # samples per second
-        self.wave_data = None
-        self.filename = filename
-        self.file_finished = False
+        self.filename = filename       # a file, or a list of them to play one after the other
+        self.file_source = None        # Playlist
+        self.file_clock = None         # paces a file at its sample rate
+        self.live_stream = None        # the device, without a file
+        self.stopped = False           # set by shutdown, ends the buffer thread
+        self.loop = loop
+        self.cache_dir = cache_dir
+        self.use_file_cache = use_file_cache
+        self.audio_device = audio_device         # pyaudio, null, sine, noise, silence, music or wav:<filename>
+        self.device_realtime = device_realtime   # False lets the non pyaudio devices run as fast as they can
         self.host_api_index = None
         self.input_device_index = input_device_index
         self.output_device_index = output_device_index
         self.need_to_configure = False
         self.config_filename = config_filename
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.pyaudio_instance = None
+        # a server can host more streams (streams=), each an AudioServer of its own with its own source, encoders
+        # and buffer. They share this one's listener, datagram socket, event loop, clients and metrics
+        self.stream_name = stream_name
+        self.host_server = self if hosted_by is None else hosted_by
         self.bind_address = bind_address
         self.bind_port = bind_port
-        self.connection.bind((bind_address, bind_port))
-        self.connection.listen(5)
-        self.clients = {}
+        if hosted_by is None:
+            self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.connection.bind((bind_address, bind_port))
+            self.connection.listen(5)
+            # chunks for clients using the datagram transport. the loss shim is only there for testing
+            self.datagram_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.datagram_socket.bind((bind_address, bind_port))
+            if udp_loss > 0 or udp_reorder > 0:
+                self.datagram_socket = LossShim(self.datagram_socket, udp_loss, udp_reorder)
+            self.datagram_sessions = {}    # session id -> ClientSession
+        else:
+            self.connection = hosted_by.connection
+            self.datagram_socket = hosted_by.datagram_socket
+            self.datagram_sessions = hosted_by.datagram_sessions
+        self.udp_fec = udp_fec         # chunks per parity datagram, 0 for none
+        if udp_fec > MAX_PARITY_GROUP:
+            raise ValueError("udp_fec can be at most {}".format(MAX_PARITY_GROUP))
+        # multicast. rolling_buffer sends every chunk once to the group, whatever the number of listeners
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.multicast_socket = None
+        self.multicast_id = self.new_session_id()     # stands in for the session id in multicast datagrams
+        self.multicast_parity = None
+        if multicast_group is not None:
+            self.multicast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+            self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+            if bind_address != "0.0.0.0":
+                self.multicast_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                                 socket.inet_aton(bind_address))
+            if udp_loss > 0 or udp_reorder > 0:
+                self.multicast_socket = LossShim(self.multicast_socket, udp_loss, udp_reorder)
+            self.multicast_parity = ParityEncoder(udp_fec) if udp_fec > 1 else None
+        self.clients = {} if hosted_by is None else hosted_by.clients
+        self.sessions = {}             # address -> ClientSession of every client reading from the buffer
         self.threads = {}
         self.buffer_size = audio_buffer_size
         self.buffer_min_size = audio_buffer_size
         self.buffer_max_size = audio_buffer_size * 2
         self.buffer_size_increment = buffer_size_increment
         self.buffer_optimize_time = buffer_optimize_time * 60
-        self.audio_buffer = []
-        self.buffer_id = -1
+        self.audio_buffer = None       # ChunkRing, created once the stream parameters are known
         self.highest_buffer_pos = 1
-        self.use_compression = use_compression
+        self.deepest_reader = 0        # furthest any client was behind since the buffer size was last checked
+        self.last_fit = time.time()
+        # per client latency control. chunks a client may be behind beyond the depth it says it needs,
+        # and how often one may be skipped to get it back there
+        self.latency_margin = latency_margin
+        self.skip_interval = skip_interval
+        # compression modes every chunk is encoded into, best quality first. clients that can switch move down
+        # the ladder when they fall behind and back up once they keep up. level 0 is what everyone else gets
+        self.codec_ladder = list(codec_ladder) if codec_ladder else [use_compression]
+        self.use_compression = self.codec_ladder[0]
+        self.abr_interval = abr_interval  # chunks a client has to keep up for before it is moved up a level
+        self.decimation_factor = decimation_factor    # used for compression mode 3
+        self.mid_side = mid_side       # compression 4 codes stereo as mid and side where that is smaller
+        self.silence_threshold = silence_threshold    # chunks with a lower rms (int16 units) count as silent
+        self.encoder = None            # ChunkEncoder for every mode of the codec ladder
+        self.encode_workers = encode_workers      # 0 encodes on the buffer thread itself
+        self.encode_pipeline = None
+        self.use_event_loop = use_event_loop
+        self.client_timeout = client_timeout
+        # protocol version 2 clients that lost their connection can pick up where they left off for a while.
+        # token -> (stream name, ladder level, time it expires), kept by the server that accepts connections
+        self.resume_timeout = resume_timeout
+        self.resumable = {}
+        self.protocol_window = protocol_window
+        self.chunk_published = Condition()
+        self.selector = None
+        if hosted_by is None:
+            self.wake_receiver, self.wake_sender = socket.socketpair()
+            self.wake_sender.setblocking(False)
+            self.wake_receiver.setblocking(False)
+        else:
+            self.wake_receiver, self.wake_sender = hosted_by.wake_receiver, hosted_by.wake_sender
 
         # parse command line arguments
         parser = argparse.ArgumentParser(description="Server portion of audio transport")
         parser.add_argument("--configure_devices", default=0, type=int, choices=[0, 1],
                             help="Choose devices on program startup")
-        args = parser.parse_args()
+        parser.add_argument("--use_event_loop", default=0, type=int, choices=[0, 1],
+                            help="Serve all clients from one event loop instead of a thread per client")
+        parser.add_argument("--audio_device", default=None,
+                            help="pyaudio, null, sine, noise, silence, music or wav:<filename>")
+        parser.add_argument("--codec_ladder", default=None,
+                            help="compression modes to encode every chunk into, best first. i.e. 0,5,2")
+        parser.add_argument("--encode_workers", default=None, type=int,
+                            help="processes to encode in, so slow codecs do not hold up capture. 0 for none")
+        parser.add_argument("--channels", default=None, type=int, help="channels to capture, 2 for stereo")
+        parser.add_argument("--mid_side", default=None, type=int, choices=[0, 1],
+                            help="let compression 4 code stereo as mid and side where that takes fewer bytes")
+        parser.add_argument("--metrics_port", default=None, type=int,
+                            help="serve Prometheus metrics on this port, at /metrics and /metrics.json")
+        parser.add_argument("--metrics_file", default=None, help="write a json metrics snapshot to this file")
+        parser.add_argument("--loop", default=None, type=int, choices=[0, 1],
+                            help="in file mode, start over once the file (or the last one) ends")
+        parser.add_argument("--stream", default=[], action="append", metavar="NAME=SOURCE",
+                            help="host another stream. SOURCE is an --audio_device or a file. can be repeated")
+        # known args only, so scripts that build a server (like audio_benchmark.py) can have options of their own.
+        # the command line is meant for the hosting server, not for the streams it hosts
+        args, _ = parser.parse_known_args(None if hosted_by is None else [])
         config_arg = args.configure_devices
         if config_arg == 1 or configure_devices is True:
             self.need_to_configure = True
+        if args.use_event_loop == 1:
+            self.use_event_loop = True
+        if args.audio_device is not None:
+            self.audio_device = args.audio_device
+        if args.codec_ladder is not None:
+            self.codec_ladder = [int(mode) for mode in args.codec_ladder.split(",")]
+            self.use_compression = self.codec_ladder[0]
+        if args.encode_workers is not None:
+            self.encode_workers = args.encode_workers
+        if args.channels is not None:
+            self.CHANNELS = args.channels
+        if args.mid_side is not None:
+            self.mid_side = args.mid_side == 1
+        if args.metrics_port is not None:
+            metrics_port = args.metrics_port
+        if args.metrics_file is not None:
+            metrics_file = args.metrics_file
+        if args.loop is not None:
+            self.loop = args.loop == 1
+        streams = dict(streams) if streams else {}
+        for stream in args.stream:
+            name, source = stream.split("=", 1)
+            is_device = source in ("pyaudio", "null") or source in SYNTHETIC_KINDS or source.startswith("wav:")
+            streams[name] = {"audio_device": source} if is_device else {"filename": source}
 
-        if self.filename is None:
+        if self.filename is None and self.audio_device != "pyaudio":
+            self.live_stream = open_source(self.audio_device, self.CHUNK, self.CHANNELS, self.RATE,
+                                           self.device_realtime)
+            self.CHANNELS = self.live_stream.channels
+            self.RATE = self.live_stream.rate
+            print("using {} input channels={}, samplerate={}".format(self.audio_device, self.CHANNELS, self.RATE))
+        elif self.filename is None:
+            require_pyaudio()
             # read config file and create audio streams
-            live_audio = pyaudio.PyAudio()
+            live_audio = self.audio_interface()
             if self.need_to_configure:
                 self.configure_this_instance(live_audio)
             else:
@@ -92,31 +290,142 @@ class AudioServer:
                 output_device_index=self.output_device_index
              )
         else:
-            self.file_stream = []
-            with audioread.audio_open(self.filename) as f:
-                self.CHANNELS = f.channels
-                self.RATE = f.samplerate
-                print("using file {} channels={}, samplerate={}, duration={} second(s)".format(
-                    self.filename, f.channels, f.samplerate, round(f.duration, 1))
-                )
-                for buf in f:
-                    self.file_stream.append(buf)
-            self.file_data = self.file_data_reader()
-            live_audio = pyaudio.PyAudio()
-            self.live_stream = live_audio.open(
+            self.file_source = Playlist(self.filename, self.CHUNK, self.cache_dir, self.use_file_cache, self.loop)
+            self.CHANNELS = self.file_source.channels
+            self.RATE = self.file_source.samplerate
+            print("using file {} channels={}, samplerate={}, duration={} second(s)".format(
+                self.file_source.filenames[0], self.CHANNELS, self.RATE, round(self.file_source.duration, 1))
+            )
+            # the file plays at its sample rate by the monotonic clock, no sound card needed
+            self.file_clock = PacedStream(self.CHUNK, self.CHANNELS, self.RATE, self.device_realtime)
 
-                format=self.FORMAT,
-                channels=self.CHANNELS,
-                rate=self.RATE,
-                input=True,
-                output=True,
-                frames_per_buffer=self.CHUNK,
-                input_device_index=self.input_device_index,
-                output_device_index=self.input_device_index
-             )
+        # room for buffer_max_size chunks plus one increment so readers at the tail are never overwritten mid send
+        # every slot holds one encoding of the chunk per ladder level
+        self.audio_buffer = ChunkRing(self.buffer_max_size + self.buffer_size_increment,
+                                      [self.max_chunk_bytes(mode) for mode in self.codec_ladder], self.buffer_size)
+        if len(set(self.codec_ladder)) != len(self.codec_ladder):
+            raise ValueError("codec_ladder lists a compression mode twice")
+        if 3 in self.codec_ladder and self.decimation_factor not in (2, 3, 4):
+            raise ValueError("decimation_factor must be 2, 3 or 4")
+        if self.mid_side and (self.CHANNELS != 2 or 4 not in self.codec_ladder):
+            print("mid/side coding is for stereo with compression 4 only. not using it")
+            self.mid_side = False
+        self.encoder = ChunkEncoder(self.CHUNK, self.CHANNELS, self.codec_ladder, self.silence_threshold,
+                                    self.decimation_factor, self.mid_side)
+        # protocol version 1 sends variable size chunks behind a 2 byte length, bigger ones would not fit
+        self.serves_v1 = not self.variable_size_chunks() or self.max_chunk_bytes() <= V1_MAX_LENGTH
+        if not self.serves_v1:
+            print("chunks can be up to {} bytes, more than protocol version 1 can send. only serving protocol "
+                  "version 2 clients".format(self.max_chunk_bytes()))
 
+        # metrics are always kept, they are only served when asked for. see audio_metrics.py
+        # with several streams everything a stream measures is labelled with its name
+        self.metrics = Metrics("audio_server_") if hosted_by is None else hosted_by.metrics
+        self.stream_labels = {"stream": stream_name} if streams or hosted_by is not None else {}
+        self.capture_time = self.metrics.histogram(
+            "capture_seconds", "Time get_next_chunk took to read one chunk from the device or file",
+            **self.stream_labels)
+        self.skipped_chunks = {reason: self.metrics.counter(
+            "skipped_chunks_total", "Chunks clients never got. latency: the latency controller, lagging: fell off "
+            "the end of the buffer, silence: buffer magic", reason=reason, **self.stream_labels)
+            for reason in ("latency", "lagging", "silence")}
+        self.connections = self.metrics.counter("connections_total", "Clients that got through the handshake",
+                                                **self.stream_labels)
+        self.reconnects = self.metrics.counter("reconnects_total",
+                                               "Clients from a host that had been connected before",
+                                               **self.stream_labels)
+        self.resumes = self.metrics.counter("resumes_total", "Clients that picked up their session where it broke off",
+                                            **self.stream_labels)
+        self.seen_hosts = set()
+        self.count_codecs()
+        self.metrics.add_collector(self.collect_metrics)
+        if hosted_by is None:
+            self.metrics.start(metrics_port, metrics_address, metrics_file, metrics_interval)
+
+        if self.encode_workers > 0:
+            self.encode_pipeline = EncodePipeline(self, self.encode_workers)
         print('stream started')
 
+        # name -> AudioServer of every stream, this one first. Clients pick one by name in their hello
+        self.streams = {stream_name: self} if hosted_by is None else hosted_by.streams
+        for name, options in streams.items():
+            if name in self.streams or len(name) == 0 or any(char in name for char in ",/="):
+                raise ValueError("stream names must be unique and can not contain ',', '/' or '='")
+            print("stream {}:".format(name))
+            # the handshake and timeouts are this server's, whatever the stream's options say
+            self.streams[name] = AudioServer(**dict(
+                options, bind_address=bind_address, bind_port=bind_port, client_timeout=client_timeout,
+                protocol_window=protocol_window, resume_timeout=resume_timeout, stream_name=name, hosted_by=self))
+
+    def audio_interface(self):
+        """One PyAudio for the server and every stream it hosts"""
+        if self.host_server.pyaudio_instance is None:
+            self.host_server.pyaudio_instance = pyaudio.PyAudio()
+        return self.host_server.pyaudio_instance
+
+    def count_codecs(self):
+        """Per codec metrics for every level of the ladder"""
+        self.encode_time = {mode: self.metrics.histogram(
+            "encode_seconds", "Time to measure and compress one chunk", codec=mode, **self.stream_labels)
+            for mode in self.codec_ladder}
+        self.sent_bytes = {mode: self.metrics.counter(
+            "sent_bytes_total", "Bytes sent to clients, headers included", codec=mode, **self.stream_labels)
+            for mode in self.codec_ladder}
+        self.sent_chunks = {mode: self.metrics.counter(
+            "sent_chunks_total", "Chunks sent to clients", codec=mode, **self.stream_labels)
+            for mode in self.codec_ladder}
+
+    def count_sent(self, codec, size):
+        self.sent_bytes[codec].inc(size)
+        self.sent_chunks[codec].inc()
+
+    def collect_metrics(self):
+        """Values that are kept anyway, read when the metrics are asked for instead of copied on every chunk"""
+        period = self.CHUNK / self.RATE
+        labels = self.stream_labels
+        samples = [
+            ("buffer_chunks", "gauge", "Chunks in the buffer", labels, len(self.audio_buffer)),
+            ("buffer_size", "gauge", "Chunks the buffer is sized for right now", labels, self.buffer_size),
+            ("clients", "gauge", "Clients reading from the buffer", labels, len(self.sessions)),
+        ]
+        for session in list(self.sessions.values()):
+            labels = dict(self.stream_labels, client=session.address)
+            samples += [
+                ("client_buffer_position", "gauge", "Position of the next chunk a client gets, 1 being the newest",
+                 labels, session.cur_buf_pos),
+                ("client_lag_seconds", "gauge", "How far behind the newest chunk a client is", labels,
+                 max(session.cur_buf_pos - 1, 0) * period),
+                ("client_skipped_chunks_total", "counter", "Chunks a client never got", labels,
+                 session.skipped_total),
+                ("client_codec", "gauge", "Compression mode a client is sent", labels,
+                 self.codec_ladder[session.level]),
+            ]
+            if session.client_target is not None:
+                samples += [
+                    ("client_playout_depth", "gauge", "Chunks in a client's playout buffer, as it reported",
+                     labels, session.client_depth),
+                    ("client_underruns_total", "counter", "Playout buffer underruns a client reported", labels,
+                     session.client_underruns),
+                ]
+        return samples
+
+    def max_chunk_bytes(self, mode=None):
+        """Largest chunk rolling_buffer can publish with the given (or the current) compression mode"""
+        mode = self.use_compression if mode is None else mode
+        raw_bytes = self.CHUNK * self.CHANNELS * 2
+        if mode == 2:
+            # worst case every sample is a turning point: count + coordinates + values, for every channel
+            return (2 * self.CHUNK + 1) * self.CHANNELS * 2
+        elif mode == 4:
+            # channels that do not compress are stored verbatim behind their header
+            return LOSSLESS_FRAMES.size + raw_bytes + LOSSLESS_HEADER.size * self.CHANNELS
+        return raw_bytes
+
+    def variable_size_chunks(self):
+        """Compression modes whose chunk size changes with the audio. Protocol version 1 sends these behind
+        a 2 byte length header the client has to echo"""
+        return self.use_compression in (1, 2, 3, 4)
+
     def configure_this_instance(self, instance):
         print("Listing available APIs")
         host_api_count = instance.get_host_api_count()
@@ -165,21 +474,28 @@ class AudioServer:
         return
 
     def wait_for_connection(self):
-        if "rolling_buffer" not in self.threads.keys():
-            print("starting server buffer thread")
-            self.begin_rolling_buffer()
+        for stream in self.streams.values():
+            if "rolling_buffer" not in stream.threads.keys():
+                print("starting buffer thread for stream {}".format(stream.stream_name) if len(self.streams) > 1
+                      else "starting server buffer thread")
+                stream.begin_rolling_buffer()
         print("audio server running on {}:{}".format(self.bind_address, self.bind_port))
+        if self.use_event_loop:
+            self.run_event_loop()
+            return
+        thread = Thread(target=self.datagram_listener, name="datagram listener", daemon=True)
+        self.threads["datagram_listener"] = thread
+        thread.start()
         while True:
             client_socket, address = self.connection.accept()
-            client_socket.settimeout(5)
+            client_socket.settimeout(self.client_timeout)
             try:
                 msg = client_socket.recv(self.CHUNK)
-                decoded_msg = msg.decode("utf-8").split(sep=",")
                 print("connection received from {}".format(address))
-                if decoded_msg[0] == "AudioClient" and len(decoded_msg) > 1:
-                    print("type is {} with buffer size {}. sending audio parameters".format(decoded_msg[0], decoded_msg[1]))
-                    params = "{},{},{}, {}".format(self.RATE, self.CHUNK, self.CHANNELS, self.use_compression)
-                    client_socket.send(bytes(params, "utf-8"))
+                hello = self.parse_client_hello(msg)
+                stream = self.stream_for(hello[2]) if hello is not None else None
+                if stream is not None:
+                    client_socket.send(bytes(stream.audio_parameters(hello[2]), "utf-8"))
                     msg = client_socket.recv(self.CHUNK)
                     d_msg = ""
                     try:
@@ -187,10 +503,12 @@ class AudioServer:
                     except UnicodeDecodeError as e:
                         print(e)
                     if d_msg == "ok":
-                        print("creating client thread {}".format(address[0]))
-                        self.clients[address[0]] = client_socket
-                        thread = Thread(target=self.send_audio_loop, name=address[0], daemon=True,
-                                        args=(client_socket, address[0], int(decoded_msg[1]), decoded_msg[-1]))
+                        # keyed by ip and port so several clients on one host do not replace each other
+                        client_address = "{}:{}".format(address[0], address[1])
+                        print("creating client thread {}".format(client_address))
+                        self.clients[client_address] = client_socket
+                        thread = Thread(target=stream.send_audio_loop, name=client_address, daemon=True,
+                                        args=(client_socket, client_address) + hello)
                         self.threads[thread.name] = thread
                         thread.start()
                     else:
@@ -198,177 +516,724 @@ class AudioServer:
                         print("received {} {} after sending parameters. closing connection".format(msg, d_msg))
                         client_socket.close()
                 else:
-                    print("invalid identity {}. terminating connection".format(decoded_msg))
                     client_socket.send(bytes("i have nothing for you", "utf-8"))
                     client_socket.close()
             except ConnectionError as e:
                 print("ConnectionError:", e.errno, e.strerror)
                 client_socket.close()
 
+    def parse_client_hello(self, msg):
+        """Checks the identity message sent by a new client.
+        Returns (client_buffer_size, use_magic, options) or None if the client is not one of ours.
+        options holds any key=value fields after the buffer size, i.e. proto and window"""
+        try:
+            decoded_msg = msg.decode("utf-8").split(sep=",")
+        except UnicodeDecodeError:
+            decoded_msg = [str(msg)]
+        if decoded_msg[0] == "AudioClient" and len(decoded_msg) > 1:
+            try:
+                client_buffer_size = int(decoded_msg[1])
+            except ValueError:
+                print("invalid buffer size {}. terminating connection".format(decoded_msg[1]))
+                return None
+            print("type is {} with buffer size {}. sending audio parameters".format(decoded_msg[0], decoded_msg[1]))
+            options = parse_options(decoded_msg[2:])
+            use_magic = options.get("magic", decoded_msg[-1])
+            return client_buffer_size, use_magic, options
+        print("invalid identity {}. terminating connection".format(decoded_msg))
+        return None
+
+    def stream_for(self, options):
+        """The stream a client asked for with stream=<name> in its hello, this server's own if it did not ask.
+        None when there is no such stream or the client can not decode it"""
+        stream = self.streams.get(options.get("stream", self.stream_name))
+        if stream is None:
+            print("no stream named {}. terminating connection".format(options["stream"]))
+        elif stream.mid_side and options.get("ms") != "1":
+            print("client can not decode mid/side stereo. terminating connection")
+            return None
+        elif not stream.serves_v1 and self.negotiate_protocol(options)[0] < 2:
+            print("chunks can be up to {} bytes, more than protocol version 1 can send. terminating "
+                  "connection".format(stream.max_chunk_bytes()))
+            return None
+        return stream
+
+    def audio_parameters(self, options):
+        """Parameters sent to a client after its hello. Version 1 clients get the original positional format"""
+        protocol_version, window = self.negotiate_protocol(options)
+        if protocol_version < 2:
+            params = "{},{},{}, {}".format(self.RATE, self.CHUNK, self.CHANNELS, self.use_compression)
+            if self.use_compression == 3:
+                params += ",{}".format(self.decimation_factor)
+            return params
+        params = {"rate": self.RATE, "chunk": self.CHUNK, "channels": self.CHANNELS,
+                  "compression": self.use_compression, "proto": protocol_version, "window": window}
+        if self.mid_side:
+            params["ms"] = 1
+        if len(self.streams) > 1:
+            params.update({"streams": "/".join(self.streams), "name": self.stream_name})
+        if self.resume_timeout > 0:
+            params["token"] = self.session_token(options)
+        if 3 in self.codec_ladder:
+            params["factor"] = self.decimation_factor
+        levels = self.session_levels(options)
+        if len(levels) > 1:
+            params["ladder"] = "/".join(str(self.codec_ladder[level]) for level in levels)
+        transport = self.session_transport(options)
+        if transport == "tcp" and options.get("feedback") == "1":
+            params["feedback"] = 1
+        if transport != "tcp":
+            # the session id goes back into options, that is where the session picks it up once the client said ok
+            options["session"] = self.new_session_id()
+            params.update({"transport": transport, "session": options["session"],
+                           "udp_port": self.datagram_socket.getsockname()[1], "fec": self.udp_fec})
+        if transport == "multicast":
+            params.update({"group": self.multicast_group, "group_port": self.multicast_port,
+                           "stream": self.multicast_id})
+        return format_options(params)
+
+    def session_token(self, options):
+        """The token a client resumes its session with. Its old one back when the server still has it, a new one
+        otherwise. It goes back into options like the session id, begin_session looks there"""
+        token = options.get("token")
+        if token is not None and token not in self.host_server.resumable:
+            self.drop_stale_session(token)
+        if token not in self.host_server.resumable:
+            token = os.urandom(8).hex()
+            options.pop("seq", None)
+        options["token"] = token
+        return token
+
+    def drop_stale_session(self, token):
+        """A client can be back before the server noticed its old connection died, which may take until a send
+        times out. The old session makes way and can be resumed right away"""
+        for stream in self.streams.values():
+            for session in list(stream.sessions.values()):
+                if session.options.get("token") == token and stream.sessions.pop(session.address, None) is not None:
+                    print("{} is back on another connection. dropping the old one".format(session.address))
+                    stream.keep_resumable(session)
+                    try:
+                        session.socket.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+
+    def keep_resumable(self, session):
+        """Remembers a protocol version 2 session for resume_timeout seconds after its connection dropped"""
+        token = session.options.get("token")
+        if token is None or session.protocol_version < 2:
+            return
+        now = time.time()
+        resumable = self.host_server.resumable
+        for expired in [token for token, kept in list(resumable.items()) if kept[2] < now]:
+            resumable.pop(expired, None)
+        resumable[token] = (self.stream_name, session.level, now + self.resume_timeout)
+
+    def resume_session(self, session):
+        """Places a client that came back with its token right after the last chunk it received (seq= in its
+        hello), as long as that chunk is still in the buffer. The chunks it has buffered keep playing meanwhile,
+        so a short drop costs nothing but the reconnect. Returns False for everyone else"""
+        kept = self.host_server.resumable.pop(session.options.get("token"), None)
+        if kept is None or kept[0] != self.stream_name or kept[2] < time.time() or "seq" not in session.options:
+            return False
+        try:
+            sequence = int(session.options["seq"]) + 1
+        except ValueError:
+            return False
+        if not self.audio_buffer.oldest() <= sequence <= self.audio_buffer.head + 1:
+            print("{} came back too late to resume, chunk {} is gone".format(session.address, sequence))
+            return False
+        session.next_sequence = sequence
+        session.cur_buf_pos = self.audio_buffer.head - sequence + 1
+        session.lag_mark = session.cur_buf_pos
+        session.level = kept[1] if kept[1] in session.levels else 0
+        self.resumes.inc()
+        print("{} resumed its session at buffer position {}".format(session.address, session.cur_buf_pos))
+        return True
+
+    def negotiate_protocol(self, options):
+        try:
+            protocol_version = min(int(options.get("proto", 1)), PROTOCOL_VERSION)
+            window = min(max(int(options.get("window", 1)), 1), self.protocol_window)
+        except ValueError:
+            print("invalid protocol options {}. falling back to version 1".format(options))
+            return 1, 1
+        return protocol_version, window if protocol_version >= 2 else 1
+
+    def session_transport(self, options):
+        """udp or multicast for protocol version 2 clients that asked for it, tcp for everyone else.
+        Multicast needs a multicast_group on the server"""
+        protocol_version, _ = self.negotiate_protocol(options)
+        transport = options.get("transport")
+        if protocol_version < 2 or transport not in ("udp", "multicast"):
+            return "tcp"
+        if transport == "multicast" and self.multicast_group is None:
+            return "tcp"
+        return transport
+
+    def new_session_id(self):
+        while True:
+            session_id = int.from_bytes(os.urandom(4), "little")
+            if session_id not in self.datagram_sessions:
+                return session_id
+
+    def begin_datagram_session(self, session, options):
+        """Sets a session up for the datagram transport. Buffer magic stays off, the client would take the
+        skipped sequence numbers for lost datagrams. Multicast sessions only use theirs to ask for repairs"""
+        session.transport = self.session_transport(options)
+        session.session_id = int(options["session"])
+        session.magic_enabled = False
+        session.parity = ParityEncoder(self.udp_fec) if self.udp_fec > 1 else None
+        self.datagram_sessions[session.session_id] = session
+
+    def session_levels(self, options):
+        """Ladder levels a client may be switched between. Only protocol version 2 clients that list the codecs
+        they can decode (codecs=0/1/2 in their hello) get more than level 0"""
+        protocol_version, _ = self.negotiate_protocol(options)
+        if protocol_version < 2 or "codecs" not in options:
+            return [0]
+        try:
+            codecs = [int(codec) for codec in options["codecs"].split("/")]
+        except ValueError:
+            print("invalid codec list {}. sticking to compression {}".format(options["codecs"], self.use_compression))
+            return [0]
+        return [0] + [level for level, mode in enumerate(self.codec_ladder) if level > 0 and mode in codecs]
+
+    def run_event_loop(self):
+        """Serves every client from one selectors loop instead of a thread per client.
+        rolling_buffer wakes the loop through self.wake_sender whenever a new chunk is published"""
+        self.selector = selectors.DefaultSelector()
+        self.connection.setblocking(False)
+        self.selector.register(self.connection, selectors.EVENT_READ, None)
+        self.selector.register(self.wake_receiver, selectors.EVENT_READ, None)
+        self.datagram_socket.setblocking(False)
+        self.selector.register(self.datagram_socket, selectors.EVENT_READ, None)
+        # sessions are handled by the stream they read from, which needs the loop to queue data and wake it
+        for stream in self.streams.values():
+            stream.selector = self.selector
+        sessions = {}
+        last_timeout_check = time.time()
+        while True:
+            for key, events in self.selector.select(timeout=1):
+                if key.fileobj is self.connection:
+                    self.accept_session(sessions)
+                elif key.fileobj is self.wake_receiver:
+                    try:
+                        while self.wake_receiver.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj is self.datagram_socket:
+                    while self.datagram_readable():
+                        pass
+                else:
+                    session = key.data
+                    if session.address not in sessions:
+                        continue
+                    if events & selectors.EVENT_READ:
+                        session.stream.session_readable(session, sessions)
+                    if events & selectors.EVENT_WRITE and session.address in sessions:
+                        session.stream.session_writable(session, sessions)
+            # every idle client that has caught up gets the chunk that was just published
+            for session in list(sessions.values()):
+                if session.state == "idle":
+                    session.stream.start_session_send(session, sessions)
+                elif session.state == "datagram":
+                    session.stream.send_session_datagrams(session)
+            if time.time() - last_timeout_check > 1:
+                last_timeout_check = time.time()
+                for session in list(sessions.values()):
+                    if session.state == "multicast":
+                        waiting = False
+                    elif session.state == "datagram":
+                        # the tcp connection stays quiet. only a client that never registered is waited on
+                        waiting = session.udp_address is None
+                    else:
+                        waiting = session.state != "idle" or len(session.in_flight) > 0
+                    if waiting and time.time() - session.last_activity > self.client_timeout:
+                        print("{} socket timeout".format(session.address))
+                        session.stream.end_session(session, sessions)
+
+    def accept_session(self, sessions):
+        try:
+            client_socket, address = self.connection.accept()
+        except BlockingIOError:
+            return
+        print("connection received from {}".format(address))
+        client_socket.setblocking(False)
+        # keyed by ip and port so several clients behind one address can share the loop
+        session = ClientSession(client_socket, "{}:{}".format(address[0], address[1]))
+        session.stream = self
+        sessions[session.address] = session
+        self.selector.register(client_socket, selectors.EVENT_READ, session)
+
+    def session_readable(self, session, sessions):
+        try:
+            msg = session.socket.recv(self.CHUNK)
+            if len(msg) == 0:
+                raise ConnectionError("client closed the connection")
+        except BlockingIOError:
+            return
+        except ConnectionError as e:
+            print(session.address, e)
+            self.end_session(session, sessions)
+            return
+        session.last_activity = time.time()
+        if session.state == "hello":
+            hello = self.parse_client_hello(msg)
+            stream = self.stream_for(hello[2]) if hello is not None else None
+            if stream is None:
+                self.queue_session_data(session, bytes("i have nothing for you", "utf-8"))
+                session.state = "rejected"
+                return
+            # from here on the session is handled by the stream it asked for
+            session.stream = stream
+            session.options = hello[2]
+            session.client_buffer_size = hello[0]
+            session.magic_enabled = True if hello[1] == "true" else False
+            session.protocol_version, session.window = stream.negotiate_protocol(hello[2])
+            session.levels = stream.session_levels(hello[2])
+            session.state = "params"
+            stream.queue_session_data(session, bytes(stream.audio_parameters(hello[2]), "utf-8"))
+            if stream.session_transport(hello[2]) != "tcp":
+                stream.begin_datagram_session(session, hello[2])
+            return
+        if session.state == "params":
+            if msg != b"ok":
+                print("received {} after sending parameters. closing connection".format(msg))
+                self.end_session(session, sessions)
+                return
+            print("client {} added to event loop".format(session.address))
+            self.clients[session.address] = session.socket
+            self.begin_session(session)
+            if session.transport == "udp":
+                session.state = "datagram"
+                return
+            if session.transport == "multicast":
+                session.state = "multicast"
+                return
+            session.state = "idle"
+            self.start_session_send(session, sessions)
+            return
+        if session.state in ("datagram", "multicast"):
+            # nothing is expected over tcp anymore
+            return
+        if session.protocol_version >= 2:
+            session.in_data += msg
+            try:
+                self.handle_client_messages(session)
+            except ConnectionError as e:
+                print(session.address, e)
+                self.end_session(session, sessions)
+                return
+            if session.state == "idle":
+                self.start_session_send(session, sessions)
+            return
+        # streaming. every reply from the client is 2 bytes, either "ok" or the echoed header
+        session.in_data += msg
+        while len(session.in_data) >= 2 and session.expect is not None:
+            reply, session.in_data = session.in_data[:2], session.in_data[2:]
+            if reply != session.expect:
+                if session.expect == b"ok":
+                    print("client said '{}' so ending audio loop".format(reply))
+                else:
+                    print("client responded to data size {} with {}".format(session.expect, reply))
+                self.end_session(session, sessions)
+                return
+            if session.pending_chunk is not None:
+                chunk, session.pending_chunk = session.pending_chunk, None
+                session.expect = None
+                self.queue_session_data(session, chunk, expect=b"ok")
+            else:
+                session.expect = None
+                session.ack_seconds.observe(time.perf_counter() - session.send_done)
+                self.advance_session(session)
+                self.adapt_level(session, time.time() - session.send_started)
+                session.state = "idle"
+                self.start_session_send(session, sessions)
+
+    def session_writable(self, session, sessions):
+        try:
+            sent = session.socket.send(session.out_data)
+        except BlockingIOError:
+            return
+        except ConnectionError as e:
+            print(session.address, e)
+            self.end_session(session, sessions)
+            return
+        session.last_activity = time.time()
+        session.out_data = session.out_data[sent:]
+        if len(session.out_data) == 0:
+            session.out_data = None
+            self.selector.modify(session.socket, selectors.EVENT_READ, session)
+            if session.state == "rejected":
+                self.end_session(session, sessions)
+            elif session.state == "sending" and session.protocol_version >= 2:
+                session.send_seconds.observe(time.time() - session.send_started)
+                self.adapt_level(session, time.time() - session.send_started)
+                session.state = "idle"
+                self.start_session_send(session, sessions)
+            elif session.state == "sending":
+                if session.pending_chunk is None:
+                    # the chunk itself went out, not the length header
+                    session.send_seconds.observe(time.time() - session.send_started)
+                    session.send_done = time.perf_counter()
+                session.state = "waiting"
+
+    def queue_session_data(self, session, data, expect=None):
+        session.out_data = memoryview(data)
+        session.expect = expect
+        session.last_activity = time.time()
+        if session.state in ("idle", "waiting"):
+            session.state = "sending"
+        self.selector.modify(session.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+
+    def start_session_send(self, session, sessions):
+        if session.switch_to is not None:
+            frame = self.switch_session(session)
+            if frame is not None:
+                # the new stream sends the chunks from here on
+                self.queue_session_data(session, frame)
+                return
+        if session.protocol_version >= 2 and len(session.in_flight) >= session.window:
+            return
+        next_chunk = self.next_session_chunk(session)
+        if next_chunk is None:
+            return
+        session.send_started = time.time()
+        codec = self.codec_ladder[session.level]
+        if session.protocol_version >= 2:
+            frame = pack_frame(session.sequence, codec, next_chunk)
+            self.queue_session_data(session, frame)
+            self.count_sent(codec, len(frame))
+            self.frame_sent(session)
+            self.advance_session(session)
+        elif self.variable_size_chunks():
+            header = len(next_chunk).to_bytes(2, "little", signed=True)
+            session.pending_chunk = next_chunk
+            self.queue_session_data(session, header, expect=header)
+            self.count_sent(codec, len(header) + len(next_chunk))
+        else:
+            self.queue_session_data(session, next_chunk, expect=b"ok")
+            self.count_sent(codec, len(next_chunk))
+
+    def end_session(self, session, sessions):
+        try:
+            self.selector.unregister(session.socket)
+        except (KeyError, ValueError):
+            pass
+        sessions.pop(session.address, None)
+        if self.sessions.pop(session.address, None) is not None:
+            self.keep_resumable(session)
+        self.datagram_sessions.pop(session.session_id, None)
+        if session.address in self.clients:
+            self.close_connection(session.socket, session.address)
+        else:
+            session.socket.close()
+
+    def notify_new_chunk(self):
+        with self.chunk_published:
+            self.chunk_published.notify_all()
+        if self.selector is not None:
+            try:
+                self.wake_sender.send(b"\x00")
+            except BlockingIOError:
+                # the loop has not drained the previous wake ups yet, it will see this chunk anyway
+                pass
+
     def begin_rolling_buffer(self):
+        """Starts the buffer thread and returns as soon as the first chunk is in. Clients get in from then on and
+        start close to live while the rest of the buffer fills up behind them"""
         thread = Thread(target=self.rolling_buffer, name="rolling buffer", daemon=True)
         self.threads["rolling_buffer"] = thread
         thread.start()
-        while len(self.audio_buffer) < self.buffer_size:
-            pass
+        with self.chunk_published:
+            self.chunk_published.wait_for(lambda: len(self.audio_buffer) > 0)
 
     def rolling_buffer(self):
         print("pre-filling audio buffer")
-        while len(self.audio_buffer) < self.buffer_size:
-            next_chunk = self.get_next_chunk()
-            next_chunk = self.compress_data(next_chunk) if self.use_compression > 0 else next_chunk
-            self.audio_buffer.append(next_chunk)
-            self.buffer_id += 1
-        print("buffer pre-fill complete - ready for connections")
+        filled = False
         last_buffer_optimize = time.time()
-        while True:
-            next_chunk = self.get_next_chunk()
-            next_chunk = self.compress_data(next_chunk) if self.use_compression > 0 else next_chunk
-            self.audio_buffer.append(next_chunk)
-            if len(self.audio_buffer) > self.buffer_size:
-                self.audio_buffer = self.audio_buffer[-self.buffer_size:]
-            self.buffer_id += 1
+        while not self.stopped:
+            self.publish_next_chunk()
+            if not filled and len(self.audio_buffer) >= self.buffer_size:
+                print("buffer pre-fill complete")
+                filled = True
+            self.fit_ring()
             if time.time() - last_buffer_optimize > self.buffer_optimize_time:
-                if self.buffer_size > self.buffer_min_size \
-                        and self.highest_buffer_pos < len(self.audio_buffer) - self.buffer_size_increment:
-                    self.buffer_size -= self.buffer_size_increment
-                    print("max load {} / {}. dropping size to {}".format(self.highest_buffer_pos,
-                                                                         len(self.audio_buffer), self.buffer_size))
-                elif len(self.clients) > 0:
+                if len(self.clients) > 0:
                     print("max load {} / {}".format(self.highest_buffer_pos, len(self.audio_buffer)))
                 last_buffer_optimize = time.time()
                 self.highest_buffer_pos = 1
 
-    def compress_data(self, data):
-        if self.use_compression == 1:
-            return self.compress_interpolate(data)
-        elif self.use_compression == 2:
-            return self.compress_data_fill(data)
+    def fit_ring(self):
+        """Sizes the buffer to the slowest client still reading from it, never below the size it started with.
+        Grows as soon as a client gets within a buffer increment of the tail. Shrinks once the slowest client
+        stayed well clear of the tail for a few seconds, or left, so one slow client no longer keeps the buffer
+        (and everyone's start position) big for good"""
+        # multicast sessions only read from the buffer for repairs, which are always recent
+        deepest = max((self.audio_buffer.head - session.next_sequence + 1 for session in list(self.sessions.values())
+                       if session.transport != "multicast"), default=0)
+        self.deepest_reader = max(self.deepest_reader, deepest)
+        if deepest + self.buffer_size_increment > self.buffer_size and self.buffer_size < self.buffer_max_size:
+            self.buffer_size = min(max(deepest, self.buffer_size) + self.buffer_size_increment, self.buffer_max_size)
+            print("a client is {} chunks behind. increasing server buffer to {}".format(deepest, self.buffer_size))
+            self.audio_buffer.resize(self.buffer_size)
+        if time.time() - self.last_fit < 3:
+            return
+        slowest, self.deepest_reader = self.deepest_reader, 0
+        self.last_fit = time.time()
+        needed = slowest + self.buffer_size_increment
+        if needed < self.buffer_size - self.buffer_size_increment and self.buffer_size > self.buffer_min_size:
+            self.buffer_size = max(needed, self.buffer_min_size)
+            print("slowest client {} chunks behind. dropping server buffer to {}".format(slowest, self.buffer_size))
+            self.audio_buffer.resize(self.buffer_size)
 
-    @staticmethod
-    def compress_interpolate(data):
-        if data is None:
-            return data
-        data = np.frombuffer(data, dtype=np.int16)
-        data_value = np.sum(data)
-        if 5 > data_value > -5:
-            return bytes(2)
-        condition = []
-        for _ in range(len(data) // 2):
-            condition += [True, False]
-        new_data = data[condition].tobytes()
-        return new_data
+    def publish_next_chunk(self):
+        """Reads, measures, compresses and publishes one chunk. Encoded once per ladder level however many
+        clients are listening. With encode_workers this only reads, the pipeline does the rest"""
+        started = time.perf_counter()
+        next_chunk = self.get_next_chunk()
+        self.capture_time.observe(time.perf_counter() - started)
+        if self.encode_pipeline is not None:
+            if self.encode_pipeline.submit(next_chunk):
+                return
+            self.encode_pipeline = None
+        self.publish_chunk(next_chunk)
 
-    @staticmethod
-    def compress_data_fill(data):
+    def publish_chunk(self, next_chunk):
+        """Compresses one pcm chunk into every ladder level and publishes it. Peak and rms are measured once,
+        only what counts as silent depends on the level"""
+        levels = []
+        silent_levels = []
+        peak, rms = chunk_levels(next_chunk)
+        for mode in self.codec_ladder:
+            started = time.perf_counter()
+            silent = self.is_silent(peak, rms, len(next_chunk), mode)
+            levels.append(self.compress_data(next_chunk, silent, mode) if mode > 0 else next_chunk)
+            silent_levels.append(silent)
+            self.encode_time[mode].observe(time.perf_counter() - started)
+        self.publish_encoded(levels, silent_levels, peak, rms)
+
+    def publish_encoded(self, levels, silent_levels, peak, rms):
+        """Makes one encoded chunk visible to the senders"""
+        sequence = self.audio_buffer.publish_levels(levels, silent_levels, peak, rms)
+        if self.multicast_socket is not None:
+            self.send_multicast(sequence)
+        self.notify_new_chunk()
+
+    def chunk_metadata(self, data, mode=None):
+        """silence flag, peak and rms of a pcm chunk. Computed once here so send loops never touch the samples.
+        Lossless mode only calls pure digital silence silent, anything else must reach the client untouched"""
+        peak, rms = chunk_levels(data)
+        return self.is_silent(peak, rms, len(data), mode), peak, rms
+
+    def is_silent(self, peak, rms, length, mode=None):
+        """Whether a chunk with this peak and rms goes out as the silence marker at the given compression mode"""
+        return self.encoder.is_silent(peak, rms, length, self.use_compression if mode is None else mode)
+
+    def compress_data(self, data, silent=False, mode=None):
+        """Silent chunks are sent as the 2 byte silence marker. The stateful encoders still get to see them"""
         if data is None:
             return data
-        data = np.frombuffer(data, dtype=np.int16)
-        data_value = np.sum(data)
-        if 5 > data_value > -5:
-            return bytes(2)
-        total_data_cords = 0
-        data_cords = []
-        new_data = []
-        direction = 1 if data[1] >= data[0] else -1
-        matching_values = False
-        last_value = None
-        for cursor, value in enumerate(data):
-            if cursor == 0:
-                new_data.append(value)
-                data_cords.append(cursor)
-                total_data_cords += 1
-            elif cursor == len(data) - 1:
-                new_data.append(value)
-                data_cords.append(cursor)
-                total_data_cords += 1
-            elif value < last_value and direction == 1:
-                new_data.append(data[cursor-1])
-                data_cords.append(cursor-1)
-                total_data_cords += 1
-                direction = -1
-            elif value > last_value and direction == -1:
-                new_data.append(data[cursor-1])
-                data_cords.append(cursor-1)
-                total_data_cords += 1
-                direction = 1
-            elif value == last_value:
-                if not matching_values:
-                    matching_values = True
-                    new_data.append(value)
-                    data_cords.append(cursor - 1)
-                    total_data_cords += 1
-                elif data[cursor + 1] != value:
-                    matching_values = False
-                    new_data.append(value)
-                    data_cords.append(cursor)
-                    total_data_cords += 1
-                    direction = 1 if data[cursor + 1] >= value else -1
-            last_value = value
-        if len(data_cords) != len(new_data):
-            print("compress error. tot cords {} len cords {} len data {}".format(total_data_cords, len(data_cords),
-                                                                                 len(new_data)))
-        new_data = [total_data_cords] + data_cords + new_data
-        byte_data = np.array(new_data, dtype=np.int16).tobytes()
-        return byte_data
-
-    def send_audio_loop(self, client_socket, address, client_buffer_size, use_magic):
+        return self.encoder.encode(data, silent, self.use_compression if mode is None else mode)
+
+    def begin_session(self, session):
+        """Places a new client in the buffer according to the buffer size it asked for, or where it left off when
+        it resumed its session"""
+        if session.switching or not self.resume_session(session):
+            start_pos = session.client_buffer_size \
+                if session.client_buffer_size < len(self.audio_buffer) - self.buffer_size_increment \
+                else len(self.audio_buffer) - self.buffer_size_increment
+            start_pos = max(start_pos, 1)
+            if session.transport == "udp":
+                # the backlog goes out in one burst, keep it small enough for the client's socket buffer
+                start_pos = min(start_pos, session.window)
+            session.next_sequence = self.audio_buffer.head - start_pos + 1
+            session.cur_buf_pos = start_pos
+            session.lag_mark = start_pos
+        session.sent_at = [0.0] * session.window
+        session.send_seconds = self.metrics.histogram(
+            "client_send_seconds", "Time to hand one chunk to a client's connection", client=session.address,
+            **self.stream_labels)
+        session.ack_seconds = self.metrics.histogram(
+            "client_ack_seconds", "Time from a chunk going out until the client acknowledged it",
+            client=session.address, **self.stream_labels)
+        if not session.switching:
+            self.connections.inc()
+            host = session.address.rsplit(":", 1)[0]
+            if host in self.seen_hosts:
+                self.reconnects.inc()
+            self.seen_hosts.add(host)
+        self.sessions[session.address] = session
+        print("client starting at buffer position", session.cur_buf_pos)
+
+    def next_session_chunk(self, session):
+        """Returns the chunk the client should get next, or None when it has caught up with rolling_buffer"""
+        next_chunk = None
+        while next_chunk is None:
+            head = self.audio_buffer.head
+            if session.next_sequence > head:
+                return None
+            if session.next_sequence < self.audio_buffer.oldest():
+                # fit_ring could not grow the buffer fast enough, or it is at max
+                skipped = self.audio_buffer.oldest() - session.next_sequence
+                self.skipped_chunks["lagging"].inc(skipped)
+                session.skipped_total += skipped
+                session.next_sequence = self.audio_buffer.oldest()
+                print("{} is lagging. skipped ahead to the oldest chunk (server buffer {})".format(
+                    session.address, self.buffer_size))
+            # None when rolling_buffer moved the tail past us in the meantime. go around again
+            next_chunk = self.audio_buffer.get(session.next_sequence, session.level)
+        session.cur_buf_pos = head - session.next_sequence + 1
+        if self.control_latency(session):
+            next_chunk = self.audio_buffer.get(session.next_sequence, session.level)
+
+        # funky buffer magic to help clients stay away from end of buffer
+        moved_positions = 0
+        if session.magic_enabled is True:
+            while self.audio_buffer.is_silent(session.next_sequence, session.level) and session.cur_buf_pos > 2:
+                following_chunk = self.audio_buffer.get(session.next_sequence + 1, session.level)
+                if following_chunk is None:
+                    break
+                session.next_sequence += 1
+                session.cur_buf_pos -= 1
+                moved_positions += 1
+                next_chunk = following_chunk
+            if self.audio_buffer.is_silent(session.next_sequence, session.level):
+                next_chunk = bytes(2)
+        if moved_positions > 0:
+            self.skipped_chunks["silence"].inc(moved_positions)
+            session.skipped_total += moved_positions
+        if moved_positions > 1:
+            print("{} buffer move {} -> {} ({})".format(session.address, session.cur_buf_pos + moved_positions,
+                                                        session.cur_buf_pos, moved_positions))
+        # end buffer magic
+        session.sequence = session.next_sequence
+        return next_chunk
+
+    def control_latency(self, session):
+        """Per client latency controller, for clients that report their playout buffer (protocol version 2 over
+        tcp). The chunks waiting here for a client plus what it has buffered is its latency. While that is more
+        than latency_margin chunks above the depth the client says it needs, one chunk every skip_interval is
+        skipped, preferably a quiet one, and more often the further over it is. A new underrun on the client holds
+        skipping off for a while.
+        Returns True when the next chunk was skipped"""
+        if session.client_target is None:
+            return False
+        metadata = self.audio_buffer.metadata(session.next_sequence, session.level)
+        if metadata is None:
+            return False
+        rms = metadata[2]
+        session.mean_rms += (rms - session.mean_rms) / 32
+        session.since_skip += 1
+        excess = session.cur_buf_pos - 1 + session.client_depth - session.client_target - self.latency_margin
+        if excess <= 0:
+            if session.skipped > 0:
+                print("{} back within its latency target, {} chunk(s) skipped".format(session.address,
+                                                                                       session.skipped))
+                session.skipped = 0
+            return False
+        # the further behind, the more often. the chunk after has to be published already and a loud one only goes
+        # when no quiet one came along for a while
+        interval = max(2, self.skip_interval * self.latency_margin // excess)
+        if session.cur_buf_pos < 2 or session.since_skip < interval \
+                or (rms > session.mean_rms and session.since_skip < 4 * interval):
+            return False
+        if session.skipped == 0:
+            print("{} is {} chunk(s) over its latency target. skipping ahead".format(session.address, excess))
+        session.next_sequence += 1
+        session.cur_buf_pos -= 1
+        session.since_skip = 0
+        session.skipped += 1
+        session.skipped_total += 1
+        self.skipped_chunks["latency"].inc()
+        return True
+
+    def advance_session(self, session):
+        """Called once the chunk from next_session_chunk went out (or was acknowledged with protocol version 1)"""
+        session.next_sequence = session.sequence + 1
+        session.cur_buf_pos = self.audio_buffer.head - session.next_sequence + 1
+        if session.cur_buf_pos > self.highest_buffer_pos:
+            self.highest_buffer_pos = session.cur_buf_pos if session.cur_buf_pos <= self.buffer_size \
+                else self.buffer_size
+
+    def adapt_level(self, session, send_time):
+        """Moves a client along the codec ladder once a chunk went out. Sends taking more than half a chunk period
+        or a client falling further behind (cur_buf_pos growing by a buffer increment) step it down to a cheaper
+        level. Fast sends while keeping up for abr_interval chunks step it back up"""
+        if len(session.levels) < 2:
+            return
+        period = self.CHUNK / self.RATE
+        session.send_time += (send_time - session.send_time) / 8
+        session.since_switch += 1
+        session.lag_mark = min(session.lag_mark, session.cur_buf_pos)
+        position = session.levels.index(session.level)
+        falling_behind = session.cur_buf_pos > session.lag_mark + self.buffer_size_increment
+        if (session.send_time > period / 2 or falling_behind) and position < len(session.levels) - 1 \
+                and session.since_switch >= 8:
+            level = session.levels[position + 1]
+        elif session.send_time < period / 10 and session.cur_buf_pos <= session.lag_mark + 1 and position > 0 \
+                and session.since_switch >= self.abr_interval:
+            level = session.levels[position - 1]
+        else:
+            return
+        print("{} switching from compression {} to {} (send time {} ms, buffer position {})".format(
+            session.address, self.codec_ladder[session.level], self.codec_ladder[level],
+            round(session.send_time * 1000, 1), session.cur_buf_pos))
+        session.level = level
+        session.since_switch = 0
+        session.lag_mark = session.cur_buf_pos
+
+    def send_audio_loop(self, client_socket, address, client_buffer_size, use_magic, options=None):
         magic_enabled = True if use_magic == "true" else False
+        protocol_version, window = self.negotiate_protocol(options if options is not None else {})
+        session = ClientSession(client_socket, address, client_buffer_size, magic_enabled, protocol_version, window)
+        session.stream = self
+        session.options = options if options is not None else {}
+        session.levels = self.session_levels(session.options)
+        transport = self.session_transport(options if options is not None else {})
+        if transport != "tcp":
+            self.begin_datagram_session(session, options)
+            self.begin_session(session)
+            if transport == "multicast":
+                self.watch_multicast_session(session)
+            else:
+                self.send_datagrams_loop(session)
+            return
+        self.begin_session(session)
+        if session.protocol_version >= 2:
+            # returns True when the client was moved to another stream, which carries on
+            while session.stream.send_frames_loop(session):
+                pass
+            return
         done = False
-        current_buffer_id = self.buffer_id - client_buffer_size
-        cur_buf_pos = client_buffer_size if client_buffer_size < len(self.audio_buffer) - self.buffer_size_increment \
-            else len(self.audio_buffer) - self.buffer_size_increment
-        print("client starting at buffer position", cur_buf_pos)
         while not done:
             try:
-                if cur_buf_pos < 1:
-                    cur_buf_pos = 1
-                    current_buffer_id = self.buffer_id
-                elif cur_buf_pos > len(self.audio_buffer):
-                    cur_buf_pos = len(self.audio_buffer)
-                    current_buffer_id = self.buffer_id - len(self.audio_buffer)
-                    if self.buffer_size + self.buffer_size_increment <= self.buffer_max_size:
-                        self.buffer_size += self.buffer_size_increment
-                        print("{} is lagging. increasing server buffer to {}".format(address, self.buffer_size))
-                    else:
-                        print("{} is lagging but server buffer is at max ({})".format(address, self.buffer_size))
-
-                next_chunk = self.audio_buffer[-cur_buf_pos]
-
-                # funky buffer magic to help clients stay away from end of buffer
-                have_next_chunk = False
-                moved_positions = 0
-                while have_next_chunk is False:
-                    if ((self.use_compression == 0 and sum(next_chunk) < 5)
-                            or self.use_compression > 0 and next_chunk == bytes(2))\
-                            and cur_buf_pos > 2 and magic_enabled is True:
-                        cur_buf_pos -= 1
-                        current_buffer_id += 1
-                        moved_positions += 1
-                        next_chunk = self.audio_buffer[-cur_buf_pos]
-                    else:
-                        have_next_chunk = True
-                        if ((self.use_compression == 0 and sum(next_chunk) < 5)
-                                or self.use_compression > 0 and next_chunk == bytes(2)) and magic_enabled is True:
-                            next_chunk = bytes(2)
-                if moved_positions > 1:
-                    print("{} buffer move {} -> {} ({})".format(address, cur_buf_pos + moved_positions, cur_buf_pos,
-                                                                moved_positions))
-                # end buffer magic
+                next_chunk = self.next_session_chunk(session)
+                if next_chunk is None:
+                    # caught up with the server. wait for rolling_buffer to publish the next chunk
+                    with self.chunk_published:
+                        self.chunk_published.wait_for(
+                            lambda: self.audio_buffer.head >= session.next_sequence, timeout=1)
+                    continue
 
+                session.send_started = time.time()
                 header = None
-                if self.use_compression > 0:
+                if self.variable_size_chunks():
                     header = len(next_chunk).to_bytes(2, "little", signed=True)
                     client_socket.send(header)
                     msg = client_socket.recv(2)
                     if msg != header:
                         raise ConnectionError("client responded to data size {} with {}".format(header, msg))
-                client_socket.send(next_chunk)
+                started = time.perf_counter()
+                client_socket.sendall(next_chunk)
+                sent = time.perf_counter()
                 msg = client_socket.recv(self.CHUNK)
-                current_buffer_id += 1
-                cur_buf_pos = (self.buffer_id - current_buffer_id) + 1
-                if cur_buf_pos > self.highest_buffer_pos:
-                    self.highest_buffer_pos = cur_buf_pos if cur_buf_pos <= self.buffer_size else self.buffer_size
+                session.send_seconds.observe(sent - started)
+                session.ack_seconds.observe(time.perf_counter() - sent)
+                self.count_sent(self.codec_ladder[session.level], len(next_chunk) + (2 if header else 0))
+                self.advance_session(session)
+                self.adapt_level(session, time.time() - session.send_started)
             except (ConnectionError, socket.timeout) as e:
                 done = True
                 if type(e) == ConnectionError:
@@ -381,7 +1246,7 @@ class AudioServer:
                     decoded_msg = msg.decode("utf-8")
                 except UnicodeDecodeError:
                     print("error decoding client msg after sent data. client sent {} instead of ok".format(msg))
-                    if self.use_compression > 0 and msg == header:
+                    if self.variable_size_chunks() and msg == header:
                         print("that response matches the sent header")
                 else:
                     if decoded_msg != "ok":
@@ -389,7 +1254,261 @@ class AudioServer:
                         self.close_connection(client_socket, address)
                         done = True
 
+    def send_frames_loop(self, session):
+        """Protocol version 2 send loop. Keeps up to session.window frames in flight
+        and only blocks on the client when the window is full. Returns True once the client switched streams"""
+        while True:
+            try:
+                # a full window counts towards the send time. it means the client is not keeping up
+                session.send_started = time.time()
+                while len(session.in_flight) >= session.window:
+                    self.receive_client_messages(session)
+                if session.switch_to is not None:
+                    frame = self.switch_session(session)
+                    if frame is not None:
+                        session.socket.sendall(frame)
+                        return True
+                next_chunk = self.next_session_chunk(session)
+                if next_chunk is None:
+                    # caught up. a good moment for the messages that came in meanwhile, a stream switch included
+                    readable, _, _ = select.select([session.socket], [], [], 0)
+                    if len(readable) > 0:
+                        self.receive_client_messages(session)
+                        continue
+                    with self.chunk_published:
+                        self.chunk_published.wait_for(
+                            lambda: self.audio_buffer.head >= session.next_sequence, timeout=1)
+                    continue
+                codec = self.codec_ladder[session.level]
+                frame = pack_frame(session.sequence, codec, next_chunk)
+                started = time.perf_counter()
+                session.socket.sendall(frame)
+                session.send_seconds.observe(time.perf_counter() - started)
+                self.count_sent(codec, len(frame))
+                self.frame_sent(session)
+                self.advance_session(session)
+                self.adapt_level(session, time.time() - session.send_started)
+            except (ConnectionError, socket.timeout) as e:
+                if isinstance(e, socket.timeout):
+                    print("{} socket timeout".format(session.address))
+                else:
+                    print(session.address, e)
+                self.close_connection(session.socket, session.address)
+                return False
+
+    def receive_client_messages(self, session):
+        """Threaded protocol version 2. Blocks until the client sent something and handles it"""
+        msg = session.socket.recv(self.CHUNK)
+        if len(msg) == 0:
+            raise ConnectionError("client closed the connection")
+        session.in_data += msg
+        self.handle_client_messages(session)
+
+    def switch_session(self, session):
+        """Moves a protocol version 2 tcp client to the stream it asked for with MSG_STREAM, without it having
+        to reconnect. It starts in the new stream's buffer like a new client would. Returns the parameters frame
+        that has to go out before the new stream's first chunk, or None when the client stays where it is"""
+        index, session.switch_to = session.switch_to, None
+        names = list(self.streams)
+        stream = self.streams[names[index]] if index < len(names) else None
+        if stream is None or stream is self:
+            return None
+        if stream.mid_side and session.options.get("ms") != "1":
+            print("{} can not decode mid/side stereo. staying on stream {}".format(session.address, self.stream_name))
+            return None
+        print("{} switching from stream {} to {}".format(session.address, self.stream_name, stream.stream_name))
+        self.sessions.pop(session.address, None)
+        self.metrics.remove(client=session.address)
+        # the frames in flight are the old stream's. acks for them are ignored until the client acknowledged
+        # the parameters frame, which tells it everything after is the new stream
+        session.in_flight.clear()
+        session.frames_acked = session.frames_sent
+        session.switching = True
+        session.stream = stream
+        session.levels = stream.session_levels(session.options)
+        session.level = 0
+        session.since_switch = 0
+        params = stream.audio_parameters(session.options)
+        stream.begin_session(session)
+        return pack_frame(PARAMS_SEQUENCE, 0, bytes(params, "utf-8"), FLAG_PARAMS)
+
+    @staticmethod
+    def frame_sent(session):
+        """Protocol version 2. The frame for session.sequence is in flight"""
+        session.in_flight.append(session.sequence)
+        session.sent_at[session.frames_sent % session.window] = time.perf_counter()
+        session.frames_sent += 1
+
+    def send_datagrams_loop(self, session):
+        """Datagram transport send loop. Never waits on the client, the tcp connection is only watched
+        for the client hanging up"""
+        started = time.time()
+        while True:
+            try:
+                readable, _, _ = select.select([session.socket], [], [], 0)
+                if len(readable) > 0 and len(session.socket.recv(self.CHUNK)) == 0:
+                    raise ConnectionError("client closed the connection")
+                if session.udp_address is None:
+                    if time.time() - started > self.client_timeout:
+                        raise socket.timeout("client never registered for datagrams")
+                    time.sleep(0.05)
+                    continue
+                self.send_session_datagrams(session)
+                with self.chunk_published:
+                    self.chunk_published.wait_for(
+                        lambda: self.audio_buffer.head >= session.next_sequence, timeout=1)
+            except (ConnectionError, socket.timeout) as e:
+                print(session.address, e)
+                self.datagram_sessions.pop(session.session_id, None)
+                self.close_connection(session.socket, session.address)
+                return
+
+    def watch_multicast_session(self, session):
+        """Multicast clients get everything from rolling_buffer. This only waits for the client to hang up"""
+        while True:
+            try:
+                if len(session.socket.recv(self.CHUNK)) == 0:
+                    raise ConnectionError("client closed the connection")
+            except socket.timeout:
+                continue
+            except ConnectionError as e:
+                print(session.address, e)
+                self.datagram_sessions.pop(session.session_id, None)
+                self.close_connection(session.socket, session.address)
+                return
+
+    def send_multicast(self, sequence):
+        """Sends a freshly published chunk to the multicast group, once for every listener"""
+        chunk = self.audio_buffer.get(sequence)
+        timestamp = int(self.audio_buffer.publish_time(sequence) * 1000)
+        address = (self.multicast_group, self.multicast_port)
+        try:
+            for datagram in pack_datagrams(self.multicast_id, sequence, timestamp, self.use_compression, chunk):
+                self.multicast_socket.sendto(datagram, address)
+                self.count_sent(self.use_compression, len(datagram))
+            parity = self.multicast_parity.add(sequence, self.use_compression, chunk) \
+                if self.multicast_parity is not None else None
+            if parity is not None:
+                for datagram in pack_datagrams(self.multicast_id, parity[0], timestamp, 0, parity[1], FLAG_PARITY):
+                    self.multicast_socket.sendto(datagram, address)
+        except OSError as e:
+            print("multicast datagram not sent:", e)
+
+    def send_repair(self, session, sequence, address):
+        """Unicast resend of a multicast chunk a client missed, straight from the buffer"""
+        chunk = self.audio_buffer.get(sequence)
+        if chunk is None:
+            return
+        timestamp = int(self.audio_buffer.publish_time(sequence) * 1000)
+        try:
+            for datagram in pack_datagrams(self.multicast_id, sequence, timestamp, self.use_compression, chunk):
+                self.datagram_socket.sendto(datagram, address)
+                self.count_sent(self.use_compression, len(datagram))
+        except OSError as e:
+            if not isinstance(e, BlockingIOError):
+                print("{} repair not sent: {}".format(session.address, e))
+
+    def send_session_datagrams(self, session):
+        """Sends a datagram client everything published since its last datagram"""
+        if session.udp_address is None:
+            return
+        while True:
+            next_chunk = self.next_session_chunk(session)
+            if next_chunk is None:
+                return
+            self.send_datagram(session, next_chunk)
+            self.advance_session(session)
+
+    def send_datagram(self, session, chunk):
+        """One chunk, plus the parity datagram when it closes a fec group, each in as many fragments as it takes.
+        A datagram that does not fit the socket buffer is dropped like the network would, the client conceals it"""
+        codec = self.codec_ladder[session.level]
+        published = self.audio_buffer.publish_time(session.sequence)
+        timestamp = int((published if published is not None else time.monotonic()) * 1000)
+        try:
+            parity = session.parity.add(session.sequence, codec, chunk) if session.parity is not None else None
+            for datagram in pack_datagrams(session.session_id, session.sequence, timestamp, codec, chunk):
+                self.datagram_socket.sendto(datagram, session.udp_address)
+                self.count_sent(codec, len(datagram))
+            if parity is not None:
+                for datagram in pack_datagrams(session.session_id, parity[0], timestamp, 0, parity[1], FLAG_PARITY):
+                    self.datagram_socket.sendto(datagram, session.udp_address)
+        except OSError as e:
+            if not isinstance(e, BlockingIOError):
+                print("{} datagram not sent: {}".format(session.address, e))
+
+    def datagram_listener(self):
+        """Threaded mode only. The event loop reads the datagram socket itself"""
+        while True:
+            self.datagram_readable()
+
+    def datagram_readable(self):
+        """Registrations from datagram clients and repair requests from multicast clients.
+        Repairs are only sent to the address the session registered from.
+        Returns False once there is nothing left to read"""
+        try:
+            msg, address = self.datagram_socket.recvfrom(2048)
+        except (BlockingIOError, socket.timeout):
+            return False
+        except OSError as e:
+            # some systems report an earlier send to a closed port here
+            print("datagram socket:", e)
+            return True
+        if len(msg) == REPAIR_MESSAGE.size:
+            msg_type, session_id, sequence = REPAIR_MESSAGE.unpack(msg)
+            session = self.datagram_sessions.get(session_id)
+            if msg_type == MSG_REPAIR and session is not None and session.udp_address == address:
+                session.stream.send_repair(session, sequence, address)
+            return True
+        if len(msg) != CLIENT_MESSAGE.size:
+            return True
+        msg_type, session_id = CLIENT_MESSAGE.unpack(msg)
+        session = self.datagram_sessions.get(session_id)
+        if msg_type == MSG_REGISTER and session is not None:
+            if session.udp_address != address:
+                print("{} receiving datagrams on {}:{}".format(session.address, address[0], address[1]))
+            session.udp_address = address
+            session.last_activity = time.time()
+            try:
+                self.datagram_socket.sendto(msg, address)
+            except OSError as e:
+                print("{} registration not confirmed: {}".format(session.address, e))
+        return True
+
+    def handle_client_messages(self, session):
+        """Consumes complete messages from session.in_data. Acks release every frame up to the acked sequence,
+        feedback updates the client's latency controller and a stream request is picked up by the send path"""
+        while len(session.in_data) >= CLIENT_MESSAGE.size:
+            msg_type, value = CLIENT_MESSAGE.unpack(session.in_data[:CLIENT_MESSAGE.size])
+            session.in_data = session.in_data[CLIENT_MESSAGE.size:]
+            if msg_type == MSG_ACK and session.switching:
+                # still acks for the stream the client left
+                session.switching = value != PARAMS_SEQUENCE
+            elif msg_type == MSG_ACK:
+                acked = session.frames_acked
+                while len(session.in_flight) > 0 and session.in_flight[0] <= value:
+                    session.in_flight.popleft()
+                    session.frames_acked += 1
+                if session.frames_acked > acked:
+                    # window frames at most are in flight, so the newest one acked is still in sent_at
+                    session.ack_seconds.observe(
+                        time.perf_counter() - session.sent_at[(session.frames_acked - 1) % session.window])
+            elif msg_type == MSG_FEEDBACK:
+                depth, target, underruns = unpack_feedback(value)
+                if session.client_underruns is not None and underruns != session.client_underruns:
+                    # the client ran dry. let it build its buffer back up before skipping anything again
+                    session.since_skip = -4 * self.skip_interval
+                session.client_depth, session.client_target, session.client_underruns = depth, target, underruns
+            elif msg_type == MSG_STREAM:
+                session.switch_to = value
+            else:
+                raise ConnectionError("unknown message type {} from client".format(msg_type))
+
     def close_connection(self, client_socket, address):
+        session = self.sessions.pop(address, None)
+        if session is not None:
+            self.keep_resumable(session)
+        self.metrics.remove(client=address)
         try:
             client_socket.close()
             del self.clients[address]
@@ -397,31 +1516,55 @@ class AudioServer:
         except KeyError:
             print("client {} not found in clients".format(address))
         try:
-            del self.threads[address]
-            print("{} threads running".format(len(self.threads)))
+            # client threads are started by the server that accepted them, whatever stream they are on now
+            del self.host_server.threads[address]
+            print("{} threads running".format(len(self.host_server.threads)))
         except KeyError:
             print("client {} not found in threads".format(address))
 
-    def file_data_reader(self):
-        for i in self.file_stream:
-            yield i
-        return None
+    def shutdown(self):
+        """Stops capturing and encoding on every stream for good: the buffer threads end, the encoding workers
+        exit and their shared memory is freed, devices and files are closed. Connections and their threads are
+        left to end with the process"""
+        for stream in self.streams.values():
+            stream.stopped = True
+        for stream in self.streams.values():
+            thread = stream.threads.get("rolling_buffer")
+            if thread is not None:
+                thread.join(timeout=5)
+            if stream.encode_pipeline is not None:
+                stream.encode_pipeline.close()
+                stream.encode_pipeline = None
+            if stream.file_source is not None:
+                stream.file_source.close()
+            if stream.live_stream is not None:
+                stream.live_stream.stop_stream()
+                stream.live_stream.close()
+
+    def seek(self, seconds, track=None):
+        """File mode. Jumps to seconds into the file playing, or into the given file of a playlist (counting from
+        0). Clients hear it once they played the chunks that were in the buffer already"""
+        if self.file_source is None:
+            raise ValueError("only a server playing files can seek")
+        self.file_source.seek(seconds, track)
 
     def get_next_chunk(self):
+        """Returns exactly one chunk (CHUNK frames) of pcm data. Silence once a file that does not loop ended"""
         if self.filename is None:
-            while self.live_stream.get_read_available() < self.CHUNK * self.CHANNELS:
-                time.sleep(0.1)
-            data = self.live_stream.read(self.CHUNK * self.CHANNELS)
+            # pyaudio counts frames, so CHUNK frames is already CHUNK * CHANNELS samples
+            available = self.live_stream.get_read_available()
+            while available < self.CHUNK:
+                # about when the rest of the chunk is due
+                time.sleep((self.CHUNK - available) / self.RATE)
+                available = self.live_stream.get_read_available()
+            data = self.live_stream.read(self.CHUNK)
 #             print("{} frames left to read".format(self.live_stream.get_read_available()))
         else:
-            self.live_stream.read(self.CHUNK)
-            data = bytes()
-            while not self.file_finished and len(data) < self.CHUNK * 2 * self.CHANNELS:
-                try:
-                    data += next(self.file_data)
-                except StopIteration:
-                    self.file_finished = True
-                    print("reached end of file")
+            self.file_clock.pace(self.CHUNK)
+            was_finished = self.file_source.finished
+            data = self.file_source.read_chunk()
+            if self.file_source.finished and not was_finished:
+                print("reached end of file")
         return data
 
 